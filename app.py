@@ -1,16 +1,25 @@
 # Copyright © 2025 Mentics
 # All Rights Reserved.
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, Response, stream_with_context, g, has_request_context
 from werkzeug.security import generate_password_hash, check_password_hash
-from dbhelper import DatabaseHandler
+from dbhelper import DatabaseHandler, BufferedWriter
 from userhelper import User
-from functools import wraps
+from cachehelper import LLMCache
+from jsonhelper import json_loads, json_dumps, JSONProvider
+from functools import wraps, lru_cache
+from collections import defaultdict, deque
 import json
+import hashlib
+import logging
+import threading
+import time
 import google.generativeai as genai
 import os
+import tempfile
 from dotenv import load_dotenv
 import random
 from pathlib import Path
+from string import Template
 from datetime import datetime, timedelta, date
 from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from authlib.integrations.flask_client import OAuth
@@ -20,29 +29,83 @@ from werkzeug.utils import secure_filename
 env_path = Path('.') / '.env'
 load_dotenv(dotenv_path=env_path)
 
+# The AI helpers log through here; MENTICS_LOG_LEVEL=DEBUG also shows the mock-generator notices
+logging.basicConfig(level=os.getenv("MENTICS_LOG_LEVEL", "INFO"),
+                    format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
+app.json = JSONProvider(app)
 app.secret_key = os.getenv("SECRET_KEY")
 # --- START: UPLOAD FOLDER CONFIGURATION ---
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.url_map.strict_slashes = False
 app.permanent_session_lifetime = timedelta(minutes=10)
 
-# Ensure the upload folder exists
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+# The upload folder is created on first upload (see _ensure_upload_folder), not at import
+_upload_folder_ready = False
+
+
+def _ensure_upload_folder():
+    global _upload_folder_ready
+    if not _upload_folder_ready:
+        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+        _upload_folder_ready = True
+
+
+def _stream_upload(file, folder, chunk_size=64 * 1024):
+    """
+    Copies an uploaded file into a temp file in `folder` without holding it all in memory.
+    Returns (temp_path, blake2b hex digest of the contents).
+    """
+    h = hashlib.blake2b(digest_size=16)
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix=".upload")
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            while True:
+                chunk = file.stream.read(chunk_size)
+                if not chunk:
+                    break
+                h.update(chunk)
+                tmp.write(chunk)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, h.hexdigest()
 # --- END: UPLOAD FOLDER CONFIGURATION ---
 
 
 oauth = OAuth(app)
-oauth.register(
-    name='google',
-    server_metadata_url='https://accounts.google.com/.well-known/openid-configuration',
-    client_id=os.getenv("GOOGLE_CLIENT_ID"),
-    client_secret=os.getenv("GOOGLE_CLIENT_SECRET"),
-    client_kwargs={'scope': 'openid email profile'}
-)
+
+
+@lru_cache(maxsize=None)
+def _google_oauth():
+    """Registers the Google OAuth client the first time a login route needs it, instead of at worker boot."""
+    return oauth.register(
+        name='google',
+        server_metadata_url='https://accounts.google.com/.well-known/openid-configuration',
+        client_id=os.getenv("GOOGLE_CLIENT_ID"),
+        client_secret=os.getenv("GOOGLE_CLIENT_SECRET"),
+        client_kwargs={'scope': 'openid email profile'}
+    )
+
+
+# Stored in the database's PRAGMA user_version by init_db(). Bump it whenever init_db()
+# changes so existing databases get the new tables/indexes on the next start.
+SCHEMA_VERSION = 3
 
 
 def init_db():
+    # Every CREATE/ALTER below commits together: one journal sync instead of one per
+    # statement, and a migration that fails partway leaves the old schema and version intact
+    with db.transaction():
+        _create_schema()
+        db.execute(f"PRAGMA user_version = {SCHEMA_VERSION};")
+    # Refresh query planner statistics now that the schema and indexes are in place
+    db.execute("PRAGMA optimize;")
+
+
+def _create_schema():
     db.create_table("users", {
         "id": "INTEGER PRIMARY KEY AUTOINCREMENT",
         "email": "TEXT NOT NULL UNIQUE",
@@ -51,12 +114,14 @@ def init_db():
         "name": "TEXT NOT NULL DEFAULT ''",
         "onboarding_completed": "BOOLEAN DEFAULT FALSE",
         "onboarding_data": "TEXT",
-        "profile_picture": "TEXT"
+        "profile_picture": "TEXT",
+        "pfp_hash": "TEXT"
     })
     db.add_column("users", "name", "TEXT NOT NULL DEFAULT ''")
     db.add_column("users", "onboarding_completed", "BOOLEAN DEFAULT FALSE")
     db.add_column("users", "onboarding_data", "TEXT")
     db.add_column("users", "profile_picture", "TEXT")
+    db.add_column("users", "pfp_hash", "TEXT")
 
     db.create_table("paths", {
         "id": "INTEGER PRIMARY KEY AUTOINCREMENT",
@@ -90,6 +155,12 @@ def init_db():
         "stat_value": "TEXT NOT NULL",
         "recorded_at": "TIMESTAMP DEFAULT CURRENT_TIMESTAMP"
     })
+    # Prompt-ready summary of each user's recent stat_history, rewritten whenever a stat is recorded
+    db.create_table("user_stat_snapshots", {
+        "user_id": "INTEGER PRIMARY KEY",
+        "summary": "TEXT NOT NULL",
+        "updated_at": "TIMESTAMP DEFAULT CURRENT_TIMESTAMP"
+    })
     db.create_table("chat_conversations", {
         "id": "INTEGER PRIMARY KEY AUTOINCREMENT",
         "user_id": "INTEGER NOT NULL",
@@ -97,6 +168,16 @@ def init_db():
         "history": "TEXT NOT NULL",
         "UNIQUE": "(user_id, category)"
     })
+    # One row per chat message; replaces the per-conversation JSON blob in chat_conversations
+    db.create_table("chat_messages", {
+        "id": "INTEGER PRIMARY KEY AUTOINCREMENT",
+        "user_id": "INTEGER NOT NULL",
+        "category": "TEXT NOT NULL",
+        "seq": "INTEGER NOT NULL",
+        "role": "TEXT NOT NULL",
+        "content": "TEXT NOT NULL",
+        "UNIQUE": "(user_id, category, seq)"
+    })
     db.create_table("activity_log", {
         "id": "INTEGER PRIMARY KEY AUTOINCREMENT",
         "user_id": "INTEGER NOT NULL",
@@ -194,40 +275,276 @@ def init_db():
 
     # Add a new column to the paths table to store the article ID
     db.add_column("paths", "secondary_content_id", "INTEGER")
+
+    # Cached Gemini responses (see cachehelper.LLMCache)
+    db.create_table("llm_cache", {
+        "prompt_hash": "TEXT PRIMARY KEY",
+        "namespace": "TEXT",
+        "response": "TEXT NOT NULL",
+        "embedding": "BLOB",
+        "created_at": "TIMESTAMP DEFAULT CURRENT_TIMESTAMP"
+    })
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_llm_cache_namespace_created ON llm_cache (namespace, created_at);")
+    # The expiry sweep deletes by age across every namespace
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_llm_cache_created ON llm_cache (created_at);")
+
+    # Last generated tasks per user and input fingerprint, so a quick resubmit skips Gemini
+    db.create_table("path_generation_cache", {
+        "user_id": "INTEGER NOT NULL",
+        "input_key": "TEXT NOT NULL",
+        "tasks": "TEXT NOT NULL",
+        "created_at": "TIMESTAMP DEFAULT CURRENT_TIMESTAMP",
+        "UNIQUE": "(user_id, input_key)"
+    })
     # --- START of the FIX ---
-    # Drop the old, inefficient index if it exists, to be safe.
+    # Drop the old, inefficient indexes if they exist, to be safe.
     try:
         db.execute("DROP INDEX IF EXISTS idx_paths_user_category_active;")
+        db.execute(
+            "DROP INDEX IF EXISTS idx_paths_user_category_active_created;")
     except Exception as e:
         print(f"Could not drop old index (this is likely fine): {e}")
 
     # Create the new, correct, and highly performant index.
-    # This new index includes the 'created_at' column which is critical for performance.
+    # It ends in task_order so the active-task lookups are answered in order without a sort.
     db.execute(
         """
-        CREATE INDEX IF NOT EXISTS idx_paths_user_category_active_created
-        ON paths (user_id, category, is_active, created_at DESC);
+        CREATE INDEX IF NOT EXISTS idx_paths_active
+        ON paths (user_id, category, is_active, created_at DESC, task_order);
         """
     )
     # --- END of the FIX ---
 
+    # Indexes for the per-user lookups that run on every AI call
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_stat_hist_user_time ON stat_history (user_id, recorded_at DESC);")
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_quiz_results_user_wrong ON quiz_results (user_id, is_correct, submitted_at DESC);")
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_sprint_results_user_wrong ON sprint_results (user_id, is_correct, submitted_at DESC);")
+
+    # Serves the completed/incomplete path history lookups used when generating a new path
+    db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_paths_user_cat_done
+        ON paths (user_id, category, is_completed, created_at DESC);
+        """
+    )
+
+    # /api/tasks loads every subtask of the active path by parent id
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_subtasks_parent ON subtasks (parent_task_id);")
+    # Forum listing (newest first), then replies per listed post, oldest first
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_forum_posts_created ON forum_posts (created_at DESC);")
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_forum_replies_post_time ON forum_replies (post_id, created_at);")
+    # Last few completed tasks for the proactive suggestion
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_activity_user_type_time ON activity_log (user_id, activity_type, created_at DESC);")
+    # Leaderboard top 10 reads the first rows of this index instead of sorting every user
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_gamification_points ON gamification_stats (points DESC);")
+    # Dashboard recent activity, activity chart and suggestion lookups
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_activity_log_user_time ON activity_log (user_id, created_at DESC);")
+
+    # Full-text index over forum post titles and bodies for the forum search. The text
+    # itself stays in forum_posts (external content); the triggers keep the index in sync.
+    forum_fts_exists = db.execute_for_one(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='forum_posts_fts'")
+    db.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS forum_posts_fts USING fts5(title, content, content='forum_posts', content_rowid='id');")
+    db.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS forum_posts_fts_ai AFTER INSERT ON forum_posts BEGIN
+            INSERT INTO forum_posts_fts (rowid, title, content) VALUES (new.id, new.title, new.content);
+        END;
+        """
+    )
+    db.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS forum_posts_fts_ad AFTER DELETE ON forum_posts BEGIN
+            INSERT INTO forum_posts_fts (forum_posts_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+        END;
+        """
+    )
+    db.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS forum_posts_fts_au AFTER UPDATE ON forum_posts BEGIN
+            INSERT INTO forum_posts_fts (forum_posts_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+            INSERT INTO forum_posts_fts (rowid, title, content) VALUES (new.id, new.title, new.content);
+        END;
+        """
+    )
+    if not forum_fts_exists:
+        # Index the posts written before the search table existed
+        db.execute("INSERT INTO forum_posts_fts (forum_posts_fts) VALUES ('rebuild');")
+
 
 # --- HELPER FUNCTIONS ---
 
+_UTC = ZoneInfo("UTC")
+
+
+@lru_cache(maxsize=64)
+def _tz(name):
+    """Returns a shared ZoneInfo for a timezone name; raises ZoneInfoNotFoundError like ZoneInfo."""
+    return ZoneInfo(name)
+
+
+def _tz_or_utc(name):
+    """Like _tz, but falls back to UTC for unknown or malformed timezone names."""
+    try:
+        return _tz(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return _UTC
+
+
+_EMPTY_DETAILS_JSON = "{}"
+
+
+def _test_date_delta(test_date_str, user_tz):
+    """
+    Returns (formatted_date, days_until) for a 'YYYY-MM-DD' test date, counted from today
+    in the given ZoneInfo. Raises ValueError for a bad date.
+    """
+    return _test_date_delta_on(test_date_str, datetime.now(user_tz).date())
+
+
+@lru_cache(maxsize=1024)
+def _test_date_delta_on(test_date_str, today):
+    # Keyed on today's date so "days remaining" rolls over at midnight
+    test_date = date.fromisoformat(test_date_str)
+    return test_date.strftime('%B %d, %Y'), (test_date - today).days
+
 
 def log_activity(user_id, activity_type, details={}):
     """Helper function to log user activities into the database."""
-    db.insert("activity_log", {
-        "user_id": user_id,
-        "activity_type": activity_type,
-        "details": json.dumps(details)
-    })
+    # Queued and written in batches by activity_writer, off the request path.
+    # The timestamp is taken now so a delayed flush doesn't shift it.
+    activity_writer.put((
+        user_id,
+        activity_type,
+        json_dumps(details) if details else _EMPTY_DETAILS_JSON,
+        datetime.now(_UTC).strftime('%Y-%m-%d %H:%M:%S')
+    ))
+
+
+# Chat turns read the stat summary on every message, so each worker keeps it briefly.
+# _forget_stat_summary drops the entry here; other workers pick the change up within the TTL.
+_STAT_SUMMARY_TTL_SECONDS = 60
+_STAT_SUMMARY_CACHE_MAX = 1024
+_stat_summary_cache = {}
+_stat_summary_lock = threading.Lock()
 
 
 def _get_stat_history_for_prompt(user_id):
     """Fetches and formats a summary of the user's stat history for AI prompts."""
+    cached = _stat_summary_cache.get(user_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    # Kept up to date by _refresh_stat_snapshot, so this is a primary-key lookup
+    snapshot = db.select_one(
+        "user_stat_snapshots", columns=["summary"], where={"user_id": user_id})
+    if snapshot:
+        summary = snapshot['summary']
+    else:
+        # Users with no snapshot yet (e.g. history recorded before snapshots existed)
+        summary = _refresh_stat_snapshot(user_id)
+    with _stat_summary_lock:
+        if len(_stat_summary_cache) >= _STAT_SUMMARY_CACHE_MAX:
+            _stat_summary_cache.clear()
+        _stat_summary_cache[user_id] = (
+            time.monotonic() + _STAT_SUMMARY_TTL_SECONDS, summary)
+    return summary
+
+
+def _refresh_stat_snapshot(user_id):
+    """Rebuilds the user's stat-history summary from their last 20 rows and stores it. Returns the summary."""
     history_records = db.select(
-        "stat_history", where={"user_id": user_id}, order_by="recorded_at DESC LIMIT 20")
+        "stat_history", columns=["stat_name", "stat_value", "recorded_at"],
+        where={"user_id": user_id}, order_by="recorded_at DESC", limit=20)
+    summary = _format_stat_history(history_records)
+    db.execute(
+        """INSERT INTO user_stat_snapshots (user_id, summary, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+           ON CONFLICT(user_id) DO UPDATE SET summary = excluded.summary, updated_at = excluded.updated_at""",
+        (user_id, summary))
+    return summary
+
+
+def _forget_stat_summary(user_id):
+    """
+    Drops this worker's cached summary for the user. Call it after the transaction that
+    refreshed the snapshot has committed: a chat turn reading before the commit would
+    otherwise cache the old summary again for the full TTL.
+    """
+    with _stat_summary_lock:
+        _stat_summary_cache.pop(user_id, None)
+
+
+def _get_task_counts(user_id):
+    """
+    Counts the user's tasks per category in one grouped query:
+    total, completed in the active path (cur_done) and completed overall (total_done).
+    Both main categories are always present, with zeros when the user has no tasks there.
+    """
+    counts = {category: {"total": 0, "cur_done": 0, "total_done": 0}
+              for category in ('Test Prep', 'College Planning')}
+    rows = db.execute(
+        """SELECT category, COUNT(*) AS total,
+                  SUM(CASE WHEN is_active AND is_completed THEN 1 ELSE 0 END) AS cur_done,
+                  SUM(CASE WHEN is_completed THEN 1 ELSE 0 END) AS total_done
+           FROM paths WHERE user_id = ? GROUP BY category""", (user_id,))
+    for row in rows:
+        counts[row['category']] = row
+    return counts
+
+
+_ACT_SECTIONS = ("act_math", "act_reading", "act_science")
+
+
+def _compute_key_stat_totals(stats):
+    """Returns (sat_total, act_average) from a user's stats dict, None where not available."""
+    sat_ebrw, sat_math = stats.get("sat_ebrw"), stats.get("sat_math")
+    sat_total = None
+    if sat_ebrw and sat_math:
+        try:
+            sat_total = int(sat_ebrw) + int(sat_math)
+        except (ValueError, TypeError):
+            sat_total = None  # Handle case where values are not valid integers
+
+    # Running total and count in one pass, no intermediate list
+    act_total = act_count = 0
+    try:
+        for key in _ACT_SECTIONS:
+            value = stats.get(key)
+            if value:
+                act_total += int(value)
+                act_count += 1
+    except (ValueError, TypeError):
+        act_count = 0
+    act_average = round(act_total / act_count) if act_count else None
+    return sat_total, act_average
+
+
+def _refresh_key_stat_totals(stats):
+    """Stores the derived SAT total / ACT average in the stats blob; call before saving score changes."""
+    stats['_sat_total'], stats['_act_average'] = _compute_key_stat_totals(stats)
+
+
+def _key_stat_totals(stats):
+    """Returns (sat_total, act_average), using the values stored at write time when present."""
+    if '_sat_total' in stats:
+        return stats['_sat_total'], stats.get('_act_average')
+    # Stats saved before the derived values were stored
+    return _compute_key_stat_totals(stats)
+
+
+def _format_stat_history(history_records):
+    """Formats stat_history rows (newest first) into the bullet summary used in AI prompts."""
     if not history_records:
         return "No historical performance data available yet."
 
@@ -241,37 +558,147 @@ def _get_stat_history_for_prompt(user_id):
             f"- On {date}, their {readable_name} was recorded as {stat_value}.")
     return "\n".join(summary)
 
+
+# The user's 5 most recent wrong quiz/sprint answers. SQLite pulls the correct option's text out of
+# the options JSON. {user_id} is a ? placeholder when run on its own, or u.id inside the context query.
+_MISSED_QUIZ_ANSWERS_SQL = """
+    SELECT qq.question_text,
+           json_extract(qq.options, '$[' || qq.correct_option || ']') AS correct_text,
+           qq.explanation
+    FROM quiz_results qr
+    JOIN quiz_questions qq ON qr.question_id = qq.id
+    WHERE qr.user_id = {user_id} AND qr.is_correct = 0
+    ORDER BY qr.submitted_at DESC
+    LIMIT 5
+"""
+_MISSED_SPRINT_ANSWERS_SQL = """
+    SELECT sq.question_text,
+           json_extract(sq.options, '$[' || sq.correct_option || ']') AS correct_text,
+           sq.explanation
+    FROM sprint_results sr
+    JOIN sprint_questions sq ON sr.question_id = sq.id
+    WHERE sr.user_id = {user_id} AND sr.is_correct = 0
+    ORDER BY sr.submitted_at DESC
+    LIMIT 5
+"""
+_NO_MISSED_QUIZ_ANSWERS = "No recent incorrect quiz answers on record. The user may be new or performing well."
+_NO_MISSED_SPRINT_ANSWERS = "No recent incorrect answers in practice sprints."
+
+
+def _missed_answers_column(answers_sql, alias):
+    """A context-query column holding the missed answers as a JSON array of objects."""
+    return f"""(SELECT json_group_array(json_object(
+                'question_text', question_text, 'correct_text', correct_text, 'explanation', explanation))
+             FROM ({answers_sql.format(user_id="u.id")})) AS {alias}"""
+
+
+_MISSED_ANSWERS_COLUMNS = (
+    f",\n            {_missed_answers_column(_MISSED_QUIZ_ANSWERS_SQL, 'missed_quiz')},"
+    f"\n            {_missed_answers_column(_MISSED_SPRINT_ANSWERS_SQL, 'missed_sprint')}")
+
+
+def _format_missed_answers(answers, empty_message):
+    """Formats missed quiz/sprint answers into the bullet list used in AI prompts."""
+    if not answers:
+        return empty_message
+    return "\n".join(
+        f"- Question: {answer['question_text']}\n"
+        f"  - Correct Answer: \"{answer['correct_text']}\"\n"
+        f"  - Explanation: {answer['explanation']}"
+        for answer in answers
+    )
+
+
+def _format_task_bullets(descriptions):
+    """Task descriptions as a "- " bullet list for prompts, or "None." when there aren't any."""
+    # One join with the separator carrying the bullet, rather than building a string per task
+    return "- " + "\n- ".join(descriptions) if descriptions else "None."
+
+
+def _get_path_generation_context(user_id, category, include_missed_answers=False):
+    """
+    Fetches everything path generation reads from the database in a single query:
+    the user's stats, their completed/incomplete task descriptions (lists of str) for the category,
+    and their last 20 stat_history rows. Returns None if the user doesn't exist.
+    With include_missed_answers, the formatted quiz and sprint summaries come back
+    from the same query as "quiz_results" and "sprint_results".
+    """
+    # The prompt only shows a short bulleted summary, so each list is capped at the 20 most recent rows.
+    # Both task lists are range scans on idx_paths_user_cat_done.
+    query = """
+        WITH recent_stats AS (
+            SELECT stat_name, stat_value, recorded_at FROM stat_history
+            WHERE user_id = ?
+            ORDER BY recorded_at DESC
+            LIMIT 20
+        ),
+        completed_tasks AS (
+            SELECT description FROM paths
+            WHERE user_id = ? AND category = ? AND is_completed = 1
+            ORDER BY created_at DESC
+            LIMIT 20
+        ),
+        incomplete_tasks AS (
+            SELECT description FROM paths
+            WHERE user_id = ? AND category = ? AND is_completed = 0
+            ORDER BY created_at DESC
+            LIMIT 20
+        )
+        SELECT
+            u.stats AS stats,
+            (SELECT json_group_array(description) FROM completed_tasks) AS completed,
+            (SELECT json_group_array(description) FROM incomplete_tasks) AS incomplete,
+            (SELECT json_group_array(json_object(
+                'stat_name', stat_name, 'stat_value', stat_value, 'recorded_at', recorded_at))
+             FROM recent_stats) AS stat_history{missed_answers}
+        FROM users u
+        WHERE u.id = ?
+    """.format(missed_answers=_MISSED_ANSWERS_COLUMNS if include_missed_answers else "")
+    rows = db.execute(query, (user_id, user_id, category,
+                      user_id, category, user_id))
+    if not rows:
+        return None
+    row = rows[0]
+    context = {
+        "stats": json_loads(row['stats']) if row['stats'] else {},
+        "path_history": {
+            "completed": json_loads(row['completed']),
+            "incomplete": json_loads(row['incomplete'])
+        },
+        "stat_history": json_loads(row['stat_history'])
+    }
+    if include_missed_answers:
+        context["quiz_results"] = _format_missed_answers(
+            json_loads(row['missed_quiz']), _NO_MISSED_QUIZ_ANSWERS)
+        context["sprint_results"] = _format_missed_answers(
+            json_loads(row['missed_sprint']), _NO_MISSED_SPRINT_ANSWERS)
+    return context
+
 # --- NEW HELPER FUNCTION TO GET QUIZ RESULTS ---
 
 
 def _get_quiz_results_for_prompt(user_id):
     """Fetches and formats a summary of the user's recent incorrect quiz answers for AI prompts."""
-    query = """
-        SELECT qq.question_text, qq.options, qq.correct_option, qq.explanation
-        FROM quiz_results qr
-        JOIN quiz_questions qq ON qr.question_id = qq.id
-        WHERE qr.user_id = ? AND qr.is_correct = 0
-        ORDER BY qr.submitted_at DESC
-        LIMIT 5
-    """
-    incorrect_answers = db.execute(query, (user_id,))
+    incorrect_answers = db.execute(
+        _MISSED_QUIZ_ANSWERS_SQL.format(user_id="?"), (user_id,))
+    return _format_missed_answers(incorrect_answers, _NO_MISSED_QUIZ_ANSWERS)
 
-    if not incorrect_answers:
-        return "No recent incorrect quiz answers on record. The user may be new or performing well."
 
-    summary = []
-    for answer in incorrect_answers:
-        options = json.loads(answer['options'])
-        correct_answer_text = options[answer['correct_option']]
-        summary.append(
-            f"- Question: {answer['question_text']}\n"
-            f"  - Correct Answer: \"{correct_answer_text}\"\n"
-            f"  - Explanation: {answer['explanation']}"
-        )
-    return "\n".join(summary)
+# --- DECORATORS & FILTERS ---
 
 
-# --- DECORATORS & FILTERS ---
+def _request_tz():
+    """The user's timezone (UTC if unset or unknown), read from the session once per request and kept on g."""
+    if 'user_tz' not in g:
+        g.user_tz = _tz_or_utc(session.get('timezone', 'UTC'))
+    return g.user_tz
+
+
+def _current_user():
+    """Loads the signed-in user's row once per request and keeps it on g."""
+    if 'current_user' not in g:
+        g.current_user = User.from_session(db, session)
+    return g.current_user
 
 
 def login_required(f):
@@ -279,7 +706,7 @@ def login_required(f):
     def decorated_function(*args, **kwargs):
         if "user" not in session:
             return redirect(url_for("login"))
-        user = User.from_session(db, session)
+        user = _current_user()
         if user is None:
             session.clear()
             return redirect(url_for("login"))
@@ -293,66 +720,227 @@ def format_date_filter(s):
     if not s:
         return ""
     try:
-        user_tz_str = session.get('timezone', 'UTC')
-        user_tz = ZoneInfo(user_tz_str)
-        naive_dt = datetime.strptime(s, '%Y-%m-%d %H:%M:%S')
-        utc_dt = naive_dt.replace(tzinfo=ZoneInfo("UTC"))
+        user_tz = _request_tz()
+        # SQLite's 'YYYY-MM-DD HH:MM:SS' timestamps parse natively (and in C) with fromisoformat
+        naive_dt = datetime.fromisoformat(s)
+        utc_dt = naive_dt.replace(tzinfo=_UTC)
         user_local_dt = utc_dt.astimezone(user_tz)
         return user_local_dt.strftime('%b %d, %Y')
-    except (ZoneInfoNotFoundError, ValueError, TypeError):
+    except (ValueError, TypeError):
         return s.split(' ')[0]
 
 
+@app.before_request
+def _set_request_clock():
+    # One clock read per request, shared by every time_ago on the page
+    g.now_ts = time.time()
+
+
+# Naive so SQLite's naive UTC timestamps can be subtracted from it without attaching a tzinfo
+_EPOCH = datetime(1970, 1, 1)
+
+
+@lru_cache(maxsize=4096)
+def _utc_timestamp(s):
+    """Epoch seconds for a SQLite UTC timestamp string (replies often share the same one)."""
+    return (datetime.fromisoformat(s) - _EPOCH).total_seconds()
+
+
 @app.template_filter('time_ago')
 def time_ago_filter(s):
     if not s:
         return ""
     try:
-        naive_dt = datetime.strptime(s, '%Y-%m-%d %H:%M:%S')
-        utc_dt = naive_dt.replace(tzinfo=ZoneInfo("UTC"))
-        now = datetime.now(ZoneInfo("UTC"))
-        diff = now - utc_dt
-        seconds = diff.total_seconds()
+        # _set_request_clock always sets now_ts; the fallback only covers rendering outside a request
+        now_ts = g.now_ts if 'now_ts' in g else time.time()
+        seconds = int(now_ts - _utc_timestamp(s))
         if seconds < 60:
             return "just now"
-        minutes = seconds / 60
+        minutes = seconds // 60
         if minutes < 60:
-            return f"{int(minutes)}m ago"
-        hours = minutes / 60
+            return f"{minutes}m ago"
+        hours = minutes // 60
         if hours < 24:
-            return f"{int(hours)}h ago"
-        days = hours / 24
-        return f"{int(days)}d ago"
-    except (ZoneInfoNotFoundError, ValueError, TypeError):
+            return f"{hours}h ago"
+        return f"{hours // 24}d ago"
+    except (ValueError, TypeError):
         return s.split(' ')[0]
 
 # --- AI HELPER FUNCTIONS (UPDATED) ---
 
+_GEMINI_MODEL = 'gemini-2.5-flash'
+# Path generation asks for structured output; shared so the prefix-model cache key is built once
+_JSON_GENERATION_CONFIG = {"response_mime_type": "application/json"}
+_JSON_GENERATION_CONFIG_KEY = json.dumps(_JSON_GENERATION_CONFIG, sort_keys=True)
+
+# Gemini context caches for the static half of each prompt, keyed by a hash of the prefix
+_PREFIX_CACHE_TTL = timedelta(hours=1)
+# Gemini won't create a context cache below this many tokens. Prefixes are estimated at about
+# 4 characters per token, and the shorter ones just send the full system instruction.
+_PREFIX_CACHE_MIN_TOKENS = 1024
+_CHARS_PER_TOKEN = 4
+# After a failed create, serve the plain model this long before trying the cache again
+_PREFIX_CACHE_FAILURE_BACKOFF_SECONDS = 6 * 3600
+_prefix_models = {}
+# One in-flight build per key; other threads wait on its Event instead of creating a second cache
+_prefix_builds = {}
+_prefix_models_lock = threading.Lock()
+
+
+@lru_cache(maxsize=64)
+def _prefix_digest(static_prefix):
+    # The prefixes are a handful of fixed strings, so each one is only hashed once
+    return hashlib.sha256(static_prefix.encode("utf-8")).hexdigest()
+
+
+def _build_prefix_model(static_prefix, generation_config, now):
+    """Creates the model for _get_prefix_cached_model. Returns (model, expires_at)."""
+    def plain_model():
+        return genai.GenerativeModel(
+            _GEMINI_MODEL, system_instruction=static_prefix, generation_config=generation_config)
+
+    if len(static_prefix) < _PREFIX_CACHE_MIN_TOKENS * _CHARS_PER_TOKEN:
+        # Too small to cache, and that won't change
+        return plain_model(), float("inf")
+    try:
+        cached = genai.caching.CachedContent.create(
+            model=f'models/{_GEMINI_MODEL}',
+            system_instruction=static_prefix,
+            ttl=_PREFIX_CACHE_TTL
+        )
+    except Exception as e:
+        logger.warning("Context cache unavailable, sending full system instruction: %s", e)
+        return plain_model(), now + _PREFIX_CACHE_FAILURE_BACKOFF_SECONDS
+    model = genai.GenerativeModel.from_cached_content(
+        cached, generation_config=generation_config)
+    # Refresh a few minutes early so we never hand out a model whose cache just expired
+    return model, now + _PREFIX_CACHE_TTL.total_seconds() - 300
+
+
+def _get_prefix_cached_model(static_prefix, generation_config=None):
+    """
+    Returns a GenerativeModel whose system instruction is served from Gemini's context cache,
+    so the static prefix is uploaded once per hour instead of billed on every call.
+    Falls back to a plain system_instruction model if the prefix is below the provider's
+    minimum cacheable size or the cache can't be created.
+    """
+    config_key = (_JSON_GENERATION_CONFIG_KEY if generation_config is _JSON_GENERATION_CONFIG
+                  else json.dumps(generation_config, sort_keys=True))
+    key = (_prefix_digest(static_prefix), config_key)
+    while True:
+        now = time.monotonic()
+        entry = _prefix_models.get(key)
+        if entry and entry[1] > now:
+            return entry[0]
+        with _prefix_models_lock:
+            entry = _prefix_models.get(key)
+            if entry and entry[1] > now:
+                return entry[0]
+            build = _prefix_builds.get(key)
+            if build is None:
+                build = _prefix_builds[key] = threading.Event()
+                break
+        # Someone else is creating this cache; use theirs rather than paying for another one
+        build.wait()
+
+    # Created outside the lock so one slow cache create doesn't hold up other prefixes
+    try:
+        model, expires_at = _build_prefix_model(static_prefix, generation_config, now)
+        with _prefix_models_lock:
+            _prefix_models[key] = (model, expires_at)
+    finally:
+        with _prefix_models_lock:
+            del _prefix_builds[key]
+        build.set()
+    return model
+
+
+@lru_cache(maxsize=None)
+def _get_plain_model():
+    """Shared model for one-off prompts that carry everything in the request itself."""
+    return genai.GenerativeModel(_GEMINI_MODEL)
+
+
+# Per-user cap on uncached Gemini calls from the essay, suggestion and tracker helpers.
+# Counted per worker process, which is enough to stop a stuck button or script from
+# running up the bill.
+_AI_CALLS_PER_MINUTE = 6
+_recent_ai_calls = defaultdict(deque)
+_recent_ai_calls_lock = threading.Lock()
+
+
+def _allow_ai_call(user_id):
+    """Records an AI call for the user and returns False if they're over the per-minute cap."""
+    now = time.monotonic()
+    with _recent_ai_calls_lock:
+        calls = _recent_ai_calls[user_id]
+        while calls and now - calls[0] > 60:
+            calls.popleft()
+        if len(calls) >= _AI_CALLS_PER_MINUTE:
+            return False
+        calls.append(now)
+        return True
+
+
+def _cached_generate(prompt, user_id, cache_key=None):
+    """
+    Calls the plain Gemini model with an exact-match llm_cache lookup in front, so an
+    identical request is answered from the cache instead of Gemini.
+    cache_key defaults to the prompt itself. Returns None if the user is rate limited.
+    """
+    cache_key = cache_key or prompt
+    cached = llm_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    if not _allow_ai_call(user_id):
+        logger.warning("AI rate limit reached for user %s", user_id)
+        return None
+    text = _get_plain_model().generate_content(prompt).text
+    llm_cache.put(cache_key, text)
+    return text
+
+
+def _log_cached_token_usage(label, response):
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return
+    logger.info("%s: prompt_tokens=%s, cache_read_input_tokens=%s",
+                label, usage.prompt_token_count, usage.cached_content_token_count)
+
 
 def _get_current_numbered_tasks(user_id, category):
     """Helper function to get current active tasks with numbering for a specific category."""
-    latest_task_query = """
-        SELECT created_at FROM paths
-        WHERE user_id=? AND category=? AND is_active=True
-        ORDER BY created_at DESC LIMIT 1
+    # Several prompts in one request can ask for the same list, so remember it on g
+    if has_request_context():
+        memo = g.setdefault('current_tasks', {})
+        if (user_id, category) not in memo:
+            memo[(user_id, category)] = _load_current_numbered_tasks(
+                user_id, category)
+        return memo[(user_id, category)]
+    return _load_current_numbered_tasks(user_id, category)
+
+
+def _forget_current_numbered_tasks():
+    """Drops the request's memoized task lists after the active path changes."""
+    if has_request_context():
+        g.pop('current_tasks', None)
+
+
+def _load_current_numbered_tasks(user_id, category):
+    # Latest batch of active tasks in one round-trip, already in task order
+    active_tasks_query = """
+        WITH latest AS (
+            SELECT MAX(created_at) AS ts FROM paths
+            WHERE user_id=? AND category=? AND is_active=1
+        )
+        SELECT paths.description, paths.is_completed FROM paths, latest
+        WHERE user_id=? AND category=? AND is_active=1 AND created_at = latest.ts
+        ORDER BY task_order
     """
-    latest_task_timestamp_result = db.execute(
-        latest_task_query, (user_id, category))
-    if not latest_task_timestamp_result:
-        return "No active tasks at the moment."
-    latest_timestamp = latest_task_timestamp_result[0]['created_at']
-    active_tasks = db.select(
-        "paths",
-        where={
-            "user_id": user_id,
-            "is_active": True,
-            "category": category,
-            "created_at": latest_timestamp
-        }
-    )
+    active_tasks = db.execute(
+        active_tasks_query, (user_id, category, user_id, category))
     if not active_tasks:
         return "No active tasks at the moment."
-    active_tasks = sorted(active_tasks, key=lambda x: x['task_order'])
     numbered_tasks = []
     for i, task in enumerate(active_tasks, 1):
         status = "✅ (Completed)" if task['is_completed'] else "⏳ (In Progress)"
@@ -365,53 +953,262 @@ def _get_current_numbered_tasks(user_id, category):
 
 def _get_sprint_results_for_prompt(user_id):
     """Fetches and formats a summary of the user's recent incorrect sprint answers for AI prompts."""
-    query = """
-        SELECT sq.question_text, sq.options, sq.correct_option, sq.explanation
-        FROM sprint_results sr
-        JOIN sprint_questions sq ON sr.question_id = sq.id
-        WHERE sr.user_id = ? AND sr.is_correct = 0
-        ORDER BY sr.submitted_at DESC
-        LIMIT 5
-    """
-    incorrect_answers = db.execute(query, (user_id,))
-    if not incorrect_answers:
-        return "No recent incorrect answers in practice sprints."
+    incorrect_answers = db.execute(
+        _MISSED_SPRINT_ANSWERS_SQL.format(user_id="?"), (user_id,))
+    return _format_missed_answers(incorrect_answers, _NO_MISSED_SPRINT_ANSWERS)
+
+
+# Fallback tasks for when the AI service is unavailable. Built once; callers get fresh copies.
+_MOCK_TEST_PREP_TASKS = (
+    {"task_format": "link", "description": "Take a full-length, timed SAT practice test from the [official College Board site](https://satsuite.collegeboard.org/sat/practice-preparation/practice-tests).",
+     "reason": "This is a 'boss battle' to test your skills under pressure.", "type": "milestone", "stat_to_update": "sat_total", "category": "Test Prep", "difficulty": "hard"},
+    {"task_format": "link", "description": "Review algebra concepts using [Khan Academy](https://www.khanacademy.org/math/algebra).",
+     "reason": "A strong algebra foundation is crucial.", "type": "standard", "stat_to_update": None, "category": "Test Prep", "difficulty": "medium"},
+    {"task_format": "link", "description": "Practice time management for the reading section.", "reason": "Pacing is key to finishing on time.",
+        "type": "standard", "stat_to_update": None, "category": "Test Prep", "difficulty": "medium"},
+)
 
-    summary = []
-    for answer in incorrect_answers:
-        options = json.loads(answer['options'])
-        correct_answer_text = options[answer['correct_option']]
-        summary.append(
-            f"- Question: {answer['question_text']}\n"
-            f"  - Correct Answer: \"{correct_answer_text}\"\n"
-            f"  - Explanation: {answer['explanation']}"
-        )
-    return "\n".join(summary)
 
+# --- PROMPT TEMPLATES ---
+# Built once at import; each call only fills in the $placeholders.
+
+# The preamble and JSON schema only vary by test focus, so Gemini can cache them (see _get_prefix_cached_model)
+_TEST_PREP_TASKS_PREFIX = Template(
+    "# MISSION\n"
+    "You are an elite AI test prep coach for Mentics. Your mission is to generate an intelligent, 5-step study plan tailored to the student's evolving needs, demonstrating a deep understanding of their history and context SPECIFICALY FOR THE DIGITAL SAT AND THE ACT.\n\n"
+    "## CRITICAL SCENARIO ANALYSIS\n"
+    "1.  **Regeneration Request:** If the user's latest message asks for a new path, your highest priority is to generate one that addresses their immediate request.\n"
+    "2.  **Post-Path Continuation:** If the student just completed all tasks, the new plan MUST be a logical next step (e.g., analyzing scores, planning long-term improvements).\n"
+    "3.  **Standard Generation:** Otherwise, generate a standard path that builds on their history.\n\n"
+    "# YOUR TASK: GENERATE THE NEW 5-STEP PLAN(for $focus_upper)\n"
+    "- **Focus on $focus_upper:** All content, examples, and resources MUST be relevant to the chosen test format(s).\n"
+    "- **Task Format Logic (Crucial!):** You must differentiate between passive learning and active practice. \n"
+    "  - If a task involves **actively solving problems or answering questions or mastering a math concept or advancing/consolidating knowlege **, it MUST be a `practice_sprint`.\n"
+    "  - If a task involves **reading articles, or watching content on yt or using external resources**, it MUST be a `link`, `strategy`, or `review` task.\n"
+    "- **Synthesize, Don't Just List:** Your primary function is to connect multiple data points to create hyper-specific tasks. Generic tasks like 'Practice Algebra' are forbidden.\n"
+    "- **Extreme Specificity & Actionable Verbs:** Descriptions must be granular and start with a strong verb (e.g., 'Master', 'Analyze', 'Implement').\n"
+    "- **Incorporate Multiple Formats:** The plan must include a mix of task types, including at least one `practice_sprint`.\n"
+    "- ** DIGITAL SAT & ACT FOCUS:** All tasks must be relevant to the unique formats and content of the Digital SAT and ACT, do not include thigns that were on the Paper SAT like ELA IS NOW JS EBRW AND MATH ACT IS similar to paper.\n"
+    "- **Data-Driven Justification:** The `reason` for each task is critical. It MUST explicitly reference the student's personal data (e.g., 'This is important because you listed Geometry as a weakness...').\n\n"
+    "- **Math:** is the user is struggling in math the biggest thing to ensure is they know how to use desmos regression for the tricky constant questions. table regressiopn, tilde regression, and system of eqs regression and also normalizing the x values. This is like a starting point for math but get specific with other topics if they need specific practice.\n\n"
+    "## `practice_sprint` & `strategy_article` GENERATION (CRITICAL)\n"
+    "This format is ONLY for tasks that require the user to practice questions. When you create a `practice_sprint`, you MUST ALSO generate a corresponding `strategy_article`.\n"
+    "1.  **Hyper-Focused Sprint:** The `sprint_content` must contain exactly 5 SAT-level questions targeting a single, narrow skill (e.g., 'verb tense consistency' or 'solving systems of linear equations'). This skill must be chosen based on the student's weaknesses or incorrect answers.\n"
+    "2.  **Actionable Strategy Article:** The `strategy_article` must be a high-quality, concise guide (using Markdown) that teaches the student how to master the specific skill in the sprint.\n\n"
+    "## `quiz` GENERATION DIRECTIVES (CRITICAL)\n"
+    "A `quiz` is different from a sprint and is a tpe `quiz`. It is a CUMULATIVE review of a broader topic and should be used to test overall knowledge, not for focused practice.\n"
+    "1.  **Strategic Placement:** A quiz should ideally follow a 'Resource Task' (`link`).\n"
+    "2.  **SAT-Level Comprehensiveness:** Questions must mirror official SAT complexity, including reading passages, 'words in context', and multi-step math problems.\n"
+    "3.  **Targeted Content:** The quiz topic MUST address one of the student's listed weaknesses.\n"
+    "4.  **Detailed Explanations:** Every question must have an explanation.\n"
+    "5.  Each quiz should have 5-10 questions.\n\n"
+    "# CRITICAL DIRECTIVES & JSON SCHEMA\n"
+    "1.  **JSON Output ONLY**: Your output MUST be a single, raw JSON object.\n"
+    "2.  **Task Formats**: You must use a mix of `link`, `quiz`, `practice_sprint`, `strategy`, and `review` based on the logic in 'YOUR TASK'.\n"
+    "3.  **Data-Driven Justification**: The `reason` field is mandatory and must explain *why* the task is assigned, referencing the student's data.\n"
+    "4.  **Milestones & 'Boss Battles'**: Use 'milestone' for major assessments. 'Boss Battle' descriptions must start with 'Boss Battle:' they DO NOT have any practice sprints with them and they DO NOT habve a guide they SHOULD direct the user to take a test on one prep or bluebook.\n"
+    "5.  **Correct Stat Naming**: `stat_to_update` must be one of: ['sat_math', 'sat_ebrw', 'sat_total', 'act_math', 'act_reading', 'act_science', 'act_composite'].\n\n"
+    "6.  ** The tasks without any practice sprints should tell user to read or watch something and then summarize key strategies. The tasks with practice sprints should have a strategy article that teaches the skill being practiced. The quiz tasks should be cumulative and test a broader topic, not just one skill.\n\n"
+    "# JSON OUTPUT STRUCTURE\n"
+    "{\n"
+    '  "tasks": [\n'
+    '    {\n'
+    '      "task_format": "Can be \'link\', \'quiz\', \'strategy\', \'review\', or \'practice_sprint\'.",\n'
+    '      "description": "Hyper-specific instruction. For a sprint, describe the skill (e.g., \'Practice Sprint: Subject-Verb Agreement\'). MUST include markdown link if format is \'link\'.",\n'
+    '      "reason": "Mandatory, data-driven justification referencing the student\'s specific stats, weaknesses, or history.",\n'
+    '      "type": "Either \'standard\' or \'milestone\'.",\n'
+    '      "stat_to_update": "Valid stat name ONLY if type is milestone, otherwise null.",\n'
+    '      "category": "This MUST be the string \'Test Prep\'.",\n'
+    '      "difficulty": "Either \'easy\', \'medium\', \'hard\', or \'epic\'.",\n'
+    '      "quiz_content": {  // For \'quiz\' format ONLY. 5-10 questions. \n'
+    '          "title": "Title of the quiz",\n'
+    '          "questions": [ {"question_text": "...", "options": [], "correct_option": 0, "explanation": "..."} ]\n'
+    '      },\n'
+    '      "sprint_content": {  // REQUIRED if task_format is \'practice_sprint\', otherwise null.\n'
+    '          "title": "Title of the sprint (e.g., \'Algebra: Functions Practice\')",\n'
+    '          "questions": [ {"question_text": "...", "options": [], "correct_option": 0, "explanation": "..."} ] // EXACTLY 5 questions on ONE skill\n'
+    '      },\n'
+    '      "strategy_article": { // REQUIRED if task_format is \'practice_sprint\', otherwise null.\n'
+    '          "title": "Article Title (e.g., \'Strategies for Tackling Function Questions\')",\n'
+    '          "content": "Full article text in Markdown format. Explain key concepts and provide 2-3 actionable strategies."\n'
+    '      }\n'
+    '    }\n'
+    '  ]\n'
+    '}'
+)
+
+_TEST_PREP_TASKS_CONTEXT = Template(
+    "# STUDENT ANALYSIS DATA\n"
+    "- **Primary Test Focus:** $focus_desc\n"
+    "- Strengths: $strengths\n"
+    "- Weaknesses: $weaknesses <== **Base your tasks primarily on these specific weaknesses.**\n"
+    "- **Current Scores (Baseline):** $current_scores_str\n"
+    "- Desired Scores: $desired_scores_str\n"
+    "- Official Test Date: $test_date_info\n"
+    "- Estimated Weekly Study Time: $hours_per_week hours\n\n"
+    "## HISTORICAL & CONVERSATIONAL CONTEXT\n"
+    "- **Most Recent User Request:** '$latest_user_message'\n"
+    "- Recently Completed Tasks: $completed_tasks_str\n"
+    "- Incomplete Tasks from Previous Path: $incomplete_tasks_str\n"
+    "- Historical Performance Data (Tracker):\n$stat_history\n\n"
+    "## RECENT QUIZ PERFORMANCE (Incorrect Answers)\n"
+    "This shows specific questions the user recently got wrong on CUMULATIVE quizzes. Use this granular data to create targeted follow-up tasks.\n$quiz_results\n\n"
+    "## RECENT PRACTICE SPRINT PERFORMANCE (Incorrect Answers)\n"
+    "This shows specific questions the user recently got wrong on FOCUSED sprints. This is the most important data for identifying specific skill gaps.\n$sprint_results\n\n"
+)
+
+# Identity, app context and coaching rules are identical for every student
+_TEST_PREP_CHAT_PREFIX = (
+    "# MISSION & IDENTITY\n"
+    "You are an expert AI assistant for Mentics, a web app that creates personalized learning paths for high school students. Your specific persona is a highly adaptive, intelligent, and supportive SAT/ACT test prep coach. Your personality is encouraging yet focused, guiding students toward steady, measurable progress. You are a supplement to the main 'Path' feature, which visually lays out the student's learning journey.\n\n"
+    "# MENTICS APPLICATION CONTEXT\n"
+    "To answer user questions accurately, you must understand the app's key features:\n"
+    "- **AI Path Generation**: The core of Mentics. The app generates a visual, step-by-step roadmap of tasks for the student to follow for test prep and college planning.\n"
+    "- **AI Assistant (Your Role)**: You are the chat interface. You help users when they are stuck on a task, provide encouragement, and offer deeper explanations.\n"
+    "- **Stats & Tracker**: A dashboard where users input their scores (GPA, SAT, ACT) and track their progress over time with charts.\n"
+    "- **Gamification**: The app includes points and streaks for completing tasks to keep users motivated.\n"
+    "- **Forum & Leaderboard**: Social features where users can connect and compete.\n\n"
+    "## CORE COACHING DIRECTIVES (Your Rules of Engagement)\n"
+    "0.  **Initial Greeting**: Your very first message to the user *must* be a warm and encouraging welcome. It *must* also clearly state that they can type **'regenerate'** or **'new path'** at any time to get a new path based on your conversation.\n"
+    "1.  **Primary Goal: Path & App Support**: Your main purpose is to help the user with their current, active Path. Answer their questions about specific tasks, why they were assigned, and how to approach them. You must also be able to answer general questions about using the Mentics application's features as described above.\n"
+    "2.  **Path Regeneration Protocol**: If a user expresses that their goals have changed or they want a different approach, reiterate that they can use the regeneration commands.\n"
+    "3.  **Provide High-Quality Resources**: When a student is stuck or asks for help, provide specific, reputable, and free resources using markdown links (e.g., `[Khan Academy](https://...)`, official practice test PDFs, specific educational YouTube videos).\n"
+    "4.  **Actionable Focus**: Every response must provide a clear next step, a useful tip, or actionable guidance. Never leave the user wondering what to do next.\n"
+    "5.  **Adaptive Response Length**: \n"
+    "    - For quick questions, provide short, concise answers KEEP THESE UNDER 100 WORDS).\n"
+    "    - For complex requests (e.g., explaining a difficult concept), provide detailed, step-by-step explanations using lists or bullet points KEEP THESE UNDER 250 words.\n"
+    "6.  **Proactive and Strategic Guidance**: Offer actionable strategies, study tips, and relevant resources when a user expresses difficulty. Address their weaknesses directly but leverage their strengths to build confidence.\n"
+    "7.  **Mentorship Tone**: Always maintain a supportive, motivating, and realistic tone. Your goal is to empower the student and encourage consistent effort and progress."
+)
 
-def _get_test_prep_ai_tasks(strengths, weaknesses, test_focus, current_scores={}, desired_scores={}, test_date_str=None, hours_per_week=None, chat_history=[], path_history={}, stat_history="", quiz_results="", sprint_results=""):
+_TEST_PREP_CHAT_CONTEXT = Template(
+    "## CURRENT STUDENT ANALYSIS (CONTEXT FOR YOUR RESPONSE)\n"
+    "This is the specific student you are currently coaching:\n"
+    "- **Primary Test Focus:** $focus_desc\n"
+    "- Current SAT EBRW: $current_sat_ebrw, Current SAT Math: $current_sat_math\n"
+    "- Current ACT Composite: $current_act_comp\n"
+    "- Desired SAT: $desired_sat, Desired ACT: $desired_act\n"
+    "- Strengths: $strengths\n"
+    "- Weaknesses: $weaknesses\n"
+    "- Official Test Date Info: $test_date_info\n"
+    "- Estimated Weekly Study Time: $hours_per_week hours\n"
+    "- Historical Performance Data (from Tracker): $stat_history\n"
+    "- Current Active Tasks (numbered):\n$current_tasks\n\n"
+    "## RECENT QUIZ PERFORMANCE (Incorrect Answers)\n$quiz_results\n\n"
+    "## RECENT SPRINT PERFORMANCE (Incorrect Answers)\n$sprint_results\n\n"
+    "This shows specific questions the user recently got wrong. Use this granular data to mentor them in their path.\n\n"
+)
+
+# Role, scenario rules and JSON schema are identical for every student (see _get_prefix_cached_model)
+_COLLEGE_TASKS_PREFIX = (
+    "# MISSION\n"
+    "You are an expert AI college admissions counselor for the Mentics platform. Your mission is to generate an intelligent, 5-step roadmap that provides a clear, logical, and motivating path for a high school student. The plan must be a thoughtful continuation of their journey, not just a random list of tasks.\n\n"
+    "## CRITICAL SCENARIO ANALYSIS (ACTION REQUIRED)\n"
+    "First, determine the student's current situation and choose your generation strategy:\n"
+    "1.  **Regeneration Request:** If the most recent user message (see below) contains keywords like 'regenerate', 'new path', or expresses a significant change in plans (e.g., 'I want to apply to different schools now'), your **highest priority** is to generate a path that directly addresses that immediate request.\n"
+    "2.  **Post-Path Continuation:** If the student has just completed all tasks in their previous path, the new plan MUST be a logical next step in the college planning process (e.g., moving from 'researching colleges' to 'drafting supplemental essays'). It should feel like a natural progression.\n"
+    "3.  **Standard Generation:** If neither of the above applies, generate a standard path that is appropriate for their grade level and builds upon their historical data.\n\n"
+    "# YOUR TASK: GENERATE THE NEW 5-STEP ROADMAP\n"
+    "- **Synthesize, Don't Just List:** Your primary function is to connect the student's grade, goals, and history to create hyper-specific tasks. Generic tasks like 'Work on your essay' are forbidden.\n"
+    "- **Extreme Specificity & Actionable Verbs:** Descriptions must be granular and start with a strong verb (e.g., 'Draft', 'Research', 'Finalize'). Instead of 'Explore majors', generate 'Research the core curriculum for a Computer Science major at one of your target schools to see if it aligns with your interests.' (use the student's actual target colleges from the data below).\n"
+    "- **Incorporate Multiple Formats:** The plan must include a mix of task types. Include at least one **Resource Task** (e.g., 'Watch this guide on financial aid'), one **Action Task** (e.g., 'Draft your Common App activity list'), and one **Strategic/Review Task** (e.g., 'Analyze the supplemental essay prompts for your target schools and categorize them by theme').\n"
+    "- **Data-Driven Justification:** The `reason` for each task is critical. It MUST explicitly reference the student's personal data (grade, major, goals). For example: 'As an 11th grader interested in Biology, it is crucial to start identifying teachers for your recommendation letters now.'\n\n"
+    "# CRITICAL DIRECTIVES & JSON SCHEMA\n"
+    "1.  **JSON Output ONLY**: Your entire output MUST be a single, raw JSON object. No extra text.\n"
+    "2.  **New Task Formats**: You can now use `strategy` and `review` in the `task_format` field for tasks focused on planning or self-evaluation. These do not require a markdown link.\n"
+    "3.  **Data-Driven Justification**: The `reason` field is mandatory and must explain *why* this task is relevant to *this specific student* by referencing their data (e.g., '...because you're in 12th grade and application deadlines are approaching').\n"
+    "4.  **Meaningful Milestones & 'Boss Battles'**: Use 'milestone' for significant achievements (e.g., completing an essay draft, submitting an application). A 'Boss Battle' description must begin with 'Boss Battle:'.\n"
+    "5.  **Refer to Test Prep Path**: If test prep is relevant, do not create a task for it. Instead, create a task that instructs the user to work on their 'Test Prep Path' within the Mentics app.\n\n"
+    "# JSON OUTPUT STRUCTURE\n"
+    "{\n"
+    '  "tasks": [\n'
+    '    {\n'
+    '      "task_format": "Either \'link\', \'strategy\', or \'review\'.",\n'
+    '      "description": "Hyper-specific instruction. MUST include a markdown link if format is \'link\'.",\n'
+    '      "reason": "Mandatory, data-driven justification referencing the student\'s specific grade, goals, or history.",\n'
+    '      "type": "Either \'standard\' or \'milestone\'.",\n'
+    '      "stat_to_update": "A string (\'gpa\', \'essay_progress\', \'applications_submitted\') ONLY if type is milestone, otherwise null.",\n'
+    '      "category": "This MUST be the string \'College Planning\'.",\n'
+    '      "difficulty": "Either \'easy\', \'medium\', \'hard\', or \'epic\'."\n'
+    '    }\n'
+    '  ]\n'
+    '}'
+)
+
+_COLLEGE_TASKS_CONTEXT = Template(
+    "# STUDENT ANALYSIS DATA\n"
+    "- Current Grade: $grade\n"
+    "- Stated Planning Stage: $planning_stage\n"
+    "- Interested Majors: $majors\n"
+    "- Target Colleges: $target_colleges\n"
+    "- Current GPA: $gpa\n\n"
+    "## HISTORICAL & CONVERSATIONAL CONTEXT\n"
+    "This is CRITICAL for creating an intelligent, continuous learning journey.\n"
+    "- **Most Recent User Request:** '$latest_user_message' <== **If this is a regeneration request, it takes precedence over all other data.**\n"
+    "- Recently Completed Tasks: $completed_tasks_str\n"
+    "- Incomplete Tasks from Previous Path: $incomplete_tasks_str\n"
+    "- Full Conversation History: $chat_history_str\n"
+    "- Historical Performance Data (Tracker):\n$stat_history\n\n"
+)
+
+_COLLEGE_CHAT_PREFIX = (
+    "# MISSION & IDENTITY\n"
+    "You are an expert AI assistant for Mentics, a web app that creates personalized roadmaps for high school students. Your specific persona is a friendly, intelligent, and highly adaptive college planning advisor. Your personality is encouraging, knowledgeable, and supportive. You are a supplement to the main 'Path' feature, which visually lays out the student's journey.\n\n"
+    "# MENTICS APPLICATION CONTEXT\n"
+    "To answer user questions accurately, you must understand the app's key features:\n"
+    "- **AI Path Generation**: The core of Mentics. The app generates a visual, step-by-step roadmap of tasks for the student to follow for college applications, essays, IT IS ALSO IS A RESOURCE FOR SAT/ACT PREP WITH THE TEST PREP PATH sugest the user use this for their SAT/ ACT planning(THIS CAN BE FOUND ON THE DASHBOARD).\n"
+    "- **AI Assistant (Your Role)**: You are the chat interface. You help users when they are stuck on a task, provide encouragement, and offer deeper explanations.\n"
+    "- **Stats & Tracker**: A dashboard where users input their scores (GPA, SAT, ACT) and track their progress over time with charts.\n"
+    "- **Gamification**: The app includes points and streaks for completing tasks to keep users motivated.\n"
+    "- **Forum & Leaderboard**: Social features where users can connect and compete.\n\n"
+    "## CORE COACHING DIRECTIVES (Your Rules of Engagement)\n"
+    "0.  **Initial Greeting**: Your very first message to the user *must* be a warm and encouraging welcome. It *must* also clearly state that they can type **'regenerate'** or **'new path'** at any time to get a new path based on your conversation.\n"
+    "1.  **Primary Goal: Path & App Support**: Your main purpose is to help the user with their current, active Path. Answer their questions about specific tasks, why they were assigned, and how to approach them. You must also be able to answer general questions about using the Mentics application's features as described above.\n"
+    "2.  **Path Regeneration Protocol**: If a user expresses that their goals have changed or they want a different approach, reiterate that they can use the regeneration commands.\n"
+    "3.  **Provide High-Quality Resources**: When a student is stuck or needs guidance, provide specific, reputable, and free resources using markdown links (e.g., links to the Common App, financial aid websites like FAFSA, or helpful articles on essay writing).\n"
+    "4.  **Actionable Guidance**: Every response must give the student a clear next step, a valuable resource, or a concrete action to take. Never leave the user wondering what to do next.\n"
+    "5.  **Adaptive Response Length**:\n"
+    "    - For simple questions, provide short, concise answers KEEP THESE UNDER 100 WORDS.\n"
+    "    - For complex requests (e.g., essay brainstorming, advice on choosing colleges), provide detailed, structured responses using lists or bullet points KEEP THESE UNDER 250 WORDS.\n"
+    "6.  **Proactive Advising**: If the student seems stuck on a task like 'write an essay', break it down into smaller, actionable steps (e.g., 'Let's start by brainstorming three key experiences you could write about.').\n"
+    "7.  **Mentorship Tone**: Always maintain a supportive, encouraging, and realistic tone to keep the student motivated throughout the often-stressful college application process.\n"
+    "8. **Suggest Test Prep Path When Relevant**: If the student mentions standardized tests (SAT/ACT) or seems uncertain about test preparation, proactively suggest they explore the MENTICS Test Prep path for tailored study plans and resources.\n"
+)
+
+_COLLEGE_CHAT_CONTEXT = Template(
+    "## CURRENT STUDENT ANALYSIS\n"
+    "This is the specific student you are currently advising:\n"
+    "- SAT Math: $sat_math\n"
+    "- SAT EBRW: $sat_ebrw\n"
+    "- ACT Math: $act_math\n"
+    "- ACT Reading: $act_reading\n"
+    "- ACT Science: $act_science\n"
+    "- GPA: $gpa\n"
+    "- Grade Level: $grade\n"
+    "- Current Planning Stage: '$planning_stage'\n"
+    "- Interested Majors: $majors\n"
+    "- Target Colleges: $target_colleges\n"
+    "- Recently Completed Tasks: $completed_tasks\n"
+    "- Incomplete/Failed Tasks: $incomplete_tasks\n"
+    "- Historical Performance Data (from Tracker): $stat_history\n"
+    "- Current Active Tasks (numbered for reference):\n$current_tasks\n\n"
+)
+
+
+def _get_test_prep_ai_tasks(strengths, weaknesses, test_focus, current_scores={}, desired_scores={}, test_date_str=None, hours_per_week=None, chat_history=[], path_history={}, stat_history="", quiz_results="", sprint_results="", user_id=None, regenerate=False):
     """Generates hyper-intelligent, adaptive test prep tasks, now including interactive Practice Sprints, Strategy Articles, and better context."""
 
     def get_mock_tasks_reliably():
         """A fallback function to provide tasks if the AI service is unavailable."""
-        print("--- DEBUG: Running fallback mock task generator for Test Prep. ---")
+        logger.debug("Running fallback mock task generator for %s", "Test Prep")
         # (Keep the fallback content the same as before)
-        return [
-            {"task_format": "link", "description": "Take a full-length, timed SAT practice test from the [official College Board site](https://satsuite.collegeboard.org/sat/practice-preparation/practice-tests).",
-             "reason": "This is a 'boss battle' to test your skills under pressure.", "type": "milestone", "stat_to_update": "sat_total", "category": "Test Prep", "difficulty": "hard"},
-            {"task_format": "link", "description": "Review algebra concepts using [Khan Academy](https://www.khanacademy.org/math/algebra).",
-             "reason": "A strong algebra foundation is crucial.", "type": "standard", "stat_to_update": None, "category": "Test Prep", "difficulty": "medium"},
-            {"task_format": "link", "description": "Practice time management for the reading section.", "reason": "Pacing is key to finishing on time.",
-                "type": "standard", "stat_to_update": None, "category": "Test Prep", "difficulty": "medium"}
-        ]
+        return [dict(task) for task in _MOCK_TEST_PREP_TASKS]
 
     if not os.getenv("GEMINI_API_KEY"):
         return get_mock_tasks_reliably()
 
-    completed_tasks_str = "\n".join(
-        [f"- {task['description']}" for task in path_history.get('completed', [])]) or "None."
-    incomplete_tasks_str = "\n".join(
-        [f"- {task['description']}" for task in path_history.get('incomplete', [])]) or "None."
+    completed_tasks_str = _format_task_bullets(path_history.get('completed'))
+    incomplete_tasks_str = _format_task_bullets(path_history.get('incomplete'))
     latest_user_message = next((msg['content'] for msg in reversed(
         chat_history) if msg['role'] == 'user'), "N/A")
 
@@ -419,15 +1216,13 @@ def _get_test_prep_ai_tasks(strengths, weaknesses, test_focus, current_scores={}
     test_date_info = "Not set."
     if test_date_str:
         try:
-            user_tz = ZoneInfo(session.get('timezone', 'UTC'))
-            test_date = datetime.strptime(test_date_str, '%Y-%m-%d').date()
-            delta = test_date - datetime.now(user_tz).date()
-            formatted_date = test_date.strftime('%B %d, %Y')
-            if delta.days >= 0:
-                test_date_info = f"on {formatted_date} ({delta.days} days remaining)"
+            formatted_date, days_left = _test_date_delta(
+                test_date_str, _request_tz())
+            if days_left >= 0:
+                test_date_info = f"on {formatted_date} ({days_left} days remaining)"
             else:
                 test_date_info = f"on {formatted_date} (this date has passed)"
-        except (ValueError, ZoneInfoNotFoundError):
+        except ValueError:
             test_date_info = "Invalid date format."
 
     # --- Format Current Scores for Prompt ---
@@ -471,125 +1266,54 @@ def _get_test_prep_ai_tasks(strengths, weaknesses, test_focus, current_scores={}
     elif test_focus == 'both':
         focus_desc = "both SAT and ACT"
 
-    prompt = (
-        f"# MISSION\n"
-        f"You are an elite AI test prep coach for Mentics. Your mission is to generate an intelligent, 5-step study plan tailored to the student's evolving needs, demonstrating a deep understanding of their history and context SPECIFICALY FOR THE DIGITAL SAT AND THE ACT.\n\n"
-
-        f"## CRITICAL SCENARIO ANALYSIS\n"
-        f"1.  **Regeneration Request:** If the user's latest message asks for a new path, your highest priority is to generate one that addresses their immediate request.\n"
-        f"2.  **Post-Path Continuation:** If the student just completed all tasks, the new plan MUST be a logical next step (e.g., analyzing scores, planning long-term improvements).\n"
-        f"3.  **Standard Generation:** Otherwise, generate a standard path that builds on their history.\n\n"
-
-        f"# STUDENT ANALYSIS DATA\n"
-        f"- **Primary Test Focus:** {focus_desc}\n"  # NEW
-        f"- Strengths: {strengths}\n"
-        f"- Weaknesses: {weaknesses} <== **Base your tasks primarily on these specific weaknesses.**\n"
-        f"- **Current Scores (Baseline):** {current_scores_str}\n"  # NEW
-        f"- Desired Scores: {desired_scores_str}\n"  # Updated
-        f"- Official Test Date: {test_date_info}\n"  # Updated
-        # NEW
-        f"- Estimated Weekly Study Time: {hours_per_week or 'Not specified'} hours\n\n"
-
-        f"## HISTORICAL & CONVERSATIONAL CONTEXT\n"
-        f"- **Most Recent User Request:** '{latest_user_message}'\n"
-        f"- Recently Completed Tasks: {completed_tasks_str}\n"
-        f"- Incomplete Tasks from Previous Path: {incomplete_tasks_str}\n"
-        f"- Historical Performance Data (Tracker):\n{stat_history}\n\n"
-
-        f"## RECENT QUIZ PERFORMANCE (Incorrect Answers)\n"
-        f"This shows specific questions the user recently got wrong on CUMULATIVE quizzes. Use this granular data to create targeted follow-up tasks.\n{quiz_results}\n\n"
-
-        f"## RECENT PRACTICE SPRINT PERFORMANCE (Incorrect Answers)\n"
-        f"This shows specific questions the user recently got wrong on FOCUSED sprints. This is the most important data for identifying specific skill gaps.\n{sprint_results}\n\n"
-
-        f"# YOUR TASK: GENERATE THE NEW 5-STEP PLAN(for {focus_desc.upper()})\n"
-        f"- **Focus on {focus_desc.upper()}:** All content, examples, and resources MUST be relevant to the chosen test format(s).\n"
-        f"- **Task Format Logic (Crucial!):** You must differentiate between passive learning and active practice. \n"
-        f"  - If a task involves **actively solving problems or answering questions or mastering a math concept or advancing/consolidating knowlege **, it MUST be a `practice_sprint`.\n"
-        f"  - If a task involves **reading articles, or watching content on yt or using external resources**, it MUST be a `link`, `strategy`, or `review` task.\n"
-        f"- **Synthesize, Don't Just List:** Your primary function is to connect multiple data points to create hyper-specific tasks. Generic tasks like 'Practice Algebra' are forbidden.\n"
-        f"- **Extreme Specificity & Actionable Verbs:** Descriptions must be granular and start with a strong verb (e.g., 'Master', 'Analyze', 'Implement').\n"
-        f"- **Incorporate Multiple Formats:** The plan must include a mix of task types, including at least one `practice_sprint`.\n"
-        f"- ** DIGITAL SAT & ACT FOCUS:** All tasks must be relevant to the unique formats and content of the Digital SAT and ACT, do not include thigns that were on the Paper SAT like ELA IS NOW JS EBRW AND MATH ACT IS similar to paper.\n"
-        f"- **Data-Driven Justification:** The `reason` for each task is critical. It MUST explicitly reference the student's personal data (e.g., 'This is important because you listed Geometry as a weakness...').\n\n"
-        f"- **Math:** is the user is struggling in math the biggest thing to ensure is they know how to use desmos regression for the tricky constant questions. table regressiopn, tilde regression, and system of eqs regression and also normalizing the x values. This is like a starting point for math but get specific with other topics if they need specific practice.\n\n"
-
-        f"## `practice_sprint` & `strategy_article` GENERATION (CRITICAL)\n"
-        f"This format is ONLY for tasks that require the user to practice questions. When you create a `practice_sprint`, you MUST ALSO generate a corresponding `strategy_article`.\n"
-        f"1.  **Hyper-Focused Sprint:** The `sprint_content` must contain exactly 5 SAT-level questions targeting a single, narrow skill (e.g., 'verb tense consistency' or 'solving systems of linear equations'). This skill must be chosen based on the student's weaknesses or incorrect answers.\n"
-        f"2.  **Actionable Strategy Article:** The `strategy_article` must be a high-quality, concise guide (using Markdown) that teaches the student how to master the specific skill in the sprint.\n\n"
-
-        f"## `quiz` GENERATION DIRECTIVES (CRITICAL)\n"
-        f"A `quiz` is different from a sprint and is a tpe `quiz`. It is a CUMULATIVE review of a broader topic and should be used to test overall knowledge, not for focused practice.\n"
-        f"1.  **Strategic Placement:** A quiz should ideally follow a 'Resource Task' (`link`).\n"
-        f"2.  **SAT-Level Comprehensiveness:** Questions must mirror official SAT complexity, including reading passages, 'words in context', and multi-step math problems.\n"
-        f"3.  **Targeted Content:** The quiz topic MUST address one of the student's listed weaknesses.\n"
-        f"4.  **Detailed Explanations:** Every question must have an explanation.\n"
-        f"5.  Each quiz should have 5-10 questions.\n\n"
-
-        f"# CRITICAL DIRECTIVES & JSON SCHEMA\n"
-        f"1.  **JSON Output ONLY**: Your output MUST be a single, raw JSON object.\n"
-        f"2.  **Task Formats**: You must use a mix of `link`, `quiz`, `practice_sprint`, `strategy`, and `review` based on the logic in 'YOUR TASK'.\n"
-        f"3.  **Data-Driven Justification**: The `reason` field is mandatory and must explain *why* the task is assigned, referencing the student's data.\n"
-        f"4.  **Milestones & 'Boss Battles'**: Use 'milestone' for major assessments. 'Boss Battle' descriptions must start with 'Boss Battle:' they DO NOT have any practice sprints with them and they DO NOT habve a guide they SHOULD direct the user to take a test on one prep or bluebook.\n"
-        f"5.  **Correct Stat Naming**: `stat_to_update` must be one of: ['sat_math', 'sat_ebrw', 'sat_total', 'act_math', 'act_reading', 'act_science', 'act_composite'].\n\n"
-        f"6.  ** The tasks without any practice sprints should tell user to read or watch something and then summarize key strategies. The tasks with practice sprints should have a strategy article that teaches the skill being practiced. The quiz tasks should be cumulative and test a broader topic, not just one skill.\n\n"
-
-        f"# JSON OUTPUT STRUCTURE\n"
-        f"{{\n"
-        f'  "tasks": [\n'
-        f'    {{\n'
-        f'      "task_format": "Can be \'link\', \'quiz\', \'strategy\', \'review\', or \'practice_sprint\'.",\n'
-        f'      "description": "Hyper-specific instruction. For a sprint, describe the skill (e.g., \'Practice Sprint: Subject-Verb Agreement\'). MUST include markdown link if format is \'link\'.",\n'
-        f'      "reason": "Mandatory, data-driven justification referencing the student\'s specific stats, weaknesses, or history.",\n'
-        f'      "type": "Either \'standard\' or \'milestone\'.",\n'
-        f'      "stat_to_update": "Valid stat name ONLY if type is milestone, otherwise null.",\n'
-        f'      "category": "This MUST be the string \'Test Prep\'.",\n'
-        f'      "difficulty": "Either \'easy\', \'medium\', \'hard\', or \'epic\'.",\n'
-        f'      "quiz_content": {{  // For \'quiz\' format ONLY. 5-10 questions. \n'
-        f'          "title": "Title of the quiz",\n'
-        f'          "questions": [ {{"question_text": "...", "options": [], "correct_option": 0, "explanation": "..."}} ]\n'
-        f'      }},\n'
-        f'      "sprint_content": {{  // REQUIRED if task_format is \'practice_sprint\', otherwise null.\n'
-        f'          "title": "Title of the sprint (e.g., \'Algebra: Functions Practice\')",\n'
-        f'          "questions": [ {{"question_text": "...", "options": [], "correct_option": 0, "explanation": "..."}} ] // EXACTLY 5 questions on ONE skill\n'
-        f'      }},\n'
-        f'      "strategy_article": {{ // REQUIRED if task_format is \'practice_sprint\', otherwise null.\n'
-        f'          "title": "Article Title (e.g., \'Strategies for Tackling Function Questions\')",\n'
-        f'          "content": "Full article text in Markdown format. Explain key concepts and provide 2-3 actionable strategies."\n'
-        f'      }}\n'
-        f'    }}\n'
-        f'  ]\n'
-        f'}}'
-    )
+    static_prefix = _TEST_PREP_TASKS_PREFIX.substitute(
+        focus_upper=focus_desc.upper())
+    dynamic_suffix = _TEST_PREP_TASKS_CONTEXT.substitute(
+        focus_desc=focus_desc, strengths=strengths, weaknesses=weaknesses,
+        current_scores_str=current_scores_str, desired_scores_str=desired_scores_str,
+        test_date_info=test_date_info,
+        hours_per_week=hours_per_week or 'Not specified',
+        latest_user_message=latest_user_message,
+        completed_tasks_str=completed_tasks_str,
+        incomplete_tasks_str=incomplete_tasks_str, stat_history=stat_history,
+        quiz_results=quiz_results, sprint_results=sprint_results)
+    prompt = static_prefix + "\n\n" + dynamic_suffix
+    # Semantic cache hits are only ever shared between generations for the same user, and only
+    # the student-specific suffix is embedded. v2 keeps rows embedded from the whole prompt out.
+    cache_namespace = f"test_prep_tasks:v2:{user_id}" if user_id is not None else None
     try:
-        model = genai.GenerativeModel(
-            'gemini-2.5-flash',  # Using 2.5-flash as it's generally good with JSON
-            generation_config={"response_mime_type": "application/json"}
-        )
-        response = model.generate_content(prompt)
-
         response_data = None
-        raw_text = None
-
-        # Try to access the text content reliably
-        try:
-            # The structure might vary slightly depending on the exact Gemini library version
-            if hasattr(response, 'text'):
-                raw_text = response.text
-            elif hasattr(response, 'parts') and response.parts:
-                # Handle potential streaming or multi-part responses if applicable
-                raw_text = "".join(
-                    part.text for part in response.parts if hasattr(part, 'text'))
-            elif hasattr(response, 'content') and hasattr(response.content, 'parts') and response.content.parts:
-                raw_text = "".join(
-                    part.text for part in response.content.parts if hasattr(part, 'text'))
-            else:
-                # Fallback to string representation if unsure
-                raw_text = str(response)
-        except Exception as e:
-            print(f"--- Error accessing Gemini response text: {e} ---")
-            raw_text = str(response)  # Fallback again
+        # An explicit regenerate skips the semantic match: it would likely hand back a path
+        # close to the one the student just asked to replace
+        raw_text, cache_embedding = llm_cache.lookup(
+            prompt, cache_namespace, dynamic_suffix, semantic=not regenerate)
+        is_cache_hit = raw_text is not None
+
+        if not is_cache_hit:
+            # Using 2.5-flash as it's generally good with JSON
+            model = _get_prefix_cached_model(
+                static_prefix, generation_config=_JSON_GENERATION_CONFIG)
+            response = model.generate_content(dynamic_suffix)
+            _log_cached_token_usage("Test prep path tokens", response)
+
+            # Try to access the text content reliably
+            try:
+                # The structure might vary slightly depending on the exact Gemini library version
+                if hasattr(response, 'text'):
+                    raw_text = response.text
+                elif hasattr(response, 'parts') and response.parts:
+                    # Handle potential streaming or multi-part responses if applicable
+                    raw_text = "".join(
+                        part.text for part in response.parts if hasattr(part, 'text'))
+                elif hasattr(response, 'content') and hasattr(response.content, 'parts') and response.content.parts:
+                    raw_text = "".join(
+                        part.text for part in response.content.parts if hasattr(part, 'text'))
+                else:
+                    # Fallback to string representation if unsure
+                    raw_text = str(response)
+            except Exception as e:
+                logger.warning("Error accessing Gemini response text: %s", e)
+                raw_text = str(response)  # Fallback again
 
         if not raw_text:
             raise ValueError(
@@ -605,19 +1329,19 @@ def _get_test_prep_ai_tasks(strengths, weaknesses, test_focus, current_scores={}
         # Attempt to parse the cleaned text
         try:
             # Attempt direct parsing first, as the mime_type should ensure it's JSON
-            response_data = json.loads(cleaned_text)
+            response_data = json_loads(cleaned_text)
         except json.JSONDecodeError as direct_e:
             # If direct parsing fails, try extracting the JSON part (more robust fallback)
-            print(
-                f"--- Direct JSON parsing failed: {direct_e}. Attempting extraction... ---")
+            logger.warning(
+                "Direct JSON parsing failed: %s. Attempting extraction...", direct_e)
             # Look for the outermost '{...}' or '[...]' structure
             match = re.search(
                 r'^\s*(\{.*\}|\[.*\])\s*$', cleaned_text, re.DOTALL)
             if match:
                 json_candidate = match.group(1)
                 try:
-                    response_data = json.loads(json_candidate)
-                    print("--- Successfully parsed extracted JSON. ---")
+                    response_data = json_loads(json_candidate)
+                    logger.debug("Successfully parsed extracted JSON.")
                 except json.JSONDecodeError as extract_e:
                     # If even extraction fails, raise the original error with context
                     raise ValueError(
@@ -726,29 +1450,32 @@ def _get_test_prep_ai_tasks(strengths, weaknesses, test_focus, current_scores={}
                         t['stat_to_update'] = None
                 normalized.append(t)
             except Exception as norm_e:
-                print(
-                    f"--- Error normalizing task: {norm_e} --- Task data: {t}")
+                logger.warning(
+                    "Error normalizing task: %s. Task data: %s", norm_e, t)
                 continue  # Skip problematic task
 
         if isinstance(normalized, list) and len(normalized) > 0:
+            # Only cache responses that actually produced a usable path
+            if not is_cache_hit:
+                llm_cache.put(prompt, raw_text, namespace=cache_namespace,
+                              embedding=cache_embedding)
             return normalized
         elif isinstance(normalized, list) and len(normalized) == 0 and tasks:
-            print("--- WARNING: Normalization removed all tasks. Falling back. ---")
+            logger.warning("Normalization removed all tasks. Falling back.")
             return get_mock_tasks_reliably()  # Fallback if normalization failed badly
         else:  # tasks might not have been a list or was empty
             raise ValueError(
                 "AI response did not contain a valid 'tasks' list or normalization produced no tasks")
 
     # --- ***** END OF CORRECTED PARSING LOGIC ***** ---
-    except Exception as e:
+    except Exception:
         # General catch-all for API errors or unexpected issues
-        print(
-            f"\n--- GEMINI API OR PROCESSING ERROR IN _get_test_prep_ai_tasks: {e} ---\n")
+        logger.exception("Gemini API or processing error in %s", "_get_test_prep_ai_tasks")
         # Ensure raw_text is defined for logging, even if extraction failed earlier
         if 'raw_text' not in locals():
             raw_text = "Raw text extraction failed."
-        print(
-            f"--- Raw Response (if available, first 500 chars): {str(raw_text)[:500]} ---")
+        logger.warning(
+            "Raw response (if available, first 500 chars): %.500s", raw_text)
         return get_mock_tasks_reliably()
 
 
@@ -768,6 +1495,26 @@ def strategy_article(user, task_id):
     return render_template("strategy_article.html", article=article)
 
 
+def _question_set_response(title, table_name, parent_column, parent_id):
+    """
+    JSON response with a quiz/sprint title and its questions. SQLite assembles the
+    questions array itself and json() passes each stored options list through as-is,
+    so the options are never decoded and re-encoded in Python.
+    """
+    row = db.execute_for_one(f"""
+        SELECT json_group_array(json_object(
+            'id', id,
+            'question_text', question_text,
+            'options', json(options),
+            'correct_option', correct_option,
+            'explanation', explanation
+        )) AS questions
+        FROM (SELECT * FROM {table_name} WHERE {parent_column}=? ORDER BY id)
+    """, (parent_id,))
+    payload = f'{{"title": {json_dumps(title)}, "questions": {row["questions"]}}}'
+    return Response(payload, mimetype='application/json')
+
+
 @app.route('/api/practice_sprint/<int:task_id>')
 @login_required
 def get_practice_sprint(user, task_id):
@@ -781,17 +1528,8 @@ def get_practice_sprint(user, task_id):
     if not sprint_details:
         return jsonify({"error": "Sprint details not found"}), 404
 
-    questions_raw = db.select("sprint_questions", where={
-                              "sprint_id": sprint_details['id']})
-    questions = [{
-        "id": q['id'],
-        "question_text": q['question_text'],
-        "options": json.loads(q['options']),
-        "correct_option": q['correct_option'],
-        "explanation": q['explanation']
-    } for q in questions_raw]
-
-    return jsonify({"title": sprint_details['title'], "questions": questions})
+    return _question_set_response(
+        sprint_details['title'], "sprint_questions", "sprint_id", sprint_details['id'])
 
 
 @app.route('/api/submit_sprint_results', methods=['POST'])
@@ -804,23 +1542,17 @@ def submit_sprint_results(user):
         return jsonify({"success": False, "error": "Invalid results format"}), 400
 
     user_id = user.data['id']
-    for result in results:
-        if 'question_id' in result and 'is_correct' in result:
-            db.insert('sprint_results', {
-                'user_id': user_id,
-                'question_id': result.get('question_id'),
-                'is_correct': result.get('is_correct')
-            })
+    db.insert_many('sprint_results', [{
+        'user_id': user_id,
+        'question_id': result.get('question_id'),
+        'is_correct': result.get('is_correct')
+    } for result in results if 'question_id' in result and 'is_correct' in result])
     return jsonify({"success": True})
 
 
 # In app.py, REPLACE the entire _generate_and_save_new_test_path function
 
-def _generate_and_save_new_test_path(user_id, test_path_info, chat_history=[]):
-    user_record = db.select_one("users", where={"id": user_id})
-    user_stats = json.loads(user_record['stats']) if user_record else {
-    }  # Load main stats like GPA
-
+def _generate_and_save_new_test_path(user_id, test_path_info, chat_history=[], regenerate=False):
     # Extract info from test_path_info (which now contains more fields)
     strengths = test_path_info.get("strengths", "")
     weaknesses = test_path_info.get("weaknesses", "")
@@ -843,23 +1575,15 @@ def _generate_and_save_new_test_path(user_id, test_path_info, chat_history=[]):
         "desired_act": test_path_info.get("desired_act"),
     }
 
-    # (Path history fetching remains the same)
-    all_tasks = db.select(
-        "paths", where={"user_id": user_id, "category": "Test Prep"})
-    path_history = {
-        "completed": [t for t in all_tasks if t['is_completed']],
-        "incomplete": [t for t in all_tasks if not t['is_completed']]
-    }
-
-    # (Context data fetching remains the same)
-    stat_history = _get_stat_history_for_prompt(user_id)
-    quiz_results = _get_quiz_results_for_prompt(user_id)
-    sprint_results = _get_sprint_results_for_prompt(
-        user_id)  # Ensure this line exists
-
-    # Deactivate old path
-    db.update("paths", {"is_active": False}, where={
-              "user_id": user_id, "category": "Test Prep", "is_active": True})
+    # User stats, path history, stat history and missed quiz/sprint answers in one round-trip
+    context = _get_path_generation_context(
+        user_id, "Test Prep", include_missed_answers=True) or {
+        "path_history": {"completed": [], "incomplete": []}, "stat_history": [],
+        "quiz_results": _NO_MISSED_QUIZ_ANSWERS, "sprint_results": _NO_MISSED_SPRINT_ANSWERS}
+    path_history = context["path_history"]
+    stat_history = _format_stat_history(context["stat_history"])
+    quiz_results = context["quiz_results"]
+    sprint_results = context["sprint_results"]
 
     # ***** UPDATED CALL *****
     tasks = _get_test_prep_ai_tasks(
@@ -874,53 +1598,100 @@ def _generate_and_save_new_test_path(user_id, test_path_info, chat_history=[]):
         path_history=path_history,
         stat_history=stat_history,
         quiz_results=quiz_results,
-        sprint_results=sprint_results
+        sprint_results=sprint_results,
+        user_id=user_id,
+        regenerate=regenerate
     )
     # ***** END UPDATED CALL *****
 
     tasks = tasks[:5]  # Limit to 5 tasks
 
-    # (Saving tasks logic remains the same, including quizzes, sprints, articles)
-    saved_tasks = []
-    for i, task in enumerate(tasks):
-        task_format = task.get("task_format", "link")
-        task_id = db.insert("paths", {
-            "user_id": user_id, "task_order": i + 1, "description": task.get("description"),
-            "reason": task.get("reason"), "type": task.get("type"), "stat_to_update": task.get("stat_to_update"),
-            "category": "Test Prep", "is_active": True, "is_completed": False, "task_format": task_format
-        })
+    # Deactivating the old path and saving the new one commit together, and only after the
+    # AI call has returned, so no write lock is held while waiting on Gemini
+    with db.transaction():
+        saved_tasks = _save_test_path_tasks(user_id, tasks)
+        log_activity(user_id, 'path_generated', {'category': 'Test Prep'})
+    return saved_tasks
 
-        if task_format == 'quiz' and task.get('quiz_content'):
-            quiz_id = db.insert("quizzes", {
-                                "task_id": task_id, "title": task['quiz_content'].get("title", "Quiz")})
-            for q in task['quiz_content'].get("questions", []):
-                db.insert("quiz_questions", {"quiz_id": quiz_id, "question_text": q.get("question_text"), "options": json.dumps(
-                    q.get("options")), "correct_option": q.get("correct_option"), "explanation": q.get("explanation")})
-            db.update("paths", {"task_content_id": quiz_id},
-                      where={"id": task_id})
 
+def _save_test_path_tasks(user_id, tasks):
+    """
+    Saves a generated test prep path with one batched insert per table.
+    Run it inside db.transaction() so deactivating the old path and inserting
+    the new one commit together.
+    """
+    # Deactivate old path
+    db.update("paths", {"is_active": False}, where={
+              "user_id": user_id, "category": "Test Prep", "is_active": True})
+    _forget_current_numbered_tasks()
+
+    path_rows = [{
+        "user_id": user_id, "task_order": i + 1, "description": task.get("description"),
+        "reason": task.get("reason"), "type": task.get("type"), "stat_to_update": task.get("stat_to_update"),
+        "category": "Test Prep", "is_active": True, "is_completed": False, "task_format": task.get("task_format", "link")
+    } for i, task in enumerate(tasks)]
+    task_ids = db.insert_many("paths", path_rows)
+
+    quiz_tasks, sprint_tasks = [], []
+    for task_id, task in zip(task_ids, tasks):
+        task_format = task.get("task_format", "link")
+        if task_format == 'quiz' and task.get('quiz_content'):
+            quiz_tasks.append((task_id, task))
         elif task_format == 'practice_sprint' and task.get('sprint_content') and task.get('strategy_article'):
-            sprint_id = db.insert("practice_sprints", {
-                                  "task_id": task_id, "title": task['sprint_content'].get("title", "Practice Sprint")})
-            for q in task['sprint_content'].get("questions", []):
-                db.insert("sprint_questions", {"sprint_id": sprint_id, "question_text": q.get("question_text"), "options": json.dumps(
-                    q.get("options")), "correct_option": q.get("correct_option"), "explanation": q.get("explanation")})
-            article_id = db.insert("strategy_articles", {"task_id": task_id, "title": task['strategy_article'].get(
-                "title"), "content": task['strategy_article'].get("content")})
-            db.update("paths", {"task_content_id": sprint_id,
-                      "secondary_content_id": article_id}, where={"id": task_id})
-
-        new_task_data = db.select_one("paths", where={"id": task_id})
-        saved_tasks.append({**new_task_data, "is_completed": False})
-
-    log_activity(user_id, 'path_generated', {'category': 'Test Prep'})
+            sprint_tasks.append((task_id, task))
+
+    def question_rows(parent_col, parent_ids, content_key, owners):
+        return [{parent_col: parent_id, "question_text": q.get("question_text"), "options": json_dumps(
+            q.get("options")), "correct_option": q.get("correct_option"), "explanation": q.get("explanation")}
+            for parent_id, (_, task) in zip(parent_ids, owners)
+            for q in task[content_key].get("questions", [])]
+
+    content_updates = []
+    if quiz_tasks:
+        quiz_ids = db.insert_many("quizzes", [
+            {"task_id": task_id, "title": task['quiz_content'].get("title", "Quiz")} for task_id, task in quiz_tasks])
+        db.insert_many("quiz_questions", question_rows(
+            "quiz_id", quiz_ids, 'quiz_content', quiz_tasks))
+        content_updates += [(quiz_id, None, task_id)
+                            for quiz_id, (task_id, _) in zip(quiz_ids, quiz_tasks)]
+
+    if sprint_tasks:
+        sprint_ids = db.insert_many("practice_sprints", [
+            {"task_id": task_id, "title": task['sprint_content'].get("title", "Practice Sprint")} for task_id, task in sprint_tasks])
+        db.insert_many("sprint_questions", question_rows(
+            "sprint_id", sprint_ids, 'sprint_content', sprint_tasks))
+        article_ids = db.insert_many("strategy_articles", [
+            {"task_id": task_id, "title": task['strategy_article'].get("title"), "content": task['strategy_article'].get("content")}
+            for task_id, task in sprint_tasks])
+        content_updates += [(sprint_id, article_id, task_id)
+                            for sprint_id, article_id, (task_id, _) in zip(sprint_ids, article_ids, sprint_tasks)]
+
+    if content_updates:
+        db.executemany(
+            "UPDATE paths SET task_content_id=?, secondary_content_id=? WHERE id=?", content_updates)
+
+    # Build the saved rows from what we just wrote instead of reading them back
+    content_ids = {task_id: (content_id, secondary_id)
+                   for content_id, secondary_id, task_id in content_updates}
+    saved_tasks = []
+    for task_id, row in zip(task_ids, path_rows):
+        content_id, secondary_id = content_ids.get(task_id, (None, None))
+        saved_tasks.append({**row, "id": task_id, "task_content_id": content_id,
+                            "secondary_content_id": secondary_id})
     return saved_tasks
 
 
 # Added sprint_results parameter
 def _get_test_prep_ai_chat_response(history, user_stats, stat_history="", quiz_results="", sprint_results="", user_id=None):
+    return "".join(_stream_test_prep_ai_chat_response(
+        history, user_stats, stat_history, quiz_results, sprint_results, user_id))
+
+
+def _stream_test_prep_ai_chat_response(history, user_stats, stat_history="", quiz_results="", sprint_results="", user_id=None):
+    """Yields the coach's reply in pieces as Gemini generates it."""
     if not os.getenv("GEMINI_API_KEY"):
-        return "I'm in testing mode, but I'm saving our conversation!"
+        yield "I'm in testing mode, but I'm saving our conversation!"
+        return
 
     # Extract test path info, including new fields
     test_path_info = user_stats.get("test_path", {})
@@ -941,18 +1712,10 @@ def _get_test_prep_ai_chat_response(history, user_stats, stat_history="", quiz_r
     # ... (rest of date formatting logic is the same) ...
     if test_date_str:
         try:
-            user_tz_str = session.get('timezone', 'UTC')
-            try:
-                user_tz = ZoneInfo(user_tz_str)
-            except ZoneInfoNotFoundError:
-                user_tz = ZoneInfo("UTC")
-            test_date = datetime.strptime(
-                test_date_str, '%Y-%m-%d').date()  # Use .date()
-            # Compare dates directly
-            delta = test_date - datetime.now(user_tz).date()
-            formatted_date = test_date.strftime('%B %d, %Y')
-            if delta.days >= 0:
-                test_date_info = f"The student's test is on {formatted_date} ({delta.days} days from now)."
+            formatted_date, days_left = _test_date_delta(
+                test_date_str, _request_tz())
+            if days_left >= 0:
+                test_date_info = f"The student's test is on {formatted_date} ({days_left} days from now)."
             else:
                 test_date_info = f"The student's test date was {formatted_date}, which has already passed."
         except ValueError:
@@ -968,50 +1731,15 @@ def _get_test_prep_ai_chat_response(history, user_stats, stat_history="", quiz_r
         focus_desc = "ACT"
     elif test_focus == 'both':
         focus_desc = "both SAT and ACT"
-    system_message = (
-        "# MISSION & IDENTITY\n"
-        "You are an expert AI assistant for Mentics, a web app that creates personalized learning paths for high school students. Your specific persona is a highly adaptive, intelligent, and supportive SAT/ACT test prep coach. Your personality is encouraging yet focused, guiding students toward steady, measurable progress. You are a supplement to the main 'Path' feature, which visually lays out the student's learning journey.\n\n"
-
-        "# MENTICS APPLICATION CONTEXT\n"
-        "To answer user questions accurately, you must understand the app's key features:\n"
-        "- **AI Path Generation**: The core of Mentics. The app generates a visual, step-by-step roadmap of tasks for the student to follow for test prep and college planning.\n"
-        "- **AI Assistant (Your Role)**: You are the chat interface. You help users when they are stuck on a task, provide encouragement, and offer deeper explanations.\n"
-        "- **Stats & Tracker**: A dashboard where users input their scores (GPA, SAT, ACT) and track their progress over time with charts.\n"
-        "- **Gamification**: The app includes points and streaks for completing tasks to keep users motivated.\n"
-        "- **Forum & Leaderboard**: Social features where users can connect and compete.\n\n"
-
-        f"## CURRENT STUDENT ANALYSIS (CONTEXT FOR YOUR RESPONSE)\n"
-        f"This is the specific student you are currently coaching:\n"
-        f"- **Primary Test Focus:** {focus_desc}\n"  # NEW
-        # NEW
-        f"- Current SAT EBRW: {current_sat_ebrw}, Current SAT Math: {current_sat_math}\n"
-        # NEW (You can add section scores too if needed)
-        f"- Current ACT Composite: {current_act_comp}\n"
-        # Updated
-        f"- Desired SAT: {desired_sat}, Desired ACT: {desired_act}\n"
-        f"- Strengths: {strengths}\n"
-        f"- Weaknesses: {weaknesses}\n"
-        f"- Official Test Date Info: {test_date_info}\n"  # Updated name
-        f"- Estimated Weekly Study Time: {hours_per_week} hours\n"  # NEW
-        f"- Historical Performance Data (from Tracker): {stat_history}\n"
-        f"- Current Active Tasks (numbered):\n{current_tasks}\n\n"
-        f"## RECENT QUIZ PERFORMANCE (Incorrect Answers)\n{quiz_results}\n\n"
-        # Added sprint results here too
-        f"## RECENT SPRINT PERFORMANCE (Incorrect Answers)\n{sprint_results}\n\n"
-        f"This shows specific questions the user recently got wrong. Use this granular data to mentor them in their path."
-
-        "## CORE COACHING DIRECTIVES (Your Rules of Engagement)\n"
-        "0.  **Initial Greeting**: Your very first message to the user *must* be a warm and encouraging welcome. It *must* also clearly state that they can type **'regenerate'** or **'new path'** at any time to get a new path based on your conversation.\n"
-        "1.  **Primary Goal: Path & App Support**: Your main purpose is to help the user with their current, active Path. Answer their questions about specific tasks, why they were assigned, and how to approach them. You must also be able to answer general questions about using the Mentics application's features as described above.\n"
-        "2.  **Path Regeneration Protocol**: If a user expresses that their goals have changed or they want a different approach, reiterate that they can use the regeneration commands.\n"
-        "3.  **Provide High-Quality Resources**: When a student is stuck or asks for help, provide specific, reputable, and free resources using markdown links (e.g., `[Khan Academy](https://...)`, official practice test PDFs, specific educational YouTube videos).\n"
-        "4.  **Actionable Focus**: Every response must provide a clear next step, a useful tip, or actionable guidance. Never leave the user wondering what to do next.\n"
-        "5.  **Adaptive Response Length**: \n"
-        "    - For quick questions, provide short, concise answers KEEP THESE UNDER 100 WORDS).\n"
-        "    - For complex requests (e.g., explaining a difficult concept), provide detailed, step-by-step explanations using lists or bullet points KEEP THESE UNDER 250 words.\n"
-        "6.  **Proactive and Strategic Guidance**: Offer actionable strategies, study tips, and relevant resources when a user expresses difficulty. Address their weaknesses directly but leverage their strengths to build confidence.\n"
-        "7.  **Mentorship Tone**: Always maintain a supportive, motivating, and realistic tone. Your goal is to empower the student and encourage consistent effort and progress."
-    )
+    static_prefix = _TEST_PREP_CHAT_PREFIX
+    student_context = _TEST_PREP_CHAT_CONTEXT.substitute(
+        focus_desc=focus_desc, current_sat_ebrw=current_sat_ebrw,
+        current_sat_math=current_sat_math, current_act_comp=current_act_comp,
+        desired_sat=desired_sat, desired_act=desired_act, strengths=strengths,
+        weaknesses=weaknesses, test_date_info=test_date_info,
+        hours_per_week=hours_per_week, stat_history=stat_history,
+        current_tasks=current_tasks, quiz_results=quiz_results,
+        sprint_results=sprint_results)
 
     # Build Gemini chat history
     gemini_history = []
@@ -1019,118 +1747,114 @@ def _get_test_prep_ai_chat_response(history, user_stats, stat_history="", quiz_r
         role = "model" if message["role"] == "assistant" else "user"
         gemini_history.append({"role": role, "parts": [message["content"]]})
 
+    # The cache key covers the full system message and conversation, so a hit means identical context.
+    # Exact match only: a near-identical conversation can still be asking a different question.
+    cache_key = static_prefix + "\n\n" + student_context + "\n\n" + json_dumps(gemini_history)
+    chunks = []
     try:
-        # Initialize model
-        model = genai.GenerativeModel(
-            'gemini-2.5-flash', system_instruction=system_message)
+        cached_reply = llm_cache.get(cache_key)
+        if cached_reply is not None:
+            yield cached_reply
+            return
+
+        # Initialize model; the per-student context rides along with the latest turn
+        model = _get_prefix_cached_model(static_prefix)
         chat = model.start_chat(history=gemini_history[:-1])
         last_user_message = gemini_history[-1]['parts'][0] if gemini_history else "Hello"
-        response = chat.send_message(last_user_message)
-        return response.text
-    except Exception as e:
-        print(
-            f"\n--- GEMINI API ERROR IN _get_test_prep_ai_chat_response: {e} ---\n")
-        return "Sorry, I encountered an error connecting to the AI."
+        response = chat.send_message(
+            [student_context, last_user_message], stream=True)
+        for chunk in response:
+            text = chunk.text
+            chunks.append(text)
+            yield text
+        _log_cached_token_usage("Test prep chat tokens", response)
+        llm_cache.put(cache_key, "".join(chunks))
+    except Exception:
+        logger.exception("Gemini API error in %s", "_get_test_prep_ai_chat_response")
+        # Keep whatever already reached the student rather than tacking an error onto it
+        if not chunks:
+            yield "Sorry, I encountered an error connecting to the AI."
+
+
+# Most recent chat messages quoted in the college path prompt, to keep its size bounded
+_PROMPT_CHAT_HISTORY_LIMIT = 20
+
+# College Planning fallback tasks; the generator returns shuffled copies
+_MOCK_COLLEGE_TASKS = (
+    {"description": "Research 5 colleges that match your interests.", "reason": "Finding the right fit is the first step to a successful college experience.",
+        "type": "standard", "stat_to_update": None, "category": "College Planning", "difficulty": "medium"},
+    {"description": "Write a rough draft of your Common App personal statement.", "reason": "This is your chance to tell your story and show admissions officers who you are.",
+        "type": "milestone", "stat_to_update": "essay_progress", "category": "College Planning", "difficulty": "hard"},
+    {"description": "Update your GPA in your profile.", "reason": "Keeping your academic information up-to-date is important for tracking your progress.",
+        "type": "milestone", "stat_to_update": "gpa", "category": "College Planning", "difficulty": "easy"},
+    {"description": "Request three letters of recommendation from teachers.", "reason": "Strong letters of recommendation can make a big difference in your application.",
+        "type": "standard", "stat_to_update": None, "category": "College Planning", "difficulty": "medium"},
+    {"description": "Create a spreadsheet to track application deadlines.", "reason": "Staying organized is key to a stress-free application season.",
+        "type": "standard", "stat_to_update": None, "category": "College Planning", "difficulty": "easy"},
+)
+
 
+def _get_college_planning_ai_tasks(college_context, user_stats, path_history, chat_history=[], stat_history="", user_id=None, regenerate=False):
+    """Generates hyper-intelligent, adaptive college planning tasks with a detailed, gamified prompt.
 
-def _get_college_planning_ai_tasks(college_context, user_stats, path_history, chat_history=[], stat_history=""):
-    """Generates hyper-intelligent, adaptive college planning tasks with a detailed, gamified prompt."""
+    Returns (tasks, is_fallback); is_fallback is True when the tasks are the mock set
+    served because Gemini was unavailable or returned something unusable.
+    """
 
     def get_mock_tasks_reliably():
-        print("--- DEBUG: Running corrected College Planning mock generator. ---")
-        all_mock_tasks = [
-            {"description": "Research 5 colleges that match your interests.", "reason": "Finding the right fit is the first step to a successful college experience.",
-                "type": "standard", "stat_to_update": None, "category": "College Planning", "difficulty": "medium"},
-            {"description": "Write a rough draft of your Common App personal statement.", "reason": "This is your chance to tell your story and show admissions officers who you are.",
-                "type": "milestone", "stat_to_update": "essay_progress", "category": "College Planning", "difficulty": "hard"},
-            {"description": "Update your GPA in your profile.", "reason": "Keeping your academic information up-to-date is important for tracking your progress.",
-                "type": "milestone", "stat_to_update": "gpa", "category": "College Planning", "difficulty": "easy"},
-            {"description": "Request three letters of recommendation from teachers.", "reason": "Strong letters of recommendation can make a big difference in your application.",
-                "type": "standard", "stat_to_update": None, "category": "College Planning", "difficulty": "medium"},
-            {"description": "Create a spreadsheet to track application deadlines.", "reason": "Staying organized is key to a stress-free application season.",
-                "type": "standard", "stat_to_update": None, "category": "College Planning", "difficulty": "easy"}
-        ]
-        return random.sample(all_mock_tasks, 5)
+        logger.debug("Running fallback mock task generator for %s", "College Planning")
+        return [dict(task) for task in random.sample(_MOCK_COLLEGE_TASKS, 5)], True
 
     if not os.getenv("GEMINI_API_KEY"):
         return get_mock_tasks_reliably()
 
-    completed_tasks_str = "\n".join(
-        [f"- {task['description']}" for task in path_history.get('completed', [])]) or "None."
-    incomplete_tasks_str = "\n".join(
-        [f"- {task['description']}" for task in path_history.get('incomplete', [])]) or "None."
-    chat_history_str = "\n".join(
-        [f"{msg['role'].capitalize()}: {msg['content']}" for msg in chat_history]) or "No conversation history yet."
-    latest_user_message = next((msg['content'] for msg in reversed(
-        chat_history) if msg['role'] == 'user'), "N/A")
-
-    prompt = (
-        f"# MISSION\n"
-        f"You are an expert AI college admissions counselor for the Mentics platform. Your mission is to generate an intelligent, 5-step roadmap that provides a clear, logical, and motivating path for a high school student. The plan must be a thoughtful continuation of their journey, not just a random list of tasks.\n\n"
-
-        f"## CRITICAL SCENARIO ANALYSIS (ACTION REQUIRED)\n"
-        f"First, determine the student's current situation and choose your generation strategy:\n"
-        f"1.  **Regeneration Request:** If the most recent user message (see below) contains keywords like 'regenerate', 'new path', or expresses a significant change in plans (e.g., 'I want to apply to different schools now'), your **highest priority** is to generate a path that directly addresses that immediate request.\n"
-        f"2.  **Post-Path Continuation:** If the student has just completed all tasks in their previous path, the new plan MUST be a logical next step in the college planning process (e.g., moving from 'researching colleges' to 'drafting supplemental essays'). It should feel like a natural progression.\n"
-        f"3.  **Standard Generation:** If neither of the above applies, generate a standard path that is appropriate for their grade level and builds upon their historical data.\n\n"
-
-        f"# STUDENT ANALYSIS DATA\n"
-        f"- Current Grade: {college_context.get('grade', 'N/A')}\n"
-        f"- Stated Planning Stage: {college_context.get('planning_stage', 'N/A')}\n"
-        f"- Interested Majors: {college_context.get('majors', 'N/A')}\n"
-        f"- Target Colleges: {college_context.get('target_colleges', 'None specified')}\n"
-        f"- Current GPA: {user_stats.get('gpa', 'N/A')}\n\n"
-
-        f"## HISTORICAL & CONVERSATIONAL CONTEXT\n"
-        f"This is CRITICAL for creating an intelligent, continuous learning journey.\n"
-        f"- **Most Recent User Request:** '{latest_user_message}' <== **If this is a regeneration request, it takes precedence over all other data.**\n"
-        f"- Recently Completed Tasks: {completed_tasks_str}\n"
-        f"- Incomplete Tasks from Previous Path: {incomplete_tasks_str}\n"
-        f"- Full Conversation History: {chat_history_str}\n"
-        f"- Historical Performance Data (Tracker):\n{stat_history}\n\n"
-
-        f"# YOUR TASK: GENERATE THE NEW 5-STEP ROADMAP\n"
-        f"- **Synthesize, Don't Just List:** Your primary function is to connect the student's grade, goals, and history to create hyper-specific tasks. Generic tasks like 'Work on your essay' are forbidden.\n"
-        f"- **Extreme Specificity & Actionable Verbs:** Descriptions must be granular and start with a strong verb (e.g., 'Draft', 'Research', 'Finalize'). Instead of 'Explore majors', generate 'Research the core curriculum for a Computer Science major at {college_context.get('target_colleges', 'one of your target schools')} to see if it aligns with your interests.'\n"
-        f"- **Incorporate Multiple Formats:** The plan must include a mix of task types. Include at least one **Resource Task** (e.g., 'Watch this guide on financial aid'), one **Action Task** (e.g., 'Draft your Common App activity list'), and one **Strategic/Review Task** (e.g., 'Analyze the supplemental essay prompts for your target schools and categorize them by theme').\n"
-        f"- **Data-Driven Justification:** The `reason` for each task is critical. It MUST explicitly reference the student's personal data (grade, major, goals). For example: 'As an 11th grader interested in Biology, it is crucial to start identifying teachers for your recommendation letters now.'\n\n"
-
-        f"# CRITICAL DIRECTIVES & JSON SCHEMA\n"
-        f"1.  **JSON Output ONLY**: Your entire output MUST be a single, raw JSON object. No extra text.\n"
-        f"2.  **New Task Formats**: You can now use `strategy` and `review` in the `task_format` field for tasks focused on planning or self-evaluation. These do not require a markdown link.\n"
-        f"3.  **Data-Driven Justification**: The `reason` field is mandatory and must explain *why* this task is relevant to *this specific student* by referencing their data (e.g., '...because you're in 12th grade and application deadlines are approaching').\n"
-        f"4.  **Meaningful Milestones & 'Boss Battles'**: Use 'milestone' for significant achievements (e.g., completing an essay draft, submitting an application). A 'Boss Battle' description must begin with 'Boss Battle:'.\n"
-        f"5.  **Refer to Test Prep Path**: If test prep is relevant, do not create a task for it. Instead, create a task that instructs the user to work on their 'Test Prep Path' within the Mentics app.\n\n"
-
-        f"# JSON OUTPUT STRUCTURE\n"
-        f"{{\n"
-        f'  "tasks": [\n'
-        f'    {{\n'
-        f'      "task_format": "Either \'link\', \'strategy\', or \'review\'.",\n'
-        f'      "description": "Hyper-specific instruction. MUST include a markdown link if format is \'link\'.",\n'
-        f'      "reason": "Mandatory, data-driven justification referencing the student\'s specific grade, goals, or history.",\n'
-        f'      "type": "Either \'standard\' or \'milestone\'.",\n'
-        f'      "stat_to_update": "A string (\'gpa\', \'essay_progress\', \'applications_submitted\') ONLY if type is milestone, otherwise null.",\n'
-        f'      "category": "This MUST be the string \'College Planning\'.",\n'
-        f'      "difficulty": "Either \'easy\', \'medium\', \'hard\', or \'epic\'."\n'
-        f'    }}\n'
-        f'  ]\n'
-        f'}}'
-    )
+    completed_tasks_str = _format_task_bullets(path_history.get('completed'))
+    incomplete_tasks_str = _format_task_bullets(path_history.get('incomplete'))
+    # One pass over the conversation; only the most recent messages go into the prompt
+    chat_lines = []
+    latest_user_message = "N/A"
+    first_shown = len(chat_history) - _PROMPT_CHAT_HISTORY_LIMIT
+    for i, msg in enumerate(chat_history):
+        if i >= first_shown:
+            chat_lines.append(f"{msg['role'].capitalize()}: {msg['content']}")
+        if msg['role'] == 'user':
+            latest_user_message = msg['content']
+    chat_history_str = "\n".join(chat_lines) or "No conversation history yet."
+
+    dynamic_suffix = _COLLEGE_TASKS_CONTEXT.substitute(
+        grade=college_context.get('grade', 'N/A'),
+        planning_stage=college_context.get('planning_stage', 'N/A'),
+        majors=college_context.get('majors', 'N/A'),
+        target_colleges=college_context.get('target_colleges', 'None specified'),
+        gpa=user_stats.get('gpa', 'N/A'),
+        latest_user_message=latest_user_message,
+        completed_tasks_str=completed_tasks_str,
+        incomplete_tasks_str=incomplete_tasks_str,
+        chat_history_str=chat_history_str, stat_history=stat_history)
+    # The path history is part of the prompt, so finishing or adding tasks naturally misses the cache
+    prompt = _COLLEGE_TASKS_PREFIX + "\n\n" + dynamic_suffix
+    # Same scoping and suffix-only embedding as the test prep path
+    cache_namespace = f"college_tasks:v2:{user_id}" if user_id is not None else None
     try:
-        model = genai.GenerativeModel(
-            'gemini-2.5-flash',
-            generation_config={"response_mime_type": "application/json"}
-        )
-        response = model.generate_content(prompt)
-        response_data = json.loads(response.text)
+        raw_text, cache_embedding = llm_cache.lookup(
+            prompt, cache_namespace, dynamic_suffix, semantic=not regenerate)
+        is_cache_hit = raw_text is not None
+        if not is_cache_hit:
+            model = _get_prefix_cached_model(
+                _COLLEGE_TASKS_PREFIX, generation_config=_JSON_GENERATION_CONFIG)
+            response = model.generate_content(dynamic_suffix)
+            _log_cached_token_usage("College path tokens", response)
+            raw_text = response.text
+        response_data = json_loads(raw_text)
         tasks = response_data.get("tasks", [])
         if isinstance(tasks, list) and len(tasks) > 0:
-            return tasks
+            if not is_cache_hit:
+                llm_cache.put(prompt, raw_text, namespace=cache_namespace,
+                              embedding=cache_embedding)
+            return tasks, False
         raise ValueError("Invalid format from AI")
-    except Exception as e:
-        print(
-            f"\n--- GEMINI API ERROR IN _get_college_planning_ai_tasks: {e} ---\n")
+    except Exception:
+        logger.exception("Gemini API error in %s", "_get_college_planning_ai_tasks")
         return get_mock_tasks_reliably()
 
 
@@ -1145,95 +1869,106 @@ def _get_college_planning_ai_chat_response(history, user_stats, stat_history="",
     current_tasks = "No tasks available." if user_id is None else _get_current_numbered_tasks(
         user_id, "College Planning")
 
-    # Get current active tasks
-    current_tasks = _get_current_numbered_tasks(user_id, "College Planning")
-
-    system_message = (
-        "# MISSION & IDENTITY\n"
-        "You are an expert AI assistant for Mentics, a web app that creates personalized roadmaps for high school students. Your specific persona is a friendly, intelligent, and highly adaptive college planning advisor. Your personality is encouraging, knowledgeable, and supportive. You are a supplement to the main 'Path' feature, which visually lays out the student's journey.\n\n"
-
-        "# MENTICS APPLICATION CONTEXT\n"
-        "To answer user questions accurately, you must understand the app's key features:\n"
-        "- **AI Path Generation**: The core of Mentics. The app generates a visual, step-by-step roadmap of tasks for the student to follow for college applications, essays, IT IS ALSO IS A RESOURCE FOR SAT/ACT PREP WITH THE TEST PREP PATH sugest the user use this for their SAT/ ACT planning(THIS CAN BE FOUND ON THE DASHBOARD).\n"
-        "- **AI Assistant (Your Role)**: You are the chat interface. You help users when they are stuck on a task, provide encouragement, and offer deeper explanations.\n"
-        "- **Stats & Tracker**: A dashboard where users input their scores (GPA, SAT, ACT) and track their progress over time with charts.\n"
-        "- **Gamification**: The app includes points and streaks for completing tasks to keep users motivated.\n"
-        "- **Forum & Leaderboard**: Social features where users can connect and compete.\n\n"
-
-        f"## CURRENT STUDENT ANALYSIS\n"
-        f"This is the specific student you are currently advising:\n"
-        f"- SAT Math: {user_stats.get('sat_math', 'Not provided')}\n"
-        f"- SAT EBRW: {user_stats.get('sat_ebrw', 'Not provided')}\n"
-        f"- ACT Math: {user_stats.get('act_math', 'Not provided')}\n"
-        f"- ACT Reading: {user_stats.get('act_reading', 'Not provided')}\n"
-        f"- ACT Science: {user_stats.get('act_science', 'Not provided')}\n"
-        f"- GPA: {user_stats.get('gpa', 'Not provided')}\n"
-        f"- Grade Level: {college_info.get('grade', 'N/A')}\n"
-        f"- Current Planning Stage: '{college_info.get('planning_stage', 'N/A')}'\n"
-        f"- Interested Majors: {college_info.get('majors', 'None')}\n"
-        f"- Target Colleges: {college_info.get('target_colleges', 'None')}\n"
-        f"- Recently Completed Tasks: {college_info.get('completed_tasks', 'None')}\n"
-        f"- Incomplete/Failed Tasks: {college_info.get('incomplete_tasks', 'None')}\n"
-        f"- Historical Performance Data (from Tracker): {stat_history}\n"
-        f"- Current Active Tasks (numbered for reference):\n{current_tasks}\n"
-        f"- Current Active Tasks:\n{current_tasks}\n"
-
-
-        "## CORE COACHING DIRECTIVES (Your Rules of Engagement)\n"
-        "0.  **Initial Greeting**: Your very first message to the user *must* be a warm and encouraging welcome. It *must* also clearly state that they can type **'regenerate'** or **'new path'** at any time to get a new path based on your conversation.\n"
-        "1.  **Primary Goal: Path & App Support**: Your main purpose is to help the user with their current, active Path. Answer their questions about specific tasks, why they were assigned, and how to approach them. You must also be able to answer general questions about using the Mentics application's features as described above.\n"
-        "2.  **Path Regeneration Protocol**: If a user expresses that their goals have changed or they want a different approach, reiterate that they can use the regeneration commands.\n"
-        "3.  **Provide High-Quality Resources**: When a student is stuck or needs guidance, provide specific, reputable, and free resources using markdown links (e.g., links to the Common App, financial aid websites like FAFSA, or helpful articles on essay writing).\n"
-        "4.  **Actionable Guidance**: Every response must give the student a clear next step, a valuable resource, or a concrete action to take. Never leave the user wondering what to do next.\n"
-        "5.  **Adaptive Response Length**:\n"
-        "    - For simple questions, provide short, concise answers KEEP THESE UNDER 100 WORDS.\n"
-        "    - For complex requests (e.g., essay brainstorming, advice on choosing colleges), provide detailed, structured responses using lists or bullet points KEEP THESE UNDER 250 WORDS.\n"
-        "6.  **Proactive Advising**: If the student seems stuck on a task like 'write an essay', break it down into smaller, actionable steps (e.g., 'Let's start by brainstorming three key experiences you could write about.').\n"
-        "7.  **Mentorship Tone**: Always maintain a supportive, encouraging, and realistic tone to keep the student motivated throughout the often-stressful college application process."
-        "8. **Suggest Test Prep Path When Relevant**: If the student mentions standardized tests (SAT/ACT) or seems uncertain about test preparation, proactively suggest they explore the MENTICS Test Prep path for tailored study plans and resources.\n"
-    )
+    student_context = _COLLEGE_CHAT_CONTEXT.substitute(
+        sat_math=user_stats.get('sat_math', 'Not provided'),
+        sat_ebrw=user_stats.get('sat_ebrw', 'Not provided'),
+        act_math=user_stats.get('act_math', 'Not provided'),
+        act_reading=user_stats.get('act_reading', 'Not provided'),
+        act_science=user_stats.get('act_science', 'Not provided'),
+        gpa=user_stats.get('gpa', 'Not provided'),
+        grade=college_info.get('grade', 'N/A'),
+        planning_stage=college_info.get('planning_stage', 'N/A'),
+        majors=college_info.get('majors', 'None'),
+        target_colleges=college_info.get('target_colleges', 'None'),
+        completed_tasks=college_info.get('completed_tasks', 'None'),
+        incomplete_tasks=college_info.get('incomplete_tasks', 'None'),
+        stat_history=stat_history, current_tasks=current_tasks)
 
     gemini_history = []
     for message in history:
         role = "model" if message["role"] == "assistant" else "user"
         gemini_history.append({"role": role, "parts": [message["content"]]})
 
+    # The cache key covers the full system message and conversation, so a hit means identical context.
+    # Exact match only, as for test prep chat.
+    cache_key = _COLLEGE_CHAT_PREFIX + "\n\n" + student_context + "\n\n" + json_dumps(gemini_history)
     try:
-        model = genai.GenerativeModel(
-            'gemini-2.5-flash', system_instruction=system_message)
+        cached_reply = llm_cache.get(cache_key)
+        if cached_reply is not None:
+            return cached_reply
+
+        # The static advisor prompt is the system instruction; the per-student context rides along with the latest turn
+        model = _get_prefix_cached_model(_COLLEGE_CHAT_PREFIX)
         chat = model.start_chat(history=gemini_history[:-1])
         last_user_message = gemini_history[-1]['parts'][0] if gemini_history else "Hello"
-        response = chat.send_message(last_user_message)
+        response = chat.send_message([student_context, last_user_message])
+        _log_cached_token_usage("College chat tokens", response)
+        llm_cache.put(cache_key, response.text)
         return response.text
-    except Exception as e:
-        print(
-            f"\n--- GEMINI API ERROR IN _get_college_planning_ai_chat_response: {e} ---\n")
+    except Exception:
+        logger.exception("Gemini API error in %s", "_get_college_planning_ai_chat_response")
         return "Sorry, I encountered an error connecting to the AI."
 
 
-def _generate_and_save_new_college_path(user_id, college_context, chat_history=[]):
-    """Gathers all context, generates, and saves a new college planning path."""
-    try:
-        user_record = db.select("users", where={"id": user_id})
-        if not user_record:
-            raise ValueError(f"User with ID {user_id} not found.")
-        user_stats = json.loads(user_record[0]['stats'])
+# How long a generated path is reused for identical inputs (double submits, refresh storms)
+_PATH_GENERATION_REUSE_SECONDS = 60
+
+
+def _path_generation_key(*inputs):
+    return hashlib.blake2b(json_dumps(inputs).encode("utf-8"), digest_size=16).hexdigest()
 
-        all_college_tasks = db.select(
-            "paths", where={"user_id": user_id, "category": "College Planning"})
-        path_history = {
-            "completed": [task for task in all_college_tasks if task['is_completed']],
-            "incomplete": [task for task in all_college_tasks if not task['is_completed']]
-        }
 
-        # Fetch tracker data
-        stat_history = _get_stat_history_for_prompt(user_id)
+def _get_recent_generation(user_id, input_key):
+    """Returns the tasks generated for these inputs within the reuse window, or None."""
+    row = db.execute_for_one(
+        "SELECT tasks FROM path_generation_cache WHERE user_id = ? AND input_key = ? AND created_at >= datetime('now', ?)",
+        (user_id, input_key, f"-{_PATH_GENERATION_REUSE_SECONDS} seconds"))
+    return json_loads(row['tasks']) if row else None
 
-        db.update("paths", {"is_active": False}, where={
-                  "user_id": user_id, "category": "College Planning", "is_active": True})
 
-        tasks = _get_college_planning_ai_tasks(
-            college_context, user_stats, path_history, chat_history, stat_history)
+def _remember_generation(user_id, input_key, tasks):
+    db.execute(
+        """INSERT INTO path_generation_cache (user_id, input_key, tasks) VALUES (?, ?, ?)
+           ON CONFLICT(user_id, input_key) DO UPDATE SET tasks = excluded.tasks, created_at = CURRENT_TIMESTAMP""",
+        (user_id, input_key, json_dumps(tasks)))
+    # Entries are only useful for a minute, so drop this user's expired ones while we're here
+    db.execute(
+        "DELETE FROM path_generation_cache WHERE user_id = ? AND created_at < datetime('now', ?)",
+        (user_id, f"-{_PATH_GENERATION_REUSE_SECONDS} seconds"))
+
+
+def _generate_and_save_new_college_path(user_id, college_context, chat_history=[], regenerate=False):
+    """Gathers all context, generates, and saves a new college planning path."""
+    try:
+        # User stats, recent task history and tracker data in one round-trip
+        context = _get_path_generation_context(user_id, "College Planning")
+        if context is None:
+            raise ValueError(f"User with ID {user_id} not found.")
+        user_stats = context["stats"]
+        path_history = context["path_history"]
+        stat_history = _format_stat_history(context["stat_history"])
+
+        # Incomplete tasks are left out of the fingerprint: saving a path adds to them,
+        # which would otherwise make an immediate resubmit look like new input
+        latest_user_message = next((msg['content'] for msg in reversed(
+            chat_history) if msg['role'] == 'user'), None)
+        # The completed tasks go in as a plain list of description strings, the same value the
+        # fingerprint hashed when path_history held {"description": ...} dicts, so keys stored
+        # before that change still match. Keep it that way when touching path_history.
+        completed_descriptions = list(path_history['completed'])
+        input_key = _path_generation_key(
+            "College Planning", college_context, user_stats.get('gpa'), latest_user_message,
+            completed_descriptions)
+        tasks = _get_recent_generation(user_id, input_key)
+        if tasks is None:
+            tasks, is_fallback = _get_college_planning_ai_tasks(
+                college_context, user_stats, path_history, chat_history, stat_history, user_id=user_id,
+                regenerate=regenerate)
+            # Mock tasks after a Gemini failure are not remembered, so a retry calls Gemini again
+            if not is_fallback:
+                _remember_generation(user_id, input_key, tasks)
+        else:
+            logger.debug("Reusing college path generated moments ago for identical input")
 
         tasks = tasks[:5]
 
@@ -1241,19 +1976,22 @@ def _generate_and_save_new_college_path(user_id, college_context, chat_history=[
             raise ValueError(
                 "AI task generation did not return the expected tasks.")
 
-        saved_tasks = []
-        for i, task_data in enumerate(tasks):
-            task_id = db.insert("paths", {
+        # Swap the old path for the new one in a single commit
+        with db.transaction():
+            db.update("paths", {"is_active": False}, where={
+                      "user_id": user_id, "category": "College Planning", "is_active": True})
+            _forget_current_numbered_tasks()
+            task_ids = db.insert_many("paths", [{
                 "user_id": user_id, "task_order": i + 1, "description": task_data.get("description"),
                 "reason": task_data.get("reason"), "type": task_data.get("type"), "stat_to_update": task_data.get("stat_to_update"),
                 "category": "College Planning", "is_active": True, "is_completed": False
-            })
-            saved_tasks.append(
-                {**task_data, "id": task_id, "is_completed": False})
+            } for i, task_data in enumerate(tasks)])
 
-        # LOGGING
-        log_activity(user_id, 'path_generated', {
-                     'category': 'College Planning'})
+            # LOGGING
+            log_activity(user_id, 'path_generated', {
+                         'category': 'College Planning'})
+        saved_tasks = [{**task_data, "id": task_id, "is_completed": False}
+                       for task_id, task_data in zip(task_ids, tasks)]
         return saved_tasks
     except Exception as e:
         print(f"Error in _generate_and_save_new_college_path: {e}")
@@ -1268,22 +2006,23 @@ def tracker(user):
     user_id = user.data['id']
 
     # --- 1. Comprehensive Stat History Processing ---
-    stat_history_raw = db.select(
-        "stat_history", where={"user_id": user_id}, order_by="recorded_at ASC")
+    # SQLite cuts the date out of the timestamp, so the loop doesn't split strings
+    stat_history_raw = db.execute(
+        """SELECT stat_name, stat_value, substr(recorded_at, 1, 10) AS date FROM stat_history
+           WHERE user_id = ? ORDER BY recorded_at ASC""", (user_id,))
 
     # A dictionary to hold lists of {"date": d, "value": v} for each stat
-    history_by_stat = {}
+    history_by_stat = defaultdict(list)
     for record in stat_history_raw:
-        stat_name = record['stat_name']
-        if stat_name not in history_by_stat:
-            history_by_stat[stat_name] = []
+        stat_values = history_by_stat[record['stat_name']]
         try:
-            history_by_stat[stat_name].append({
-                "date": record['recorded_at'].split(" ")[0],
+            stat_values.append({
+                "date": record['date'],
                 "value": float(record['stat_value'])
             })
         except (ValueError, TypeError):
             continue  # Skip records with non-numeric values
+    history_by_stat = dict(history_by_stat)
 
     # --- 2. Calculate Composite/Total Scores from Sectional History ---
     # This ensures that practice test totals from the path view are included.
@@ -1296,11 +2035,12 @@ def tracker(user):
             'ebrw'] = entry['value']
 
     sat_total_history = history_by_stat.get('sat_total', [])
+    sat_total_dates = {entry['date'] for entry in sat_total_history}
     for date, scores in sat_scores_by_date.items():
         if 'math' in scores and 'ebrw' in scores:
             total = scores['math'] + scores['ebrw']
             # Avoid adding duplicate totals for the same day
-            if not any(entry['date'] == date for entry in sat_total_history):
+            if date not in sat_total_dates:
                 sat_total_history.append({"date": date, "value": total})
 
     if 'sat_total' in history_by_stat:
@@ -1314,12 +2054,13 @@ def tracker(user):
                 entry['date'], []).append(entry['value'])
 
     act_composite_history = history_by_stat.get('act_composite', [])
+    act_composite_dates = {entry['date'] for entry in act_composite_history}
     for date, scores in act_scores_by_date.items():
         if scores:
             # ACT composite is the average of the sections
             composite = round(sum(scores) / len(scores))
             # Avoid adding duplicate composites for the same day
-            if not any(entry['date'] == date for entry in act_composite_history):
+            if date not in act_composite_dates:
                 act_composite_history.append(
                     {"date": date, "value": composite})
 
@@ -1345,29 +2086,19 @@ def tracker(user):
             }
 
     # --- 4. Path History Processing (Separated by Category) ---
+    # Rows arrive newest generation first and in task order, so grouping keeps both orders
     all_tasks_raw = db.select(
-        "paths", where={"user_id": user_id}, order_by="created_at DESC")
-
-    test_prep_generations, college_planning_generations = {}, {}
+        "paths", where={"user_id": user_id}, order_by="created_at DESC, task_order")
 
+    test_prep_generations, college_planning_generations = defaultdict(list), defaultdict(list)
     for task in all_tasks_raw:
-        gen_key, category = task['created_at'], task['category']
-        target_dict = test_prep_generations if category == 'Test Prep' else college_planning_generations
+        target_dict = test_prep_generations if task['category'] == 'Test Prep' else college_planning_generations
+        target_dict[task['created_at']].append(task)
 
-        if gen_key not in target_dict:
-            target_dict[gen_key] = {'date': gen_key,
-                                    'category': category, 'tasks': []}
-        target_dict[gen_key]['tasks'].append(task)
-
-    test_prep_history = sorted(
-        test_prep_generations.values(), key=lambda x: x['date'], reverse=True)
-    for gen in test_prep_history:
-        gen['tasks'].sort(key=lambda x: x['task_order'])
-
-    college_planning_history = sorted(
-        college_planning_generations.values(), key=lambda x: x['date'], reverse=True)
-    for gen in college_planning_history:
-        gen['tasks'].sort(key=lambda x: x['task_order'])
+    test_prep_history = [{'date': gen_key, 'category': tasks[0]['category'], 'tasks': tasks}
+                         for gen_key, tasks in test_prep_generations.items()]
+    college_planning_history = [{'date': gen_key, 'category': tasks[0]['category'], 'tasks': tasks}
+                                for gen_key, tasks in college_planning_generations.items()]
 
     return render_template(
         "tracker.html",
@@ -1378,6 +2109,15 @@ def tracker(user):
     )
 
 
+_TRACKER_ANALYSIS_PROMPT = Template(
+    "You are an expert education analyst. Produce a concise markdown report for the student.\n\n"
+    "CONTEXT:\n- Recent score history (latest 20 records):\n$stat_history\n\n"
+    "- Recent incorrect quiz examples (up to 5):\n$quiz_results\n\n"
+    "- Path/task summary:\n$test_prep_tasks\n$college_tasks\n$path_summary\n\n"
+    "INSTRUCTIONS:\n1) Provide a 3-sentence overall progress snapshot.\n2) List 3 specific strengths with data references.\n3) List 3 specific weaknesses or patterns to address, referencing quiz examples when useful.\n4) Provide 3 prioritized, actionable next steps (short, doable, and measurable).\n5) Suggest one micro-quiz/task the student can do in the next 48 hours.\n6) Keep tone encouraging and avoid technical jargon.\n\n"
+)
+
+
 def _get_tracker_ai_analysis(user):
     """Generates a comprehensive AI-powered analysis of all user progress."""
     user_id = user.data['id']
@@ -1387,35 +2127,38 @@ def _get_tracker_ai_analysis(user):
     stat_history_summary = _get_stat_history_for_prompt(user_id)
     quiz_results_summary = _get_quiz_results_for_prompt(user_id)
 
-    all_paths_raw = db.select(
-        "paths", where={"user_id": user_id}, order_by="created_at DESC")
+    # Completion counts and the newest path in one pass instead of loading every task
+    path_totals = db.execute_for_one(
+        """SELECT COUNT(*) AS total_count, SUM(is_completed) AS completed_count,
+                  (SELECT created_at || '|' || COALESCE(category, '') FROM paths
+                   WHERE user_id = ? ORDER BY created_at DESC LIMIT 1) AS last_path
+           FROM paths WHERE user_id = ?""", (user_id, user_id))
     path_history_summary = []
-    if all_paths_raw:
-        completed_count = sum(1 for p in all_paths_raw if p['is_completed'])
-        total_count = len(all_paths_raw)
+    if path_totals and path_totals['total_count']:
         path_history_summary.append(
-            f"Overall Task Completion: {completed_count}/{total_count} tasks completed.")
+            f"Overall Task Completion: {path_totals['completed_count']}/{path_totals['total_count']} tasks completed.")
 
-        last_path_date = all_paths_raw[0]['created_at'].split(' ')[0]
-        last_path_category = all_paths_raw[0]['category']
+        last_path_created_at, last_path_category = path_totals['last_path'].split('|', 1)
+        last_path_date = last_path_created_at.split(' ')[0]
         path_history_summary.append(
             f"Most Recent Path: A '{last_path_category}' path generated on {last_path_date}.")
 
     # Better structured prompt focusing on trends, causes, and 3 actionable steps.
-    prompt = (
-        f"You are an expert education analyst. Produce a concise markdown report for the student.\n\n"
-        f"CONTEXT:\n- Recent score history (latest 20 records):\n{stat_history_summary}\n\n"
-        f"- Recent incorrect quiz examples (up to 5):\n{quiz_results_summary}\n\n"
-        f"- Path/task summary:\n{_get_current_numbered_tasks(user_id, 'Test Prep')}\n{_get_current_numbered_tasks(user_id, 'College Planning')}\n{', '.join(path_history_summary)}\n\n"
-        f"INSTRUCTIONS:\n1) Provide a 3-sentence overall progress snapshot.\n2) List 3 specific strengths with data references.\n3) List 3 specific weaknesses or patterns to address, referencing quiz examples when useful.\n4) Provide 3 prioritized, actionable next steps (short, doable, and measurable).\n5) Suggest one micro-quiz/task the student can do in the next 48 hours.\n6) Keep tone encouraging and avoid technical jargon.\n\n"
+    prompt = _TRACKER_ANALYSIS_PROMPT.substitute(
+        stat_history=stat_history_summary,
+        quiz_results=quiz_results_summary,
+        test_prep_tasks=_get_current_numbered_tasks(user_id, 'Test Prep'),
+        college_tasks=_get_current_numbered_tasks(user_id, 'College Planning'),
+        path_summary=', '.join(path_history_summary),
     )
 
     # If a cloud AI key is available, call the model. Otherwise produce a safe local heuristic summary.
     if os.getenv("GEMINI_API_KEY"):
         try:
-            model = genai.GenerativeModel('gemini-2.5-flash')
-            response = model.generate_content(prompt)
-            return response.text
+            analysis = _cached_generate(prompt, user_id)
+            if analysis is not None:
+                return analysis
+            # Rate limited: fall through to the local summary
         except Exception as e:
             print(f"Error in tracker AI analysis (remote): {e}")
             # fallthrough to local summary
@@ -1508,16 +2251,18 @@ def signup():
         name = request.form["name"]
         password = generate_password_hash(request.form["password"])
         try:
-            user_id = db.insert("users", {
-                "email": email, "password": password, "name": name,
-                "stats": json.dumps({
-                    "sat_ebrw": "", "sat_math": "", "act_math": "",
-                    "act_reading": "", "act_science": "", "gpa": "", "milestones": 0
+            # Both rows commit together, so a failed second insert can't leave an orphan user
+            with db.transaction():
+                user_id = db.insert("users", {
+                    "email": email, "password": password, "name": name,
+                    "stats": json_dumps({
+                        "sat_ebrw": "", "sat_math": "", "act_math": "",
+                        "act_reading": "", "act_science": "", "gpa": "", "milestones": 0
+                    })
                 })
-            })
-            # Initialize gamification stats for new user
-            db.insert("gamification_stats", {
-                      "user_id": user_id, "points": 0, "current_streak": 0})
+                # Initialize gamification stats for new user
+                db.insert("gamification_stats", {
+                          "user_id": user_id, "points": 0, "current_streak": 0})
 
             session["user"] = email
             session["user_id"] = user_id
@@ -1553,7 +2298,7 @@ def login():
 @app.route('/google-login')
 def google_login():
     redirect_uri = url_for('authorize', _external=True)
-    return oauth.google.authorize_redirect(redirect_uri)
+    return _google_oauth().authorize_redirect(redirect_uri)
 
 # NEW: Google Authorize Route (Callback) - UPDATED
 
@@ -1561,8 +2306,9 @@ def google_login():
 # Replace the entire authorize function in app.py
 @app.route('/authorize')
 def authorize():
-    token = oauth.google.authorize_access_token()
-    user_info = oauth.google.parse_id_token(token, nonce=session.get('nonce'))
+    google = _google_oauth()
+    token = google.authorize_access_token()
+    user_info = google.parse_id_token(token, nonce=session.get('nonce'))
 
     # Use the new, efficient select_one method
     user_record = db.select_one("users", where={"email": user_info['email']})
@@ -1575,17 +2321,18 @@ def authorize():
     else:
         # New user, create an account
         password_hash = generate_password_hash(os.urandom(16).hex())
-        user_id = db.insert("users", {
-            "email": user_info['email'],
-            "name": user_info['name'],
-            "password": password_hash,
-            "stats": json.dumps({
-                "sat_ebrw": "", "sat_math": "", "act_math": "",
-                "act_reading": "", "act_science": "", "gpa": "", "milestones": 0
+        with db.transaction():
+            user_id = db.insert("users", {
+                "email": user_info['email'],
+                "name": user_info['name'],
+                "password": password_hash,
+                "stats": json_dumps({
+                    "sat_ebrw": "", "sat_math": "", "act_math": "",
+                    "act_reading": "", "act_science": "", "gpa": "", "milestones": 0
+                })
             })
-        })
-        db.insert("gamification_stats", {
-                  "user_id": user_id, "points": 0, "current_streak": 0})
+            db.insert("gamification_stats", {
+                      "user_id": user_id, "points": 0, "current_streak": 0})
 
         session["user"] = user_info['email']
         session["user_id"] = user_id
@@ -1613,7 +2360,7 @@ def onboarding(user):
             'anxieties': request.form.get('anxieties')
         }
         db.update('users', {
-            'onboarding_data': json.dumps(onboarding_data),
+            'onboarding_data': json_dumps(onboarding_data),
             'onboarding_completed': True
         }, {'id': user.data['id']})
         return redirect(url_for('dashboard'))
@@ -1629,11 +2376,11 @@ def set_timezone():
     timezone = data.get('timezone')
     if timezone:
         try:
-            # Validate that it's a real timezone
-            ZoneInfo(timezone)
+            # Validate that it's a real timezone (and warm the cache the date filters read from)
+            _tz(timezone)
             session['timezone'] = timezone
             return jsonify({"success": True})
-        except ZoneInfoNotFoundError:
+        except (ZoneInfoNotFoundError, ValueError):
             return jsonify({"success": False, "error": "Invalid timezone"}), 400
     return jsonify({"success": False, "error": "Timezone not provided"}), 400
 
@@ -1643,6 +2390,37 @@ def set_timezone():
 # --- Dashboard & Path Routes ---
 
 
+# Dashboard badges; the template only reads them, so every request shares these dicts
+_ACHIEVEMENTS = (
+    {"id": "pioneer_test", "icon": "🚀", "title": "Test Prep Pioneer",
+        "description": "Generated your first Test Prep path."},
+    {"id": "planner_college", "icon": "🏛️", "title": "College Planner",
+        "description": "Generated your first College Planning path."},
+    {"id": "first_step", "icon": "✅", "title": "First Step",
+        "description": "Completed your first task."},
+    {"id": "task_master_10", "icon": "🔥", "title": "Task Master",
+        "description": "Completed 10 tasks."},
+    {"id": "pathfinder_pro_25", "icon": "🏆", "title": "Pathfinder Pro",
+        "description": "Completed 25 tasks."},
+    {"id": "streak_3", "icon": "⚡", "title": "On a Roll",
+        "description": "Maintained a 3-day streak."},
+    {"id": "streak_7", "icon": "🌟", "title": "Committed",
+        "description": "Maintained a 7-day streak."},
+    {"id": "points_100", "icon": "💯", "title": "Point Collector",
+        "description": "Earned 100 points."},
+    {"id": "points_500", "icon": "💎", "title": "Point Pro",
+        "description": "Earned 500 points."},
+)
+
+
+@lru_cache(maxsize=512)
+def _earned_achievements(earned_flags):
+    """Earned subset of _ACHIEVEMENTS for a tuple of flags; there are only 2**9 combinations."""
+    if all(earned_flags):
+        return _ACHIEVEMENTS
+    return tuple(achievement for achievement, earned in zip(_ACHIEVEMENTS, earned_flags) if earned)
+
+
 @app.route("/dashboard")
 @login_required
 def dashboard(user):
@@ -1651,19 +2429,37 @@ def dashboard(user):
     stats = user.get_stats()
     user_id = user.data['id']
     name = user.get_name()
-    all_tasks = db.select("paths", where={"user_id": user_id})
 
-    # --- Gamification Stats ---
-    gamification_stats_list = db.select(
-        "gamification_stats", where={"user_id": user_id})
-    if not gamification_stats_list:
-        # Fallback to create stats if they don't exist for some reason
-        db.insert("gamification_stats", {
-                  "user_id": user_id, "points": 0, "current_streak": 0})
-        gamification_stats_list = db.select(
-            "gamification_stats", where={"user_id": user_id})
+    user_tz = _request_tz()
+
+    now_local = datetime.now(user_tz)
+    today = now_local.date()
+    seven_days_ago = today - timedelta(days=6)
+
+    # Let SQLite shift the UTC timestamps into the user's timezone and count per local day.
+    # Uses today's UTC offset for the whole week, which is only off around a DST switch.
+    offset_minutes = int(now_local.utcoffset().total_seconds()) // 60
+    sign = '-' if offset_minutes < 0 else '+'
+    offset = f"{sign}{abs(offset_minutes) // 60:02d}:{abs(offset_minutes) % 60:02d}"
+    window_start_utc = (datetime.combine(seven_days_ago, datetime.min.time(), tzinfo=user_tz)
+                        .astimezone(_UTC).strftime('%Y-%m-%d %H:%M:%S'))
+
+    # The dashboard's reads are small indexed lookups, so they run inline on the request
+    # thread; handing them to a shared pool only made requests queue behind each other
+    task_counts = _get_task_counts(user_id)
+    test_counts = task_counts['Test Prep']
+    college_counts = task_counts['College Planning']
 
-    gamification_stats = gamification_stats_list[0]
+    # --- Gamification Stats ---
+    gamification_stats = db.select_one(
+        "gamification_stats", columns=["points", "current_streak"], where={"user_id": user_id})
+    if not gamification_stats:
+        # Fallback to create stats if they don't exist for some reason. The no-op
+        # update makes RETURNING hand back the row even if another request just created it.
+        gamification_stats = db.execute(
+            """INSERT INTO gamification_stats (user_id, points, current_streak) VALUES (?, 0, 0)
+               ON CONFLICT(user_id) DO UPDATE SET user_id = excluded.user_id
+               RETURNING points, current_streak""", (user_id,))[0]
 
     game_stats = {
         "points": gamification_stats['points'],
@@ -1671,89 +2467,45 @@ def dashboard(user):
     }
 
     # --- Progress Calculations ---
-    active_test_tasks = [
-        t for t in all_tasks if t['is_active'] and t['category'] == 'Test Prep']
-    test_prep_completed_current = sum(
-        1 for t in active_test_tasks if t['is_completed'])
-    total_test_prep_completed = sum(
-        1 for t in all_tasks if t['is_completed'] and t['category'] == 'Test Prep')
-
-    active_college_tasks = [
-        t for t in all_tasks if t['is_active'] and t['category'] == 'College Planning']
-    college_planning_completed_current = sum(
-        1 for t in active_college_tasks if t['is_completed'])
-    total_college_planning_completed = sum(
-        1 for t in all_tasks if t['is_completed'] and t['category'] == 'College Planning')
-
-    # --- Key Stat Calculations ---
-    sat_ebrw = stats.get("sat_ebrw")
-    sat_math = stats.get("sat_math")
-    sat_total = None
-    if sat_ebrw and sat_math:
-        try:
-            sat_total = int(sat_ebrw) + int(sat_math)
-        except (ValueError, TypeError):
-            sat_total = None
+    test_prep_completed_current = test_counts['cur_done']
+    total_test_prep_completed = test_counts['total_done']
 
-    act_scores = []
-    if stats.get("act_math"):
-        act_scores.append(int(stats.get("act_math")))
-    if stats.get("act_reading"):
-        act_scores.append(int(stats.get("act_reading")))
-    if stats.get("act_science"):
-        act_scores.append(int(stats.get("act_science")))
+    college_planning_completed_current = college_counts['cur_done']
+    total_college_planning_completed = college_counts['total_done']
 
-    act_average = round(sum(act_scores) / len(act_scores)
-                        ) if act_scores else None
+    # --- Key Stat Calculations ---
+    sat_total, act_average = _key_stat_totals(stats)
 
     # --- Recent Activity Fetch ---
-    recent_activities_raw = db.select(
-        "activity_log",
-        where={"user_id": user_id},
-        order_by="created_at DESC LIMIT 5"
-    )
-    recent_activities = []
-    for activity in recent_activities_raw:
-        details = json.loads(activity['details'])
-        recent_activities.append({
-            "type": activity['activity_type'],
-            "details": details,
-            "timestamp": activity['created_at']
-        })
+    # The feed only shows a task description or path category, so SQLite pulls those two
+    # fields out of the details JSON instead of Python decoding every row
+    recent_activities_raw = db.execute(
+        """SELECT activity_type, json_extract(details, '$.description') AS description,
+                  json_extract(details, '$.category') AS category, created_at
+           FROM activity_log WHERE user_id = ? ORDER BY created_at DESC LIMIT 5""",
+        (user_id,))
+    recent_activities = [{
+        "type": activity['activity_type'],
+        "details": {"description": activity['description'], "category": activity['category']},
+        "timestamp": activity['created_at']
+    } for activity in recent_activities_raw]
 
     # --- START OF FIX: Data for Activity Chart ---
-    user_tz_str = session.get('timezone', 'UTC')
-    try:
-        user_tz = ZoneInfo(user_tz_str)
-    except ZoneInfoNotFoundError:
-        user_tz = ZoneInfo("UTC")
-
-    today = datetime.now(user_tz).date()
-    seven_days_ago = today - timedelta(days=6)
-
     # Use a dictionary with specific dates as keys to avoid ambiguity
     activity_counts = {}
     labels = []
     for i in range(7):
         current_date = seven_days_ago + timedelta(days=i)
         labels.append(current_date.strftime('%a'))
-        activity_counts[current_date] = 0
-
-    recent_logs = db.execute(
-        "SELECT created_at FROM activity_log WHERE user_id = ? AND date(created_at) >= ?",
-        (user_id, seven_days_ago.strftime('%Y-%m-%d'))
-    )
+        activity_counts[current_date.isoformat()] = 0
 
-    if recent_logs:
-        for log in recent_logs:
-            utc_dt = datetime.strptime(
-                log['created_at'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=ZoneInfo("UTC"))
-            # Get the date part in the user's local timezone
-            user_local_date = utc_dt.astimezone(user_tz).date()
-
-            # Increment the count for that specific date
-            if user_local_date in activity_counts:
-                activity_counts[user_local_date] += 1
+    daily_counts = db.execute(
+        """SELECT date(created_at, ?) AS local_day, COUNT(*) AS n FROM activity_log
+           WHERE user_id = ? AND created_at >= ? GROUP BY local_day""",
+        (offset, user_id, window_start_utc))
+    for row in daily_counts:
+        if row['local_day'] in activity_counts:
+            activity_counts[row['local_day']] = row['n']
 
     activity_data = {
         "labels": labels,
@@ -1770,17 +2522,11 @@ def dashboard(user):
     test_path_stats = stats.get("test_path", {})
     if test_path_stats.get("test_date"):
         try:
-            test_date = datetime.strptime(
-                test_path_stats["test_date"], '%Y-%m-%d').date()
-            try:
-                user_tz_str = session.get('timezone', 'UTC')
-                user_today = datetime.now(ZoneInfo(user_tz_str)).date()
-            except ZoneInfoNotFoundError:
-                user_today = date.today()
-            days_left = (test_date - user_today).days
+            date_str, days_left = _test_date_delta_on(
+                test_path_stats["test_date"], today)
             if days_left >= 0:
                 test_date_info["days_left"] = days_left
-                test_date_info["date_str"] = test_date.strftime('%B %d, %Y')
+                test_date_info["date_str"] = date_str
                 if test_path_stats.get("desired_sat"):
                     test_date_info["test_type"] = "SAT"
                 elif test_path_stats.get("desired_act"):
@@ -1789,49 +2535,20 @@ def dashboard(user):
             pass
 
     # --- EXPANDED Achievements Logic ---
-    all_achievements = [
-        {"id": "pioneer_test", "icon": "🚀", "title": "Test Prep Pioneer",
-            "description": "Generated your first Test Prep path.", "is_earned": False},
-        {"id": "planner_college", "icon": "🏛️", "title": "College Planner",
-            "description": "Generated your first College Planning path.", "is_earned": False},
-        {"id": "first_step", "icon": "✅", "title": "First Step",
-            "description": "Completed your first task.", "is_earned": False},
-        {"id": "task_master_10", "icon": "🔥", "title": "Task Master",
-            "description": "Completed 10 tasks.", "is_earned": False},
-        {"id": "pathfinder_pro_25", "icon": "🏆", "title": "Pathfinder Pro",
-            "description": "Completed 25 tasks.", "is_earned": False},
-        {"id": "streak_3", "icon": "⚡", "title": "On a Roll",
-            "description": "Maintained a 3-day streak.", "is_earned": False},
-        {"id": "streak_7", "icon": "🌟", "title": "Committed",
-            "description": "Maintained a 7-day streak.", "is_earned": False},
-        {"id": "points_100", "icon": "💯", "title": "Point Collector",
-            "description": "Earned 100 points.", "is_earned": False},
-        {"id": "points_500", "icon": "💎", "title": "Point Pro",
-            "description": "Earned 500 points.", "is_earned": False}
-    ]
-
     all_completed_tasks = total_test_prep_completed + total_college_planning_completed
-
-    if any(t['category'] == 'Test Prep' for t in all_tasks):
-        all_achievements[0]['is_earned'] = True
-    if any(t['category'] == 'College Planning' for t in all_tasks):
-        all_achievements[1]['is_earned'] = True
-    if all_completed_tasks >= 1:
-        all_achievements[2]['is_earned'] = True
-    if all_completed_tasks >= 10:
-        all_achievements[3]['is_earned'] = True
-    if all_completed_tasks >= 25:
-        all_achievements[4]['is_earned'] = True
-    if game_stats['streak'] >= 3:
-        all_achievements[5]['is_earned'] = True
-    if game_stats['streak'] >= 7:
-        all_achievements[6]['is_earned'] = True
-    if game_stats['points'] >= 100:
-        all_achievements[7]['is_earned'] = True
-    if game_stats['points'] >= 500:
-        all_achievements[8]['is_earned'] = True
-
-    earned_achievements = [a for a in all_achievements if a['is_earned']]
+    # One flag per entry in _ACHIEVEMENTS, in the same order
+    earned_flags = (
+        test_counts['total'] > 0,
+        college_counts['total'] > 0,
+        all_completed_tasks >= 1,
+        all_completed_tasks >= 10,
+        all_completed_tasks >= 25,
+        game_stats['streak'] >= 3,
+        game_stats['streak'] >= 7,
+        game_stats['points'] >= 100,
+        game_stats['points'] >= 500,
+    )
+    earned_achievements = _earned_achievements(earned_flags)
 
     return render_template(
         "dashboard.html",
@@ -1842,7 +2559,7 @@ def dashboard(user):
         sat_total=sat_total or "—",
         act_average=act_average or "—",
         recent_activities=recent_activities,
-        activity_data=json.dumps(activity_data),
+        activity_data=json_dumps(activity_data),
         test_date_info=test_date_info,
         earned_achievements=earned_achievements,
         game_stats=game_stats,
@@ -1869,8 +2586,9 @@ def account(user):
 
         elif form_type == 'email':
             new_email = request.form.get('email')
-            existing_user = db.select('users', where={'email': new_email})
-            if not existing_user or existing_user[0]['id'] == user.data['id']:
+            existing_user = db.select_one(
+                'users', columns=['id'], where={'email': new_email})
+            if not existing_user or existing_user['id'] == user.data['id']:
                 db.update('users', {'email': new_email},
                           {'id': user.data['id']})
                 session['user'] = new_email  # Update session
@@ -1880,7 +2598,9 @@ def account(user):
             new_password = request.form.get('new_password')
             confirm_password = request.form.get('confirm_password')
 
-            if check_password_hash(user.data['password'], current_password) and new_password == confirm_password:
+            # Cheap form checks first so a mistyped confirmation never pays for a hash verify
+            if new_password and new_password == confirm_password and current_password \
+                    and check_password_hash(user.data['password'], current_password):
                 hashed_password = generate_password_hash(new_password)
                 db.update('users', {'password': hashed_password}, {
                           'id': user.data['id']})
@@ -1889,27 +2609,39 @@ def account(user):
             if 'pfp' in request.files:
                 file = request.files['pfp']
                 if file.filename != '':
-                    # --- START: DELETE OLD PFP LOGIC (Corrected) ---
                     old_pfp_path = user.get_profile_picture()
+                    full_old_path = None
                     if old_pfp_path:
                         # Construct the absolute path from the app's root
                         base_dir = os.path.abspath(os.path.dirname(__file__))
                         full_old_path = os.path.join(
                             base_dir, old_pfp_path.lstrip('/'))
-                        if os.path.exists(full_old_path):
-                            os.remove(full_old_path)
-                    # --- END: DELETE OLD PFP LOGIC (Corrected) ---
 
-                    filename = secure_filename(file.filename)
-                    timestamp = int(datetime.now().timestamp())
-                    unique_filename = f"{user.data['id']}_{timestamp}_{filename}"
-                    filepath = os.path.join(
-                        app.config['UPLOAD_FOLDER'], unique_filename)
-                    file.save(filepath)
-
-                    db_filepath = f"/{app.config['UPLOAD_FOLDER']}/{unique_filename}"
-                    db.update('users', {'profile_picture': db_filepath}, {
-                              'id': user.data['id']})
+                    # Stream the upload to a temp file in 64 KB chunks, hashing as we go
+                    _ensure_upload_folder()
+                    tmp_path, digest = _stream_upload(
+                        file, app.config['UPLOAD_FOLDER'])
+
+                    if (digest == user.data.get('pfp_hash')
+                            and full_old_path and os.path.exists(full_old_path)):
+                        # Same image re-uploaded: keep the existing file and row
+                        os.remove(tmp_path)
+                    else:
+                        filename = secure_filename(file.filename)
+                        timestamp = int(datetime.now().timestamp())
+                        unique_filename = f"{user.data['id']}_{timestamp}_{filename}"
+                        filepath = os.path.join(
+                            app.config['UPLOAD_FOLDER'], unique_filename)
+                        os.replace(tmp_path, filepath)
+
+                        db_filepath = f"/{app.config['UPLOAD_FOLDER']}/{unique_filename}"
+                        db.update('users', {'profile_picture': db_filepath, 'pfp_hash': digest}, {
+                                  'id': user.data['id']})
+
+                        # Only remove the old picture once the new one is in place
+                        if full_old_path and full_old_path != os.path.abspath(filepath) \
+                                and os.path.exists(full_old_path):
+                            os.remove(full_old_path)
 
     user.load_user()
     return render_template('account.html', user=user, profile_picture=user.data.get('profile_picture'))
@@ -1995,36 +2727,15 @@ def college_path_view(user):
 def stats(user):
     stats = user.get_stats()
     user_id = user.data['id']
-    all_tasks = db.select("paths", where={"user_id": user_id})
+    task_counts = _get_task_counts(user_id)
 
     # --- SERVER-SIDE CALCULATION FIXES ---
-    # SAT Total
     sat_ebrw = stats.get("sat_ebrw")
     sat_math = stats.get("sat_math")
-    sat_total = None
-    if sat_ebrw and sat_math:
-        try:
-            sat_total = int(sat_ebrw) + int(sat_math)
-        except (ValueError, TypeError):
-            sat_total = None  # Handle case where values are not valid integers
-
-    # ACT Average
-    act_scores = []
-    if stats.get("act_math"):
-        act_scores.append(int(stats.get("act_math")))
-    if stats.get("act_reading"):
-        act_scores.append(int(stats.get("act_reading")))
-    if stats.get("act_science"):
-        act_scores.append(int(stats.get("act_science")))
+    sat_total, act_average = _key_stat_totals(stats)
 
-    act_average = None
-    if act_scores:
-        act_average = round(sum(act_scores) / len(act_scores))
-
-    total_test_prep_completed = sum(
-        1 for t in all_tasks if t['is_completed'] and t['category'] == 'Test Prep')
-    total_college_planning_completed = sum(
-        1 for t in all_tasks if t['is_completed'] and t['category'] == 'College Planning')
+    total_test_prep_completed = task_counts['Test Prep']['total_done']
+    total_college_planning_completed = task_counts['College Planning']['total_done']
 
     return render_template(
         "stats.html",
@@ -2055,14 +2766,17 @@ def edit_stats(user):
             "act_science": request.form.get("act_science", "")
         }
 
-        for key, value in updated_stats.items():
-            # Log an activity only if the value has changed
-            if stats.get(key) != value and value:
-                stats[key] = value
+        # Only non-empty values that actually changed are saved and logged
+        changes = [(key, value) for key, value in updated_stats.items()
+                   if value and stats.get(key) != value]
+        if changes:
+            stats.update(changes)
+            _refresh_key_stat_totals(stats)
+            user.set_stats(stats)
+            # These land in activity_writer's queue together and go out as one batch
+            for key, value in changes:
                 log_activity(user.data['id'], 'stat_updated', {
                              'stat_name': key.upper(), 'stat_value': value})
-
-        user.set_stats(stats)
         return redirect(url_for("stats"))
 
     return render_template(
@@ -2088,13 +2802,11 @@ def submit_quiz_results(user):
         return jsonify({"success": False, "error": "Invalid results format"}), 400
 
     user_id = user.data['id']
-    for result in results:
-        if 'question_id' in result and 'is_correct' in result:
-            db.insert('quiz_results', {
-                'user_id': user_id,
-                'question_id': result.get('question_id'),
-                'is_correct': result.get('is_correct')
-            })
+    db.insert_many('quiz_results', [{
+        'user_id': user_id,
+        'question_id': result.get('question_id'),
+        'is_correct': result.get('is_correct')
+    } for result in results if 'question_id' in result and 'is_correct' in result])
 
     return jsonify({"success": True})
 
@@ -2103,11 +2815,9 @@ def submit_quiz_results(user):
 @login_required
 def test_path_status(user):
     user_id = user.data['id']
-    # This query is optimized to be extremely fast. It stops looking after finding just one match.
-    query = "SELECT 1 FROM paths WHERE user_id=? AND is_active=True AND category='Test Prep' LIMIT 1"
-    # Use the new, highly efficient function from dbhelper
-    result = db.execute_for_one(query, (user_id,))
-    return jsonify({"has_path": bool(result)})
+    has_path = db.exists(
+        "paths", {"user_id": user_id, "is_active": True, "category": "Test Prep"})
+    return jsonify({"has_path": has_path})
 
 # Replace the OLD college_path_status function with this NEW version
 
@@ -2116,11 +2826,9 @@ def test_path_status(user):
 @login_required
 def college_path_status(user):
     user_id = user.data['id']
-    # This query is also optimized for speed.
-    query = "SELECT 1 FROM paths WHERE user_id=? AND is_active=True AND category='College Planning' LIMIT 1"
-    # Use the new, highly efficient function from dbhelper
-    result = db.execute_for_one(query, (user_id,))
-    return jsonify({"has_path": bool(result)})
+    has_path = db.exists(
+        "paths", {"user_id": user_id, "is_active": True, "category": "College Planning"})
+    return jsonify({"has_path": has_path})
 
 
 @app.route("/api/tasks", methods=['GET', 'POST'])
@@ -2130,49 +2838,48 @@ def api_tasks(user):
     stats = user.get_stats()
     category = request.args.get('category', 'Test Prep')
     try:
-        latest_task_query = """
-            SELECT created_at FROM paths
-            WHERE user_id=? AND category=? AND is_active=True
-            ORDER BY created_at DESC LIMIT 1
+        # Latest active batch in one round-trip, already in task order
+        active_path_query = """
+            WITH latest AS (
+                SELECT MAX(created_at) AS ts FROM paths
+                WHERE user_id=? AND category=? AND is_active=True
+            )
+            SELECT paths.* FROM paths, latest
+            WHERE user_id=? AND category=? AND is_active=True AND created_at = latest.ts
+            ORDER BY task_order
         """
-        latest_task_timestamp_result = db.execute(
-            latest_task_query, (user_id, category))
-
-        active_path = []
-        if latest_task_timestamp_result:
-            latest_timestamp = latest_task_timestamp_result[0]['created_at']
-            active_path = db.select(
-                "paths", where={
-                    "user_id": user_id,
-                    "is_active": True,
-                    "category": category,
-                    "created_at": latest_timestamp
-                })
+        active_path = db.execute(
+            active_path_query, (user_id, category, user_id, category))
 
         if request.method == "POST" or not active_path:
-            chat_record_list = db.select("chat_conversations", where={
-                "user_id": user_id, "category": category})
-            chat_history = json.loads(
-                chat_record_list[0]['history']) if chat_record_list else []
+            chat_history = _load_chat_history(user_id, category)
+            # A POST is the student asking to replace their current path
+            regenerate = request.method == "POST"
             if category == 'College Planning':
                 college_context = stats.get("college_path", {})
                 tasks = _generate_and_save_new_college_path(
-                    user_id, college_context, chat_history)
+                    user_id, college_context, chat_history, regenerate=regenerate)
             else:
                 test_path_info = stats.get("test_path", {})
                 tasks = _generate_and_save_new_test_path(
-                    user_id, test_path_info, chat_history)
+                    user_id, test_path_info, chat_history, regenerate=regenerate)
             return jsonify(tasks)
 
         if active_path:
-            active_path = sorted(active_path, key=lambda x: x['task_order'])
+            # Every subtask for the path in one query, bucketed by parent
+            task_ids = tuple(r['id'] for r in active_path)
+            placeholders = ', '.join(['?' for _ in task_ids])
+            subtasks_by_parent = defaultdict(list)
+            for s in db.execute(
+                    f"SELECT id, parent_task_id, description, is_completed FROM subtasks WHERE parent_task_id IN ({placeholders}) ORDER BY id",
+                    task_ids):
+                subtasks_by_parent[s['parent_task_id']].append(
+                    {"id": s['id'], "description": s['description'], "is_completed": bool(s['is_completed'])})
+
             tasks_with_subtasks = []
             for r in active_path:
                 task_id = r['id']
-                subtasks_raw = db.select(
-                    "subtasks", where={"parent_task_id": task_id})
-                subtasks = [{"id": s['id'], "description": s['description'],
-                             "is_completed": bool(s['is_completed'])} for s in subtasks_raw]
+                subtasks = subtasks_by_parent[task_id]
 
                 tasks_with_subtasks.append({
                     "id": task_id,
@@ -2211,21 +2918,8 @@ def get_quiz(user, task_id):
     if not quiz_details:
         return jsonify({"error": "Quiz details not found"}), 404
 
-    questions_raw = db.select("quiz_questions", where={"quiz_id": quiz_id})
-    questions = []
-    for q in questions_raw:
-        questions.append({
-            "id": q['id'],
-            "question_text": q['question_text'],
-            "options": json.loads(q['options']),
-            "correct_option": q['correct_option'],
-            "explanation": q['explanation']
-        })
-
-    return jsonify({
-        "title": quiz_details[0]['title'],
-        "questions": questions
-    })
+    return _question_set_response(
+        quiz_details[0]['title'], "quiz_questions", "quiz_id", quiz_id)
 
 
 @app.route("/api/update_task_status", methods=['POST'])
@@ -2237,17 +2931,18 @@ def api_update_task_status(user):
     task_id = data.get("taskId")
 
     if status == 'complete' and task_id:
-        task_info_list = db.select(
-            "paths", where={"id": task_id, "user_id": user_id})
-        # Check if not already completed
-        if task_info_list and not task_info_list[0]['is_completed']:
+        # Only flips a task that isn't completed yet, so a double submit can't award points twice
+        task_info_list = db.execute(
+            """UPDATE paths SET is_completed = TRUE
+               WHERE id = ? AND user_id = ? AND NOT is_completed
+               RETURNING description, category, type""",
+            (task_id, user_id))
+        if task_info_list:
             task_info = task_info_list[0]
             description = task_info['description']
             category = task_info['category']
             task_type = task_info['type']
 
-            db.update("paths", {"is_completed": True}, where={
-                      "id": task_id, "user_id": user_id})
             log_activity(user_id, 'task_completed', {
                          'description': description, 'category': category})
 
@@ -2256,37 +2951,22 @@ def api_update_task_status(user):
             if "boss battle" in description.lower():
                 points_to_add = 100
 
-            game_stats_row = db.select(
-                "gamification_stats", where={"user_id": user_id})[0]
-            game_stats = {
-                "points": game_stats_row['points'],
-                "streak": game_stats_row['current_streak'],
-                "last_date": game_stats_row['last_completed_date']
-            }
-
+            # One statement decides the streak in SQL, so two completions landing at
+            # once can't both read the old row. Same day keeps the streak, the day
+            # after extends it, anything else resets it to 1.
             today = date.today()
             yesterday = today - timedelta(days=1)
-            last_completed_date = None
-            if game_stats['last_date']:
-                last_completed_date = date.fromisoformat(
-                    game_stats['last_date'])
-
-            new_streak = game_stats['streak']
-            if last_completed_date == today:
-                # Already completed a task today, just add points
-                new_streak = game_stats['streak']
-            elif last_completed_date == yesterday:
-                # Continuing a streak
-                new_streak += 1
-            else:
-                # Reset streak
-                new_streak = 1
-
-            db.update("gamification_stats", {
-                "points": game_stats['points'] + points_to_add,
-                "current_streak": new_streak,
-                "last_completed_date": today.isoformat()
-            }, where={"user_id": user_id})
+            db.execute(
+                """INSERT INTO gamification_stats (user_id, points, current_streak, last_completed_date)
+                   VALUES (?, ?, 1, ?)
+                   ON CONFLICT(user_id) DO UPDATE SET
+                       points = points + excluded.points,
+                       current_streak = CASE last_completed_date
+                           WHEN excluded.last_completed_date THEN current_streak
+                           WHEN ? THEN current_streak + 1
+                           ELSE 1 END,
+                       last_completed_date = excluded.last_completed_date""",
+                (user_id, points_to_add, today.isoformat(), yesterday.isoformat()))
 
     return jsonify({"success": True})
 
@@ -2303,63 +2983,119 @@ def api_chat(user):
     if not history or (len(history) == 1 and history[0]['role'] == 'user' and history[0]['content'] == 'INITIAL_MESSAGE'):
         history = []
 
-    # Fetch tracker data for chat context
-    stat_history = _get_stat_history_for_prompt(user_id)
-
     user_message = history[-1]['content'].lower() if history else ""
     if "regenerate" in user_message or "new path" in user_message or "change" in user_message:
         if category == 'College Planning':
             college_context = stats.get("college_path", {})
             new_tasks = _generate_and_save_new_college_path(
-                user_id, college_context, chat_history=history)
+                user_id, college_context, chat_history=history, regenerate=True)
         else:
             test_path_info = stats.get("test_path", {})
             new_tasks = _generate_and_save_new_test_path(
-                user_id, test_path_info, chat_history=history)
+                user_id, test_path_info, chat_history=history, regenerate=True)
 
         if history:
-            history.append(
-                {"role": "assistant", "content": "I've generated a new path for you based on our conversation."})
-
-            # UPDATED LOGIC: Use upsert for simplicity and reliability
-            db.upsert("chat_conversations", {
-                "user_id": user_id,
-                "category": category,
-                "history": json.dumps(history)
-            }, conflict_target=["user_id", "category"])
+            _append_chat_turn(user_id, category, history,
+                              "I've generated a new path for you based on our conversation.")
 
         return jsonify({"new_path": new_tasks})
 
+    # Tracker data (and quiz/sprint results for test prep) for chat context. Each is a small
+    # indexed read, so they run inline rather than waiting on a shared pool.
+    stat_history = _get_stat_history_for_prompt(user_id)
     if category == 'College Planning':
         reply = _get_college_planning_ai_chat_response(
             history, stats, stat_history, user_id)
     else:
         reply = _get_test_prep_ai_chat_response(
-            history, stats, stat_history, user_id)
-
-    history.append({"role": "assistant", "content": reply})
+            history, stats, stat_history, _get_quiz_results_for_prompt(user_id),
+            _get_sprint_results_for_prompt(user_id), user_id=user_id)
 
-    # UPDATED LOGIC: Use upsert for simplicity and reliability
-    db.upsert("chat_conversations", {
-        "user_id": user_id,
-        "category": category,
-        "history": json.dumps(history)
-    }, conflict_target=["user_id", "category"])
+    _append_chat_turn(user_id, category, history, reply)
 
     return jsonify({"reply": reply})
 
 
+@app.route("/api/chat/stream", methods=['POST'])
+@login_required
+def api_chat_stream(user):
+    """Streams a chat reply as Server-Sent Events. Path regeneration still goes through /api/chat."""
+    user_id = user.data['id']
+    stats = user.get_stats()
+    data = request.get_json()
+    history = data.get("history", [])
+    category = request.args.get('category', 'Test Prep')
+
+    if not history or (len(history) == 1 and history[0]['role'] == 'user' and history[0]['content'] == 'INITIAL_MESSAGE'):
+        history = []
+
+    stat_history = _get_stat_history_for_prompt(user_id)
+    if category == 'College Planning':
+        chunks = iter([_get_college_planning_ai_chat_response(
+            history, stats, stat_history, user_id)])
+    else:
+        chunks = _stream_test_prep_ai_chat_response(
+            history, stats, stat_history, _get_quiz_results_for_prompt(user_id),
+            _get_sprint_results_for_prompt(user_id), user_id=user_id)
+
+    def event_stream():
+        reply_parts = []
+        for text in chunks:
+            reply_parts.append(text)
+            yield f"data: {json_dumps({'text': text})}\n\n"
+        _append_chat_turn(user_id, category, history, "".join(reply_parts))
+        yield "event: done\ndata: {}\n\n"
+
+    return Response(stream_with_context(event_stream()), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def _load_chat_history(user_id, category):
+    """Returns the conversation as a list of {role, content} dicts, oldest first."""
+    history = db.select("chat_messages", columns=["role", "content"], where={
+        "user_id": user_id, "category": category}, order_by="seq")
+    if history:
+        return history
+    # Conversations saved before chat_messages existed are still a single JSON blob
+    legacy = db.select_one("chat_conversations", columns=["history"], where={
+        "user_id": user_id, "category": category})
+    return json_loads(legacy['history']) if legacy else []
+
+
+def _append_chat_turn(user_id, category, history, reply):
+    """
+    Stores the newest user message from `history` (if any) and the assistant's reply.
+    Earlier messages are already in chat_messages, so a turn is two small inserts
+    instead of re-writing the whole conversation.
+    """
+    new_messages = [{"role": "assistant", "content": reply}]
+    if history and history[-1]['role'] == 'user':
+        new_messages.insert(0, history[-1])
+
+    with db.transaction():
+        next_seq = db.execute_for_one(
+            "SELECT COALESCE(MAX(seq) + 1, 0) AS next_seq FROM chat_messages WHERE user_id=? AND category=?",
+            (user_id, category))['next_seq']
+        if next_seq == 0:
+            # First turn since the switch: carry over a legacy blob, then drop it
+            legacy = db.select_one("chat_conversations", columns=["history"], where={
+                "user_id": user_id, "category": category})
+            if legacy:
+                new_messages = json_loads(legacy['history']) + new_messages
+                db.delete("chat_conversations", where={
+                          "user_id": user_id, "category": category})
+        db.insert_many("chat_messages", [
+            {"user_id": user_id, "category": category, "seq": next_seq + i,
+             "role": message['role'], "content": message['content']}
+            for i, message in enumerate(new_messages)])
+
+
 @app.route('/api/chat_history')
 @login_required
 def get_chat_history(user):
     user_id = user.data['id']
     category = request.args.get('category')
-    chat_record_list = db.select("chat_conversations", where={
-        "user_id": user_id, "category": category})
-    if chat_record_list:
-        history = json.loads(chat_record_list[0]['history'])
-        return jsonify(history)
-    return jsonify([])
+    return jsonify(_load_chat_history(user_id, category))
 
 
 @app.route('/api/reset_chat', methods=['POST'])
@@ -2371,8 +3107,11 @@ def reset_chat_history(user):
     if not category:
         return jsonify({"success": False, "error": "Category is required"}), 400
     try:
-        db.delete("chat_conversations", where={
-                  "user_id": user_id, "category": category})
+        with db.transaction():
+            db.delete("chat_messages", where={
+                      "user_id": user_id, "category": category})
+            db.delete("chat_conversations", where={
+                      "user_id": user_id, "category": category})
         return jsonify({"success": True})
     except Exception as e:
         print(f"Error resetting chat: {e}")
@@ -2390,15 +3129,19 @@ def api_update_stats(user):
         return jsonify({"success": False, "error": "Missing stat name or value"}), 400
 
     try:
-        # Always record in history
-        db.insert("stat_history", {
-            "user_id": user.data['id'], "stat_name": stat_name, "stat_value": stat_value
-        })
+        # Always record in history, and rewrite the prompt summary along with it
+        with db.transaction():
+            db.insert("stat_history", {
+                "user_id": user.data['id'], "stat_name": stat_name, "stat_value": stat_value
+            })
+            _refresh_stat_snapshot(user.data['id'])
+        _forget_stat_summary(user.data['id'])
 
         # Only update the main stats blob if it's not a temporary practice score
         if stat_name not in ["sat_total", "act_composite"]:
             stats = user.get_stats()
             stats[stat_name] = stat_value
+            _refresh_key_stat_totals(stats)
             user.set_stats(stats)
             # LOGGING for main stats
             log_activity(user.data['id'], 'stat_updated', {
@@ -2424,22 +3167,15 @@ def add_task(user):
     if not description or not category:
         return jsonify({"success": False, "error": "Description and category are required"}), 400
 
-    # Get the highest task order for the current active path
-    latest_task_query = "SELECT MAX(task_order) as max_order FROM paths WHERE user_id=? AND category=? AND is_active=True"
-    max_order_result = db.execute(latest_task_query, (user_id, category))
-    new_order = (max_order_result[0]['max_order'] or 0) + 1
-
-    task_id = db.insert("paths", {
-        "user_id": user_id,
-        "task_order": new_order,
-        "description": description,
-        "is_completed": False,
-        "is_active": True,
-        "type": "standard",  # User-added tasks are standard by default
-        "category": category,
-        "due_date": due_date,
-        "is_user_added": True
-    })
+    # The new task goes after the highest task order on the current active path. Working it out
+    # inside the INSERT saves a round-trip and keeps two quick adds from getting the same order.
+    # User-added tasks are standard by default.
+    task_id = db.execute(
+        """INSERT INTO paths (user_id, task_order, description, is_completed, is_active,
+                              type, category, due_date, is_user_added)
+           SELECT ?, COALESCE(MAX(task_order), 0) + 1, ?, False, True, 'standard', ?, ?, True
+           FROM paths WHERE user_id = ? AND category = ? AND is_active = True""",
+        (user_id, description, category, due_date, user_id, category))
 
     new_task = {
         "id": task_id, "description": description, "is_completed": False, "type": "standard",
@@ -2495,6 +3231,29 @@ def update_subtask(user):
 # --- NEW ESSAY ANALYSIS ROUTE (with more granular feedback) ---
 
 
+_ESSAY_PROMPT_HEAD = (
+    "You are an expert college admissions essay coach. Your goal is to provide constructive, actionable, and granular feedback on a student's essay. "
+    "Analyze the following essay written for the prompt: '"
+)
+_ESSAY_PROMPT_TAIL = (
+    "Provide feedback in the following structure, using markdown for formatting. **Crucially, when you identify a strength or an area for improvement, you MUST include a short, direct quote from the essay to illustrate your point.**\n\n"
+    "### Overall Impression\n"
+    "A brief, encouraging summary of your initial thoughts on the essay.\n\n"
+    "### Strengths\n"
+    "- **Clarity and Focus:** How well does the essay address the prompt? Is there a clear central theme? (Include a quote that demonstrates this strength.)\n"
+    "- **Voice and Tone:** Does the student's personality come through? Is the tone appropriate? (Include a quote that demonstrates this strength.)\n"
+    "- **Structure and Flow:** Is the essay well-organized with a logical progression of ideas? (Include a quote that demonstrates this strength.)\n\n"
+    "### Areas for Improvement\n"
+    "- **Introduction:** Does the opening hook the reader effectively? (Include the opening sentence(s) and suggest how to make it more engaging.)\n"
+    "- **Body Paragraphs:** Is there enough specific detail, reflection, and 'show, don't tell' examples? Are there areas that could be expanded or clarified? (Include a quote that could be improved.)\n"
+    "- **Conclusion:** Does the conclusion effectively summarize the main points and leave a lasting impression? (Include the concluding sentence(s) and suggest how to make it more impactful.)\n"
+    "- **Grammar and Mechanics:** Note any recurring grammatical errors, awkward phrasing, or typos, but do not rewrite the essay. (Include a quote with an error and explain the correction.)\n\n"
+    "### Actionable Next Steps\n"
+    "1.  Provide the student with 2-3 specific, concrete steps they can take to improve their next draft.\n"
+    "2.  Keep the feedback encouraging and constructive."
+)
+
+
 @app.route('/api/analyze_essay', methods=['POST'])
 @login_required
 def analyze_essay(user):
@@ -2506,36 +3265,41 @@ def analyze_essay(user):
     if not essay_text:
         return jsonify({"error": "Essay text is required."}), 400
 
-    prompt = (
-        f"You are an expert college admissions essay coach. Your goal is to provide constructive, actionable, and granular feedback on a student's essay. "
-        f"Analyze the following essay written for the prompt: '{essay_prompt}'.\n\n"
-        f"Essay Text:\n\"\"\"\n{essay_text}\n\"\"\"\n\n"
-        f"Provide feedback in the following structure, using markdown for formatting. **Crucially, when you identify a strength or an area for improvement, you MUST include a short, direct quote from the essay to illustrate your point.**\n\n"
-        f"### Overall Impression\n"
-        f"A brief, encouraging summary of your initial thoughts on the essay.\n\n"
-        f"### Strengths\n"
-        f"- **Clarity and Focus:** How well does the essay address the prompt? Is there a clear central theme? (Include a quote that demonstrates this strength.)\n"
-        f"- **Voice and Tone:** Does the student's personality come through? Is the tone appropriate? (Include a quote that demonstrates this strength.)\n"
-        f"- **Structure and Flow:** Is the essay well-organized with a logical progression of ideas? (Include a quote that demonstrates this strength.)\n\n"
-        f"### Areas for Improvement\n"
-        f"- **Introduction:** Does the opening hook the reader effectively? (Include the opening sentence(s) and suggest how to make it more engaging.)\n"
-        f"- **Body Paragraphs:** Is there enough specific detail, reflection, and 'show, don't tell' examples? Are there areas that could be expanded or clarified? (Include a quote that could be improved.)\n"
-        f"- **Conclusion:** Does the conclusion effectively summarize the main points and leave a lasting impression? (Include the concluding sentence(s) and suggest how to make it more impactful.)\n"
-        f"- **Grammar and Mechanics:** Note any recurring grammatical errors, awkward phrasing, or typos, but do not rewrite the essay. (Include a quote with an error and explain the correction.)\n\n"
-        f"### Actionable Next Steps\n"
-        f"1.  Provide the student with 2-3 specific, concrete steps they can take to improve their next draft.\n"
-        f"2.  Keep the feedback encouraging and constructive."
-    )
+    # Only the student's prompt and essay change between requests; join them between the constant parts once
+    prompt = "".join((_ESSAY_PROMPT_HEAD, essay_prompt, "'.\n\nEssay Text:\n\"\"\"\n",
+                      essay_text, "\n\"\"\"\n\n", _ESSAY_PROMPT_TAIL))
 
     try:
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        response = model.generate_content(prompt)
-        return jsonify({"feedback": response.text})
+        feedback = _cached_generate(prompt, user.data['id'])
+        if feedback is None:
+            return jsonify({"error": "Too many essay reviews in a short time. Please wait a minute and try again."}), 429
+        return jsonify({"feedback": feedback})
     except Exception as e:
         print(f"Error in essay analysis: {e}")
         return jsonify({"error": "Failed to analyze the essay."}), 500
 
 
+_SUGGESTION_PROMPT = Template(
+    "You are an AI mentor for a high school student, acting as a supportive coach. Your task is to provide one, single, non-task-based suggestion that serves as a progress check-in, a gentle reminder, or a mental state booster. Your tone should be encouraging, insightful, and focused on the student's overall well-being and journey, not just their immediate to-do list.\n\n"
+    "Analyze the user's data to find a pattern or a key insight:\n"
+    "- Onboarding Goal: $goal\n"
+    "- Onboarding Anxieties: $anxieties\n"
+    "- Current GPA: $gpa\n"
+    "- SAT Math: $sat_math\n"
+    "- SAT EBRW: $sat_ebrw\n"
+    "- ACT Composite: $act_composite\n"
+    "- Day Streak: $streak\n"
+    "- Last 5 Completed Tasks: $completed_tasks\n"
+    "- Stat History:\n$stat_history\n\n"
+    "Based on this data, provide one concise and encouraging insight. **Do not suggest a new task.** Instead, focus on motivation, strategy, and well-being. Here are some examples of the tone and style you should adopt:\n"
+    "- (If streak is high): 'A $streak-day streak is amazing! That consistency is what builds success. Keep up the great momentum.'\n"
+    "- (If a score dipped): 'I noticed your last SAT Math score was a little lower. That's a normal part of the process! It's a great opportunity to review your notes and see what you can learn from it.'\n"
+    "- (If anxieties were about time management): 'Remember when you said you were worried about time management? You've been consistently completing tasks. That shows real progress in building good habits.'\n"
+    "- (If no recent activity): 'Just checking in! Remember that even small steps forward are still steps. You've got this.'\n\n"
+    "Your response must be a single, encouraging sentence or two."
+)
+
+
 def _get_proactive_ai_suggestions(user):
     """Generates a proactive suggestion for the user based on their data."""
     if not os.getenv("GEMINI_API_KEY"):
@@ -2543,106 +3307,175 @@ def _get_proactive_ai_suggestions(user):
 
     user_id = user.data['id']
     stats = user.get_stats()
-    onboarding_data = json.loads(
-        user.data['onboarding_data']) if user.data['onboarding_data'] else {}
+    onboarding_data = user.get_onboarding_data()
+    # Stat history has its own memoized helper
     stat_history = _get_stat_history_for_prompt(user_id)
-
-    gamification_stats_list = db.select(
-        "gamification_stats", where={"user_id": user_id})
-    gamification_stats = gamification_stats_list[0] if gamification_stats_list else {
-    }
-
-    # Get last 5 completed tasks
-    completed_tasks_raw = db.select(
-        "activity_log",
-        where={"user_id": user_id, "activity_type": "task_completed"},
-        order_by="created_at DESC LIMIT 5"
-    )
-    completed_tasks = [json.loads(task['details'])['description']
-                       for task in completed_tasks_raw]
-
-    prompt = (
-        f"You are an AI mentor for a high school student, acting as a supportive coach. Your task is to provide one, single, non-task-based suggestion that serves as a progress check-in, a gentle reminder, or a mental state booster. Your tone should be encouraging, insightful, and focused on the student's overall well-being and journey, not just their immediate to-do list.\n\n"
-        f"Analyze the user's data to find a pattern or a key insight:\n"
-        f"- Onboarding Goal: {onboarding_data.get('goal', 'Not specified')}\n"
-        f"- Onboarding Anxieties: {onboarding_data.get('anxieties', 'Not specified')}\n"
-        f"- Current GPA: {stats.get('gpa', 'N/A')}\n"
-        f"- SAT Math: {stats.get('sat_math', 'N/A')}\n"
-        f"- SAT EBRW: {stats.get('sat_ebrw', 'N/A')}\n"
-        f"- ACT Composite: {stats.get('act_average', 'N/A')}\n"
-        f"- Day Streak: {gamification_stats.get('current_streak', 0)}\n"
-        f"- Last 5 Completed Tasks: {', '.join(completed_tasks) if completed_tasks else 'None'}\n"
-        f"- Stat History:\n{stat_history}\n\n"
-        f"Based on this data, provide one concise and encouraging insight. **Do not suggest a new task.** Instead, focus on motivation, strategy, and well-being. Here are some examples of the tone and style you should adopt:\n"
-        f"- (If streak is high): 'A {gamification_stats.get('current_streak', 0)}-day streak is amazing! That consistency is what builds success. Keep up the great momentum.'\n"
-        f"- (If a score dipped): 'I noticed your last SAT Math score was a little lower. That's a normal part of the process! It's a great opportunity to review your notes and see what you can learn from it.'\n"
-        f"- (If anxieties were about time management): 'Remember when you said you were worried about time management? You've been consistently completing tasks. That shows real progress in building good habits.'\n"
-        f"- (If no recent activity): 'Just checking in! Remember that even small steps forward are still steps. You've got this.'\n\n"
-        f"Your response must be a single, encouraging sentence or two."
+    # Streak and the descriptions of the last 5 completed tasks in one round-trip
+    context = db.execute_for_one(
+        """
+        SELECT
+            (SELECT current_streak FROM gamification_stats WHERE user_id = ?) AS current_streak,
+            (SELECT json_group_array(json_extract(details, '$.description')) FROM (
+                SELECT details FROM activity_log
+                WHERE user_id = ? AND activity_type = 'task_completed'
+                ORDER BY created_at DESC LIMIT 5
+            )) AS completed_tasks
+        """, (user_id, user_id))
+    gamification_stats = {"current_streak": context['current_streak'] or 0}
+    completed_tasks = [description for description in json_loads(
+        context['completed_tasks']) if description]
+
+    prompt = _SUGGESTION_PROMPT.substitute(
+        goal=onboarding_data.get('goal', 'Not specified'),
+        anxieties=onboarding_data.get('anxieties', 'Not specified'),
+        gpa=stats.get('gpa', 'N/A'),
+        sat_math=stats.get('sat_math', 'N/A'),
+        sat_ebrw=stats.get('sat_ebrw', 'N/A'),
+        act_composite=stats.get('act_average', 'N/A'),
+        streak=gamification_stats.get('current_streak', 0),
+        completed_tasks=', '.join(completed_tasks) if completed_tasks else 'None',
+        stat_history=stat_history
     )
 
     try:
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        response = model.generate_content(prompt)
-        return response.text.strip()
+        # Keyed on the day too, so an unchanged dashboard gets at most one new suggestion per day
+        suggestion = _cached_generate(
+            prompt, user_id, cache_key=f"proactive_suggestion:{user_id}:{date.today().isoformat()}\n{prompt}")
+        if suggestion is not None:
+            return suggestion.strip()
     except Exception as e:
         print(f"Error in proactive suggestion generation: {e}")
-        return "Welcome to Mentics! Let's get started on your path to success."
+    return "Welcome to Mentics! Let's get started on your path to success."
 
 
 # --- NEW SOCIAL ROUTES ---
+# The top 10 is the same for everyone, so each worker reuses it for a short while
+_LEADERBOARD_TTL_SECONDS = 30
+_leaderboard_cache = {"expires_at": 0, "data": None}
+_leaderboard_lock = threading.Lock()
+
+
+def _get_leaderboard():
+    now = time.monotonic()
+    if _leaderboard_cache["expires_at"] > now:
+        return _leaderboard_cache["data"]
+    with _leaderboard_lock:
+        # Another thread may have refreshed it while we waited for the lock
+        if _leaderboard_cache["expires_at"] > now:
+            return _leaderboard_cache["data"]
+        # Fetch top 10 users by points
+        data = tuple(db.execute(
+            """
+            SELECT u.name, g.points
+            FROM gamification_stats g
+            JOIN users u ON g.user_id = u.id
+            ORDER BY g.points DESC
+            LIMIT 10
+            """
+        ))
+        _leaderboard_cache["data"] = data
+        _leaderboard_cache["expires_at"] = time.monotonic() + _LEADERBOARD_TTL_SECONDS
+        return data
+
+
 @app.route('/leaderboard')
 @login_required
 def leaderboard(user):
-    # Fetch top 10 users by points
-    leaderboard_data = db.execute(
-        """
-        SELECT u.name, g.points
-        FROM gamification_stats g
-        JOIN users u ON g.user_id = u.id
-        ORDER BY g.points DESC
-        LIMIT 10
-        """
-    )
-    return render_template('leaderboard.html', leaderboard=leaderboard_data)
+    return render_template('leaderboard.html', leaderboard=_get_leaderboard())
+
+
+_FORUM_PAGE_SIZE = 25
+# Shorter searches match nearly every post as a prefix, so they're rejected before touching the DB
+_FORUM_MIN_SEARCH_LENGTH = 3
+# Each post's replies as a JSON array, oldest first, nested by SQLite in the same query
+_FORUM_REPLIES_COLUMN = """
+    (SELECT json_group_array(json_object(
+        'id', r.id, 'post_id', r.post_id, 'user_id', r.user_id,
+        'user_name', r.user_name, 'content', r.content, 'created_at', r.created_at))
+     FROM (SELECT * FROM forum_replies WHERE post_id = p.id ORDER BY created_at) AS r) AS replies_json
+"""
+
+
+def _forum_match_query(search_query):
+    """
+    Turns free text from the search box into an FTS5 query: every word has to appear,
+    matched as a word prefix. Quotes are dropped so user input can't break the MATCH syntax.
+    """
+    terms = search_query.replace('"', ' ').split()
+    return " ".join(f'"{term}"*' for term in terms)
 
 
 @app.route('/forum')
 @login_required
 def forum(user):
-    search_query = request.args.get('search', '')
-
-    # Base query for posts
-    post_query = "SELECT * FROM forum_posts"
-    params = []
-
-    if search_query:
-        post_query += " WHERE title LIKE ?"
-        params.append(f"%{search_query}%")
+    search_query = request.args.get('search', '').strip()
+    search_too_short = 0 < len(search_query) < _FORUM_MIN_SEARCH_LENGTH
 
-    post_query += " ORDER BY created_at DESC"
-    posts_raw = db.execute(post_query, tuple(params))
-    posts = [dict(row) for row in posts_raw]
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    # One extra row tells us whether there is a next page
+    page_limit, page_offset = _FORUM_PAGE_SIZE + 1, (page - 1) * _FORUM_PAGE_SIZE
+    if search_too_short:
+        # No posts to list, but the query below still returns today's threads
+        page_limit = 0
+
+    # One statement returns this page of posts and today's threads, flagged per row.
+    # Today's threads aren't filtered by the search or the page, so they're kept either way.
+    # "Today" is a created_at range rather than date(created_at) so idx_forum_posts_created serves it.
+    today = date.today()
+    today_start = today.strftime('%Y-%m-%d')
+    tomorrow_start = (today + timedelta(days=1)).strftime('%Y-%m-%d')
+    match_query = None if search_too_short else _forum_match_query(search_query)
+    if match_query:
+        # Search goes through the FTS index; matches come back best-ranked first
+        rows = db.execute(
+            """
+            WITH hits AS (
+                SELECT rowid AS id, bm25(forum_posts_fts) AS score FROM forum_posts_fts
+                WHERE forum_posts_fts MATCH ?
+                ORDER BY score LIMIT ? OFFSET ?
+            )
+            SELECT p.*, (p.created_at >= ? AND p.created_at < ?) AS is_today, (hits.id IS NOT NULL) AS is_match,
+                {replies_column}
+            FROM forum_posts p LEFT JOIN hits ON hits.id = p.id
+            WHERE hits.id IS NOT NULL OR (p.created_at >= ? AND p.created_at < ?)
+            ORDER BY hits.score IS NULL, hits.score, p.created_at DESC
+            """.format(replies_column=_FORUM_REPLIES_COLUMN),
+            (match_query, page_limit, page_offset, today_start, tomorrow_start, today_start, tomorrow_start))
+    else:
+        rows = db.execute(
+            """
+            WITH page AS (
+                SELECT id FROM forum_posts ORDER BY created_at DESC LIMIT ? OFFSET ?
+            )
+            SELECT p.*, (p.created_at >= ? AND p.created_at < ?) AS is_today, (p.id IN page) AS is_match,
+                {replies_column}
+            FROM forum_posts p
+            WHERE p.id IN page OR (p.created_at >= ? AND p.created_at < ?)
+            ORDER BY p.created_at DESC
+            """.format(replies_column=_FORUM_REPLIES_COLUMN),
+            (page_limit, page_offset, today_start, tomorrow_start, today_start, tomorrow_start))
+    posts = [row for row in rows if row['is_match']]
+    has_next_page = len(posts) > _FORUM_PAGE_SIZE
+    posts = posts[:_FORUM_PAGE_SIZE]
+    todays_threads = [row for row in rows if row['is_today']]
+    if match_query:
+        # The sidebar stays newest first even when the main list is ranked
+        todays_threads.sort(key=lambda row: row['created_at'], reverse=True)
 
-    # Fetch replies for each post
-    posts_with_replies = []
     for post in posts:
-        replies_raw = db.select("forum_replies", where={
-                                "post_id": post['id']}, order_by="created_at ASC")
-        post['replies'] = [dict(reply) for reply in replies_raw]
-        posts_with_replies.append(post)
-
-    # Fetch today's threads
-    today_str = date.today().strftime('%Y-%m-%d')
-    todays_threads_raw = db.execute(
-        "SELECT * FROM forum_posts WHERE date(created_at) = ? ORDER BY created_at DESC", (today_str,))
-    todays_threads = [dict(row) for row in todays_threads_raw]
+        post['replies'] = json_loads(post['replies_json'])
 
     return render_template('forum.html',
-                           posts=posts_with_replies,
+                           posts=posts,
                            user_name=user.get_name(),
                            todays_threads=todays_threads,
-                           search_query=search_query)
+                           search_query=search_query,
+                           search_too_short=search_too_short,
+                           page=page,
+                           has_next_page=has_next_page)
 
 
 @app.route('/api/posts', methods=['POST'])
@@ -2652,12 +3485,10 @@ def create_post(user):
     title = data.get('title')
     content = data.get('content')
     if title and content:
-        db.insert('forum_posts', {
-            'user_id': user.data['id'],
-            'user_name': user.get_name(),
-            'title': title,
-            'content': content
-        })
+        saved = forum_post_writer.put(
+            (user.data['id'], user.get_name(), title, content), wait=True)
+        if not saved:
+            return jsonify({'success': False, 'error': 'Could not save your post'}), 500
         return jsonify({'success': True})
     return jsonify({'success': False, 'error': 'Title and content are required'}), 400
 
@@ -2669,12 +3500,10 @@ def create_reply(user):
     post_id = data.get('post_id')
     content = data.get('content')
     if post_id and content:
-        db.insert('forum_replies', {
-            'post_id': post_id,
-            'user_id': user.data['id'],
-            'user_name': user.get_name(),
-            'content': content
-        })
+        saved = forum_reply_writer.put(
+            (post_id, user.data['id'], user.get_name(), content), wait=True)
+        if not saved:
+            return jsonify({'success': False, 'error': 'Could not save your reply'}), 500
         return jsonify({'success': True})
     return jsonify({'success': False, 'error': 'Post ID and content are required'}), 400
 
@@ -2700,15 +3529,41 @@ else:
 
 # Initialize the database handler with the correct path
 db = DatabaseHandler(DB_PATH)
+
+
+def _embed_for_cache(text):
+    result = genai.embed_content(
+        model="models/text-embedding-004", content=text[:8000])
+    return result['embedding']
+
+
+# Exact + semantic cache in front of the Gemini calls
+llm_cache = LLMCache(db, embed_fn=_embed_for_cache)
+# Batches activity_log inserts (see log_activity)
+activity_writer = BufferedWriter(
+    db, "INSERT INTO activity_log (user_id, activity_type, details, created_at) VALUES (?, ?, ?, ?)")
+# Forum posts and replies made at about the same time share one commit. The routes wait
+# for their batch (put(..., wait=True)), so a reload right after posting shows the new row.
+forum_post_writer = BufferedWriter(
+    db, "INSERT INTO forum_posts (user_id, user_name, title, content) VALUES (?, ?, ?, ?)", flush_interval=0.02)
+forum_reply_writer = BufferedWriter(
+    db, "INSERT INTO forum_replies (post_id, user_id, user_name, content) VALUES (?, ?, ?, ?)", flush_interval=0.02)
 # --- Auto-Create AND Migrate Database on Startup ---
-# This block now runs on every deployment, ensuring the database schema is up-to-date.
-with app.app_context():
-    print(f"Connecting to database at {DB_PATH}...")
-    try:
-        # This will now create tables if they don't exist AND add the new columns if they are missing.
-        init_db()
-        print("Database schema check complete. All tables and columns are present.")
-    except Exception as e:
-        print(f"!!! CRITICAL: FAILED TO INITIALIZE OR MIGRATE DATABASE: {e}")
+# Every gunicorn worker imports this module, so the full schema pass only runs when the
+# database is behind SCHEMA_VERSION; otherwise startup is a single PRAGMA read.
+# Set MENTICS_AUTO_MIGRATE=0 to skip this entirely and run `flask --app app init-db` once per deploy.
+if os.environ.get("MENTICS_AUTO_MIGRATE", "1") == "1":
+    with app.app_context():
+        print(f"Connecting to database at {DB_PATH}...")
+        try:
+            schema_version = db.execute("PRAGMA user_version;")[0]['user_version']
+            if schema_version == SCHEMA_VERSION:
+                print("Database schema is up to date.")
+            else:
+                # This will now create tables if they don't exist AND add the new columns if they are missing.
+                init_db()
+                print("Database schema check complete. All tables and columns are present.")
+        except Exception as e:
+            print(f"!!! CRITICAL: FAILED TO INITIALIZE OR MIGRATE DATABASE: {e}")
 if __name__ == "__main__":
     app.run(debug=True)
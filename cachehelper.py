@@ -0,0 +1,98 @@
+# MENTICS/cachehelper.py
+
+import hashlib
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class LLMCache:
+    """
+    Two-tier cache for Gemini responses.
+    L1: exact match on the SHA-256 of the full prompt text.
+    L2: semantic match on an embedding (cosine similarity), scoped to a namespace. Callers
+        pass semantic_text with just the student-specific part of the prompt, since a long
+        shared prefix makes unrelated prompts look alike.
+    """
+
+    # Expired rows are never served, so they only need sweeping out now and then
+    PRUNE_INTERVAL_SECONDS = 3600
+
+    def __init__(self, db, embed_fn=None, ttl=timedelta(days=7), threshold=0.92):
+        self.db = db
+        self.embed_fn = embed_fn
+        self.ttl = ttl
+        self.threshold = threshold
+        self._next_prune = 0
+
+    @staticmethod
+    def _hash(prompt):
+        return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+    def _cutoff(self):
+        # Matches SQLite's CURRENT_TIMESTAMP format so the comparison is a plain string compare
+        return (datetime.now(timezone.utc) - self.ttl).strftime('%Y-%m-%d %H:%M:%S')
+
+    def _embed(self, prompt):
+        if not self.embed_fn:
+            return None
+        try:
+            vector = np.asarray(self.embed_fn(prompt), dtype=np.float32)
+        except Exception as e:
+            logger.warning("LLM cache: embedding failed, skipping semantic lookup: %s", e)
+            return None
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def get(self, prompt):
+        """Exact-match lookup only. Returns the cached response for this prompt, or None on a miss."""
+        row = self.db.select_one(
+            "llm_cache", columns=["response", "created_at"], where={"prompt_hash": self._hash(prompt)})
+        if row and row['created_at'] >= self._cutoff():
+            return row['response']
+        return None
+
+    def lookup(self, prompt, namespace, semantic_text, semantic=True):
+        """
+        Exact match on prompt, then a semantic match on semantic_text within the namespace.
+        Returns (response, embedding): response is None on a miss, and embedding is the vector
+        computed for the semantic lookup (or None) so put() can store it without embedding again.
+        With semantic=False the similarity match is skipped but the embedding is still returned,
+        so an explicit regeneration gets a fresh response that later lookups can match.
+        """
+        response = self.get(prompt)
+        if response is not None or not namespace:
+            return response, None
+
+        # Semantic lookups are always scoped (e.g. per user) so one student can never see another's response
+        query_vec = self._embed(semantic_text)
+        if query_vec is None or not semantic:
+            return None, query_vec
+        candidates = self.db.execute(
+            "SELECT response, embedding FROM llm_cache WHERE namespace=? AND created_at >= ? AND embedding IS NOT NULL",
+            (namespace, self._cutoff()))
+        if not candidates:
+            return None, query_vec
+        matrix = np.stack([np.frombuffer(c['embedding'], dtype=np.float32)
+                           for c in candidates])
+        scores = matrix @ query_vec
+        best = int(np.argmax(scores))
+        if scores[best] >= self.threshold:
+            return candidates[best]['response'], query_vec
+        return None, query_vec
+
+    def put(self, prompt, response, namespace=None, embedding=None):
+        """Stores a response. Pass the embedding returned by lookup() to make it a semantic match candidate."""
+        self.db.execute(
+            "INSERT OR REPLACE INTO llm_cache (prompt_hash, namespace, response, embedding) VALUES (?, ?, ?, ?)",
+            (self._hash(prompt), namespace, response, None if embedding is None else embedding.tobytes()))
+        now = time.monotonic()
+        if now >= self._next_prune:
+            self._next_prune = now + self.PRUNE_INTERVAL_SECONDS
+            # Range scan on idx_llm_cache_created
+            self.db.execute(
+                "DELETE FROM llm_cache WHERE created_at < ?", (self._cutoff(),))
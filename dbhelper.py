@@ -1,31 +1,141 @@
 # MENTICS/dbhelper.py
 
+import atexit
+import logging
+import os
+import queue
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+
+# Applied to every new connection (these settings don't persist in the database file)
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",  # Safe with WAL; fsyncs at checkpoints instead of every commit
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",  # 256 MB
+    "PRAGMA cache_size=-65536",  # 64 MB
+    "PRAGMA foreign_keys=ON",
+)
+
+# sqlite3 keeps this many prepared statements per connection, keyed by SQL text.
+# The app has more distinct queries than the default of 128, so the hot ones were being evicted.
+STATEMENT_CACHE_SIZE = 512
+
+
+@lru_cache(maxsize=256)
+def _insert_sql(table_name, cols):
+    """
+    Builds the INSERT text for a table and column tuple once. sqlite3 keeps a per-connection
+    cache of prepared statements keyed by SQL text, so identical strings also skip re-parsing.
+    """
+    placeholders = ', '.join(['?' for _ in cols])
+    return f"INSERT INTO {table_name} ({', '.join(cols)}) VALUES ({placeholders})"
+
+
+def _rows_as_dicts(cursor):
+    """
+    Fetches every remaining row as a dict. Zipping plain tuples with the column names once
+    is cheaper than building a sqlite3.Row per row and then copying it into a dict.
+    """
+    cols = [d[0] for d in cursor.description]
+    return [dict(zip(cols, row)) for row in cursor.fetchall()]
+
+
+def _row_as_dict(cursor):
+    """Fetches the next row as a dict, or None when there isn't one."""
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return dict(zip([d[0] for d in cursor.description], row))
 
 
 class DatabaseHandler:
     def __init__(self, db_name):
         self.db_name = db_name
+        # Each thread keeps its own connection open and reuses it for every call
+        self._local = threading.local()
+        # WAL lets readers keep going while a write is in progress. It is stored in the
+        # database file, so setting it once here covers every later connection.
+        try:
+            conn = sqlite3.connect(self.db_name, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.close()
+        except sqlite3.Error as e:
+            logger.warning("Could not enable WAL mode for %s: %s", self.db_name, e)
+
+    def _connect(self):
+        # Autocommit mode: single statements commit on their own and
+        # multi-statement writes go through transaction()
+        conn = sqlite3.connect(self.db_name, timeout=10, isolation_level=None,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _get_connection(self):
+        """Returns this thread's connection, opening it on first use."""
+        conn = getattr(self._local, "conn", None)
+        # A connection opened before a fork (e.g. gunicorn --preload running init_db)
+        # must not be shared with the child, so each process opens its own
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._connect()
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            self._local.in_transaction = False
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        yield self._get_connection()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs every call made inside the block as one transaction and commits once on exit.
+        Rolls back if the block raises. Nested blocks join the outer transaction.
+        """
+        if getattr(self._local, "in_transaction", False):
+            yield
+            return
+        conn = self._get_connection()
+        # Take the write lock up front so the block can't fail halfway on a busy database
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.in_transaction = True
+        try:
+            yield
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            self._local.in_transaction = False
+
+    def close(self):
+        """Closes the calling thread's connection; the next call opens a fresh one."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            self._local.conn = None
+            conn.close()
 
     def execute(self, query, params=None):
-        conn = sqlite3.connect(self.db_name, timeout=10)
-        conn.row_factory = sqlite3.Row  # This is the key change
-        c = conn.cursor()
-        if params:
-            c.execute(query, params)
-        else:
-            c.execute(query)
-        verb = query.strip().lower().split()[0]
-        if verb == "select":
-            result = [dict(row)
-                      for row in c.fetchall()]  # Return list of dicts
-        elif verb == "insert":
-            result = c.lastrowid
-        else:
-            result = None
-        conn.commit()
-        conn.close()
-        return result
+        with self._connection() as conn:
+            c = conn.cursor()
+            if params:
+                c.execute(query, params)
+            else:
+                c.execute(query)
+            # Anything that yields rows (SELECT, WITH ... SELECT, INSERT ... RETURNING) comes back as dicts
+            if c.description is not None:
+                return _rows_as_dicts(c)  # Return list of dicts
+            verb = query.strip().lower().split()[0]
+            if verb == "insert":
+                return c.lastrowid
+            return None
 
     def create_table(self, table_name, columns):
         """
@@ -50,11 +160,31 @@ class DatabaseHandler:
         """
         data: dict of column_name: value
         """
-        cols = ', '.join(data.keys())
-        placeholders = ', '.join(['?' for _ in data])
-        query = f"INSERT INTO {table_name} ({cols}) VALUES ({placeholders})"
+        query = _insert_sql(table_name, tuple(data.keys()))
         return self.execute(query, tuple(data.values()))
 
+    def executemany(self, query, seq_of_params):
+        # One transaction for the whole batch instead of one commit per row
+        with self.transaction(), self._connection() as conn:
+            conn.executemany(query, seq_of_params)
+
+    def insert_many(self, table_name, rows):
+        """
+        rows: list of dicts with the same keys
+        Inserts all rows with one executemany and returns their new ids, in order.
+        """
+        if not rows:
+            return []
+        cols = tuple(rows[0].keys())
+        query = _insert_sql(table_name, cols)
+        params = [tuple(row[col] for col in cols) for row in rows]
+        # Inside one write transaction nothing else can insert in between, so the
+        # new rowids are the contiguous range ending at last_insert_rowid()
+        with self.transaction(), self._connection() as conn:
+            conn.executemany(query, params)
+            last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+        return list(range(last_id - len(rows) + 1, last_id + 1))
+
     def update(self, table_name, data, where):
         """
         data: dict of column_name: value
@@ -74,11 +204,12 @@ class DatabaseHandler:
         query = f"DELETE FROM {table_name} WHERE {where_clause}"
         self.execute(query, tuple(where.values()))
 
-    def select(self, table_name, columns='*', where=None, order_by=None):
+    def select(self, table_name, columns='*', where=None, order_by=None, limit=None):
         """
         columns: list or str
         where: dict of column_name: value for WHERE clause
         order_by: str column name to order by
+        limit: max number of rows to return
         """
         if isinstance(columns, list):
             cols = ', '.join(columns)
@@ -92,6 +223,9 @@ class DatabaseHandler:
             params = tuple(where.values())
         if order_by:
             query += f" ORDER BY {order_by}"
+        if limit is not None:
+            query += " LIMIT ?"
+            params += (limit,)
         return self.execute(query, params)
 
     # NEW: Upsert method for chat history
@@ -122,19 +256,15 @@ class DatabaseHandler:
         Executes a query and fetches only the first result.
         This is much more efficient for existence checks.
         """
-        conn = sqlite3.connect(self.db_name, timeout=10)
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        if params:
-            c.execute(query, params)
-        else:
-            c.execute(query)
-
-        # Use fetchone() for maximum efficiency
-        row = c.fetchone()
+        with self._connection() as conn:
+            c = conn.cursor()
+            if params:
+                c.execute(query, params)
+            else:
+                c.execute(query)
 
-        conn.close()
-        return dict(row) if row else None
+            # Use fetchone() for maximum efficiency
+            return _row_as_dict(c)
 # Add this new function inside the DatabaseHandler class in dbhelper.py
 
     def select_one(self, table_name, columns='*', where=None, order_by=None):
@@ -154,10 +284,148 @@ class DatabaseHandler:
         if order_by:
             query += f" ORDER BY {order_by}"
 
-        conn = sqlite3.connect(self.db_name, timeout=10)
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        c.execute(query, params)
-        row = c.fetchone()
-        conn.close()
-        return dict(row) if row else None
+        with self._connection() as conn:
+            c = conn.cursor()
+            c.execute(query, params)
+            return _row_as_dict(c)
+
+    def exists(self, table_name, where):
+        """
+        True if any row matches. Stops at the first match and doesn't build a row dict.
+        where: dict of column_name: value for WHERE clause
+        """
+        where_clause = ' AND '.join([f"{k}=?" for k in where.keys()])
+        query = f"SELECT EXISTS(SELECT 1 FROM {table_name} WHERE {where_clause})"
+        with self._connection() as conn:
+            return bool(conn.execute(query, tuple(where.values())).fetchone()[0])
+
+
+class BufferedWriter:
+    """
+    Queues rows for a single INSERT statement and writes them from a background thread
+    with one executemany per batch, so callers don't wait on the database.
+    Rows arriving within flush_interval seconds of each other share a transaction.
+    Callers that need to read their row back right away can put(..., wait=True) and
+    block until the batch holding it has been committed.
+    The worker thread is started on first use, so a process forked after import
+    (gunicorn --preload) starts its own instead of inheriting a dead one.
+    """
+
+    # How long put(wait=True) waits on the worker before writing the row itself
+    WAIT_TIMEOUT_SECONDS = 5
+
+    def __init__(self, db, query, flush_interval=0.1, max_batch=500):
+        self.db = db
+        self.query = query
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        # Guards starting the worker and handing rows between the worker and timed-out waiters
+        self._lock = threading.Lock()
+        # The worker is a daemon thread, so write out whatever is still queued on shutdown
+        atexit.register(self.flush)
+
+    def _ensure_worker(self):
+        """Starts the worker on first use, and again if it has died or we're in a forked child."""
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # Rows queued before the fork belong to the parent, which writes them itself
+                self._queue = queue.Queue()
+                self._thread = None
+                self._pid = os.getpid()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="mentics-buffered-writer", daemon=True)
+                self._thread.start()
+
+    def put(self, params, wait=False):
+        """
+        params: tuple of values for the INSERT's placeholders
+        wait: block until the row is committed. Returns whether it was written
+        (always True when not waiting).
+        """
+        self._ensure_worker()
+        if not wait:
+            self._queue.put((params, None))
+            return True
+        waiter = {"done": threading.Event(), "ok": False,
+                  "claimed": False, "abandoned": False}
+        self._queue.put((params, waiter))
+        if waiter["done"].wait(self.WAIT_TIMEOUT_SECONDS):
+            return waiter["ok"]
+        with self._lock:
+            if not waiter["claimed"]:
+                waiter["abandoned"] = True
+        if waiter["abandoned"]:
+            # The worker never picked the row up; it will skip it, so write it here
+            logger.warning("BufferedWriter: no write after %ss, writing the row directly",
+                           self.WAIT_TIMEOUT_SECONDS)
+            return self._write_one(params)
+        # The worker already has the row's batch in hand; give the commit the same time again
+        waiter["done"].wait(self.WAIT_TIMEOUT_SECONDS)
+        return waiter["ok"]
+
+    def _drain(self, items):
+        if self._queue is None:
+            return items
+        while len(items) < self.max_batch:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _write_one(self, params):
+        try:
+            self.db.execute(self.query, params)
+            return True
+        except Exception:
+            logger.exception("BufferedWriter: failed to write row")
+            return False
+
+    def _claim(self, items):
+        """Drops rows whose caller gave up waiting and wrote them itself, and marks the rest as taken."""
+        claimed = []
+        with self._lock:
+            for params, waiter in items:
+                if waiter is not None:
+                    if waiter["abandoned"]:
+                        continue
+                    waiter["claimed"] = True
+                claimed.append((params, waiter))
+        return claimed
+
+    def _write(self, items):
+        items = self._claim(items)
+        if not items:
+            return
+        try:
+            self.db.executemany(self.query, [params for params, _ in items])
+            results = [True] * len(items)
+        except Exception as e:
+            logger.warning("BufferedWriter: failed to write %d rows, retrying one by one: %s", len(items), e)
+            # One bad row (e.g. a foreign key miss) fails the whole batch, so retry
+            # the rows one by one and only lose the bad ones
+            results = [self._write_one(params) for params, _ in items] if len(items) > 1 else [False]
+        for (_, waiter), ok in zip(items, results):
+            if waiter is not None:
+                waiter["ok"] = ok
+                waiter["done"].set()
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            # Give concurrent requests a moment to add their rows to this batch
+            time.sleep(self.flush_interval)
+            self._write(self._drain([first]))
+
+    def flush(self):
+        """Writes anything still queued, on the calling thread."""
+        items = self._drain([])
+        while items:
+            self._write(items)
+            items = self._drain([])
@@ -0,0 +1,12 @@
+# MENTICS/gunicorn.conf.py
+# Picked up automatically when Render starts the app with `gunicorn app:app`.
+import os
+
+# Requests spend most of their time waiting on Gemini rather than using the CPU,
+# so every worker runs a pool of threads and a slow AI call only ties up one of them.
+worker_class = "gthread"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+threads = int(os.environ.get("GUNICORN_THREADS", 16))
+
+# Path generation can take well over gunicorn's default 30s
+timeout = 120
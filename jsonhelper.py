@@ -0,0 +1,47 @@
+# MENTICS/jsonhelper.py
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    # Fall back to the standard library so the app still runs without orjson installed
+    orjson = None
+
+
+if orjson is not None:
+    # orjson.JSONDecodeError subclasses json.JSONDecodeError, so existing except clauses still work
+    json_loads = orjson.loads
+
+    def json_dumps(obj):
+        """Serializes obj to a JSON str (orjson returns bytes)."""
+        return orjson.dumps(obj).decode("utf-8")
+else:
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        """Serializes obj to a JSON str."""
+        return json.dumps(obj)
+
+
+if orjson is not None:
+    from flask.json.provider import DefaultJSONProvider
+
+    class JSONProvider(DefaultJSONProvider):
+        """Flask JSON provider backed by orjson for jsonify and request.get_json."""
+
+        # Datetimes go through Flask's default hook so responses keep the HTTP-date format
+        _OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+        def dumps(self, obj, **kwargs):
+            option = self._OPTIONS
+            if kwargs.get("sort_keys", self.sort_keys):
+                option |= orjson.OPT_SORT_KEYS
+            if kwargs.get("indent"):
+                option |= orjson.OPT_INDENT_2
+            return orjson.dumps(obj, default=kwargs.get("default", self.default), option=option).decode("utf-8")
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+else:
+    from flask.json.provider import DefaultJSONProvider as JSONProvider
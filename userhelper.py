@@ -1,5 +1,5 @@
 # userhelper.py
-import json
+from jsonhelper import json_loads, json_dumps
 
 
 class User:
@@ -7,6 +7,8 @@ class User:
         self.db = db
         self.email = email
         self.data = None
+        self._stats = None  # Decoded stats, filled in by get_stats()
+        self._onboarding_data = None  # Decoded onboarding answers, filled in by get_onboarding_data()
         if email:
             self.load_user()
 
@@ -14,6 +16,8 @@ class User:
         user_list = self.db.select("users", where={"email": self.email})
         if user_list:
             self.data = user_list[0]
+            self._stats = None
+            self._onboarding_data = None
 
     def get_name(self):
         if self.data and self.data.get('name'):
@@ -27,13 +31,23 @@ class User:
 
     def get_stats(self):
         if self.data and 'stats' in self.data:
-            return json.loads(self.data['stats'])
+            # The User lives for the whole request (see app._current_user), so decode once
+            if self._stats is None:
+                self._stats = json_loads(self.data['stats'])
+            return self._stats
         return {"sat": "0", "act": "0", "gpa": "0.0"}
 
     def set_stats(self, stats):
         if self.data:
-            self.db.update("users", {"stats": json.dumps(
-                stats)}, where={"email": self.email})
+            self.data['stats'] = json_dumps(stats)
+            self._stats = stats
+            self.db.update("users", {"stats": self.data['stats']}, where={"email": self.email})
+
+    def get_onboarding_data(self):
+        if self._onboarding_data is None:
+            raw = self.data.get('onboarding_data') if self.data else None
+            self._onboarding_data = json_loads(raw) if raw else {}
+        return self._onboarding_data
 
     @staticmethod
     def from_session(db, session):